@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+'''Compare the JSON libraries twitterapi.JsonCodec can use on the test data'''
+
+import getopt
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import twitterapi
+
+
+def Usage():
+  print 'Usage: %s [options]' % __file__
+  print
+  print '  This script times decoding every testdata/*.json file, and'
+  print '  encoding the result back to JSON, with each installed library.'
+  print
+  print '  Options:'
+  print '    --help -h : print this help'
+  print '    --rounds : the number of times to process each file [default: 200]'
+
+
+def LoadTestData():
+  directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'testdata')
+  return [open(path).read()
+          for path in sorted(glob.glob(os.path.join(directory, '*.json')))]
+
+
+def GetCodecs(names):
+  codecs = []
+  for name in names:
+    # Encode with the same library where it can encode
+    encoder = None
+    if name in twitterapi.JsonCodec.ENCODERS:
+      encoder = name
+    try:
+      codecs.append(twitterapi.JsonCodec(decoder=name, encoder=encoder))
+    except ImportError:
+      print '%-12s not installed' % name
+  return codecs
+
+
+def Time(function, rounds):
+  start = time.time()
+  for i in xrange(rounds):
+    function()
+  return time.time() - start
+
+
+def Benchmark(rounds):
+  documents = LoadTestData()
+  size = sum([len(d) for d in documents])
+  print 'Processing %d documents (%d bytes) %d times' % (len(documents), size,
+                                                          rounds)
+  print
+  print '%-12s %12s %12s %12s' % ('library', 'decode (s)', 'MB/s', 'encode (s)')
+  for codec in GetCodecs(twitterapi.JsonCodec.DECODERS):
+    def Decode():
+      for document in documents:
+        codec.Decode(document)
+    decoded = [codec.Decode(d) for d in documents]
+    def Encode():
+      for data in decoded:
+        codec.Encode(data, sort_keys=True)
+    decode_time = Time(Decode, rounds)
+    encode_time = Time(Encode, rounds)
+    print '%-12s %12.3f %12.1f %12.3f  (encoding with %s)' % (
+        codec.decoder, decode_time, size * rounds / decode_time / (1 << 20),
+        encode_time, codec.encoder)
+  print
+  print 'Default codec decodes with %s' % twitterapi.JsonCodec().decoder
+
+
+def main():
+  try:
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'h', ['help', 'rounds='])
+  except getopt.GetoptError:
+    Usage()
+    sys.exit(2)
+  rounds = 200
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      Usage()
+      sys.exit(2)
+    if o == "--rounds":
+      rounds = int(a)
+  Benchmark(rounds)
+
+if __name__ == "__main__":
+  main()
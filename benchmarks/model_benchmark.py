@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+'''Compare the memory use and attribute speed of the twitterapi models'''
+
+import getopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import twitterapi
+
+
+def Usage():
+  print 'Usage: %s [options]' % __file__
+  print
+  print '  This script builds the statuses in testdata/public_timeline.json'
+  print '  with twitterapi.Status, twitterapi.CompactStatus and'
+  print '  twitterapi.LazyStatus and compares the memory each instance takes'
+  print '  and the time taken to build them and to read and write their'
+  print '  attributes.'
+  print
+  print '  Options:'
+  print '    --help -h : print this help'
+  print '    --rounds : the number of times to repeat each test [default: 2000]'
+
+
+def LoadStatuses():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'testdata', 'public_timeline.json')
+  return twitterapi.JsonCodec().Decode(open(path).read())
+
+
+def GetInstanceSize(instance):
+  '''Return the bytes taken by an instance, including its __dict__'''
+  size = sys.getsizeof(instance)
+  if hasattr(instance, '__dict__'):
+    size += sys.getsizeof(instance.__dict__)
+  return size
+
+
+def Time(function, rounds):
+  start = time.time()
+  for i in xrange(rounds):
+    function()
+  return time.time() - start
+
+
+def Benchmark(rounds):
+  data = LoadStatuses()
+  print 'Building %d statuses %d times' % (len(data), rounds)
+  print
+  print '%-14s %10s %10s %12s %12s %12s' % (
+      'model', 'status (B)', 'user (B)', 'build (s)', 'get (s)', 'set (s)')
+  for cls in [twitterapi.Status, twitterapi.CompactStatus,
+              twitterapi.LazyStatus]:
+    statuses = [cls.NewFromJsonDict(d) for d in data]
+    def Build():
+      for d in data:
+        cls.NewFromJsonDict(d)
+    def Get():
+      for status in statuses:
+        status.id
+        status.text
+        status.created_at
+        status.user
+    def Set():
+      for status in statuses:
+        status.favorited = True
+        status.text = status.text
+    status_size = sum([GetInstanceSize(s) for s in statuses]) / len(statuses)
+    user_size = sum([GetInstanceSize(s.user) for s in statuses]) / len(statuses)
+    print '%-14s %10d %10d %12.3f %12.3f %12.3f' % (
+        cls.__name__, status_size, user_size, Time(Build, rounds),
+        Time(Get, rounds), Time(Set, rounds))
+
+
+def main():
+  try:
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'h', ['help', 'rounds='])
+  except getopt.GetoptError:
+    Usage()
+    sys.exit(2)
+  rounds = 2000
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      Usage()
+      sys.exit(2)
+    if o == "--rounds":
+      rounds = int(a)
+  Benchmark(rounds)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+'''Compare the ways twitterapi can convert created_at timestamps'''
+
+import calendar
+import getopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import twitterapi
+
+
+def Usage():
+  print 'Usage: %s [options]' % __file__
+  print
+  print '  This script times converting the created_at timestamps of the'
+  print '  statuses in testdata/public_timeline.json to seconds since the'
+  print '  epoch with time.strptime, with twitterapi._ParseCreatedAt, and by'
+  print '  reading Status.created_at_in_seconds, which is parsed once.  It'
+  print '  then compares reading relative_created_at from each status with'
+  print '  twitterapi.GetCreatedAtTimes.'
+  print
+  print '  Options:'
+  print '    --help -h : print this help'
+  print '    --rounds : the number of times to repeat each test [default: 2000]'
+
+
+def LoadStatuses():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'testdata', 'public_timeline.json')
+  data = twitterapi.JsonCodec().Decode(open(path).read())
+  return [twitterapi.Status.NewFromJsonDict(d) for d in data]
+
+
+def Time(function, rounds):
+  start = time.time()
+  for i in xrange(rounds):
+    function()
+  return time.time() - start
+
+
+def Benchmark(rounds):
+  statuses = LoadStatuses()
+  timestamps = [s.created_at for s in statuses]
+  def Strptime():
+    for created_at in timestamps:
+      calendar.timegm(time.strptime(created_at, '%a %b %d %H:%M:%S +0000 %Y'))
+  def Parse():
+    for created_at in timestamps:
+      twitterapi._ParseCreatedAt(created_at)
+  def Property():
+    for status in statuses:
+      status.created_at_in_seconds
+  print 'Converting %d timestamps %d times' % (len(timestamps), rounds)
+  print
+  print '%-26s %12s %10s' % ('method', 'time (s)', 'speedup')
+  baseline = Time(Strptime, rounds)
+  for name, function in [('time.strptime', None),
+                         ('_ParseCreatedAt', Parse),
+                         ('created_at_in_seconds', Property)]:
+    if function is None:
+      elapsed = baseline
+    else:
+      elapsed = Time(function, rounds)
+    print '%-26s %12.3f %9.1fx' % (name, elapsed, baseline / elapsed)
+  print
+  now = time.time()
+  def Relative():
+    for status in statuses:
+      status.SetNow(now)
+      status.relative_created_at
+  def Batch():
+    twitterapi.GetCreatedAtTimes(statuses, now)
+  if twitterapi.numpy is None:
+    batch = 'GetCreatedAtTimes'
+  else:
+    batch = 'GetCreatedAtTimes (numpy)'
+  baseline = Time(Relative, rounds)
+  for name, function in [('relative_created_at', None), (batch, Batch)]:
+    if function is None:
+      elapsed = baseline
+    else:
+      elapsed = Time(function, rounds)
+    print '%-26s %12.3f %9.1fx' % (name, elapsed, baseline / elapsed)
+
+
+def main():
+  try:
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 'h', ['help', 'rounds='])
+  except getopt.GetoptError:
+    Usage()
+    sys.exit(2)
+  rounds = 2000
+  for o, a in opts:
+    if o in ("-h", "--help"):
+      Usage()
+      sys.exit(2)
+    if o == "--rounds":
+      rounds = int(a)
+  Benchmark(rounds)
+
+if __name__ == "__main__":
+  main()
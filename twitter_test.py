@@ -8,11 +8,21 @@
 
 __author__ = 'dewitt@google.com'
 
+import BaseHTTPServer
+import gzip
 import os
+import shutil
 import simplejson
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
 import time
 import calendar
 import unittest
+import urllib2
+import zlib
 
 import twitterapi
 
@@ -259,6 +269,341 @@ class UserTest(unittest.TestCase):
     self.assertEqual(self._GetSampleUser(), user)
 
 
+class CompactModelTest(unittest.TestCase):
+
+  def testGettersAndSetters(self):
+    '''Test the twitterapi.CompactStatus getters and setters'''
+    status = twitterapi.CompactStatus()
+    status.SetId(4391023)
+    self.assertEqual(4391023, status.GetId())
+    created_at = calendar.timegm((2007, 1, 26, 23, 17, 14, -1, -1, -1))
+    status.SetCreatedAt('Fri Jan 26 23:17:14 +0000 2007')
+    self.assertEqual('Fri Jan 26 23:17:14 +0000 2007', status.GetCreatedAt())
+    self.assertEqual(created_at, status.GetCreatedAtInSeconds())
+    status.SetNow(created_at + 10)
+    self.assertEqual('about 10 seconds ago', status.GetRelativeCreatedAt())
+    status.SetUser(twitterapi.CompactUser(screen_name='kesuke'))
+    self.assertEqual('kesuke', status.GetUser().GetScreenName())
+    message = twitterapi.CompactDirectMessage()
+    message.SetRecipientScreenName('dewitt')
+    self.assertEqual('dewitt', message.recipient_screen_name)
+
+  def testSameAsDefaultModels(self):
+    '''Test that compact models match the default ones'''
+    for filename, cls, compact_cls in [
+        ('public_timeline.json', twitterapi.Status, twitterapi.CompactStatus),
+        ('friends.json', twitterapi.User, twitterapi.CompactUser),
+        ('direct_messages.json', twitterapi.DirectMessage,
+         twitterapi.CompactDirectMessage)]:
+      data = simplejson.loads(open(_GetTestDataPath(filename)).read())
+      for item in data:
+        model = cls.NewFromJsonDict(item)
+        compact = compact_cls.NewFromJsonDict(item)
+        self.assertEqual(model, compact)
+        self.assertEqual(model.AsJsonString(), compact.AsJsonString())
+
+  def testSlots(self):
+    '''Test that compact models have no __dict__'''
+    status = twitterapi.CompactStatus(id=1)
+    self.failIf(hasattr(status, '__dict__'))
+    self.assertRaises(AttributeError, setattr, status, 'foo', 1)
+
+class LazyModelTest(unittest.TestCase):
+
+  def testGettersAndSetters(self):
+    '''Test the twitterapi.LazyStatus getters and setters'''
+    status = twitterapi.LazyStatus()
+    status.SetId(4391023)
+    self.assertEqual(4391023, status.GetId())
+    created_at = calendar.timegm((2007, 1, 26, 23, 17, 14, -1, -1, -1))
+    status.SetCreatedAt('Fri Jan 26 23:17:14 +0000 2007')
+    self.assertEqual(created_at, status.GetCreatedAtInSeconds())
+    status.SetNow(created_at + 10)
+    self.assertEqual('about 10 seconds ago', status.GetRelativeCreatedAt())
+    self.assertEqual(None, status.GetUser())
+    status.SetUser(twitterapi.LazyUser(screen_name='kesuke'))
+    self.assertEqual('kesuke', status.GetUser().GetScreenName())
+    message = twitterapi.LazyDirectMessage(text='hi')
+    message.SetRecipientScreenName('dewitt')
+    self.assertEqual('dewitt', message.recipient_screen_name)
+    self.assertEqual('hi', message.text)
+
+  def testSameAsDefaultModels(self):
+    '''Test that lazy models match the default ones'''
+    for filename, cls, lazy_cls in [
+        ('public_timeline.json', twitterapi.Status, twitterapi.LazyStatus),
+        ('friends.json', twitterapi.User, twitterapi.LazyUser),
+        ('direct_messages.json', twitterapi.DirectMessage,
+         twitterapi.LazyDirectMessage)]:
+      data = simplejson.loads(open(_GetTestDataPath(filename)).read())
+      for item in data:
+        model = cls.NewFromJsonDict(item)
+        lazy = lazy_cls.NewFromJsonDict(item)
+        self.assertEqual(model, lazy)
+        self.assertEqual(model.AsJsonString(), lazy.AsJsonString())
+
+  def testNestedModelsBuiltOnAccess(self):
+    '''Test that lazy models build nested models on first access'''
+    data = simplejson.loads(open(_GetTestDataPath('show-dewitt.json')).read())
+    user = twitterapi.LazyUser.NewFromJsonDict(data)
+    self.assertEqual('dewitt', user.screen_name)
+    self.assertRaises(AttributeError, getattr, user, '_status')
+    status = user.status
+    self.assert_(isinstance(status, twitterapi.LazyStatus))
+    self.assert_(status is user.status)
+    user.name = 'DeWitt Clinton'
+    self.assertEqual('DeWitt Clinton', data['name'])
+
+class CreatedAtTest(unittest.TestCase):
+
+  def _Strptime(self, created_at):
+    return calendar.timegm(time.strptime(created_at,
+                                         '%a %b %d %H:%M:%S +0000 %Y'))
+
+  def testParseCreatedAt(self):
+    '''Test that twitterapi._ParseCreatedAt agrees with time.strptime'''
+    timestamps = ['Thu Jan 01 00:00:00 +0000 1970',
+                  'Fri Feb 29 23:59:59 +0000 2008',
+                  'Sat Mar 01 00:00:00 +0000 2008',
+                  'Wed Mar 01 00:00:00 +0000 2000',
+                  'Mon Mar 01 00:00:00 +0000 2100',
+                  'Fri Dec 31 23:59:59 +0000 1999']
+    for filename in ['public_timeline.json', 'direct_messages.json']:
+      data = simplejson.loads(open(_GetTestDataPath(filename)).read())
+      timestamps.extend([item['created_at'] for item in data])
+    for created_at in timestamps:
+      self.assertEqual(self._Strptime(created_at),
+                       twitterapi._ParseCreatedAt(created_at))
+
+  def testParseOtherFormats(self):
+    '''Test that twitterapi._ParseCreatedAt falls back to time.strptime'''
+    self.assertEqual(self._Strptime('Sat Jan 27 4:17:38 +0000 2007'),
+                     twitterapi._ParseCreatedAt('Sat Jan 27 4:17:38 +0000 2007'))
+    self.assertRaises(ValueError, twitterapi._ParseCreatedAt,
+                      'Sat Foo 27 04:17:38 +0000 2007')
+    self.assertRaises(ValueError, twitterapi._ParseCreatedAt, '2007-01-27')
+    # Fields out of range are not read at fixed offsets either
+    for created_at in ['Xxx Jan 99 99:99:99 +0000 2007',
+                       'Fri Feb 30 00:00:00 +0000 2007',
+                       'Fri Jan 27 24:00:00 +0000 2007',
+                       'Fri Jan 27 23:60:00 +0000 2007',
+                       'Fri Jan -1 23:00:00 +0000 2007']:
+      self.assertRaises(ValueError, twitterapi._ParseCreatedAt, created_at)
+    # time.strptime allows leap seconds and leap days
+    self.assertEqual(self._Strptime('Sat Dec 31 23:59:60 +0000 2005'),
+                     twitterapi._ParseCreatedAt('Sat Dec 31 23:59:60 +0000 2005'))
+    self.assertEqual(self._Strptime('Fri Feb 29 12:00:00 +0000 2008'),
+                     twitterapi._ParseCreatedAt('Fri Feb 29 12:00:00 +0000 2008'))
+
+  def testSetCreatedAtInvalidates(self):
+    '''Test that created_at_in_seconds follows changes to created_at'''
+    for cls in [twitterapi.Status, twitterapi.CompactStatus,
+                twitterapi.LazyStatus, twitterapi.DirectMessage,
+                twitterapi.CompactDirectMessage,
+                twitterapi.LazyDirectMessage]:
+      model = cls(created_at='Fri Jan 26 23:17:14 +0000 2007')
+      self.assertEqual(1169853434, model.created_at_in_seconds)
+      model.SetCreatedAt('Fri Jan 26 23:17:15 +0000 2007')
+      self.assertEqual(1169853435, model.created_at_in_seconds)
+      model.created_at = 'Fri Jan 26 23:17:16 +0000 2007'
+      self.assertEqual(1169853436, model.GetCreatedAtInSeconds())
+
+class CreatedAtTimesTest(unittest.TestCase):
+
+  def testSameAsModels(self):
+    '''Test that twitterapi.GetCreatedAtTimes matches the models'''
+    data = simplejson.loads(open(_GetTestDataPath('public_timeline.json')).read())
+    statuses = [twitterapi.Status.NewFromJsonDict(item) for item in data]
+    posted = statuses[0].created_at_in_seconds
+    for offset in [-5, 0, 1, 2, 47, 48, 74, 75, 2879, 2880, 4499, 4500,
+                   69119, 69120, 107999, 108000, 10 ** 7]:
+      now = posted + offset
+      seconds, deltas, relative = twitterapi.GetCreatedAtTimes(statuses, now)
+      for i, status in enumerate(statuses):
+        status.SetNow(now)
+        self.assertEqual(status.created_at_in_seconds, seconds[i])
+        self.assertEqual(now - status.created_at_in_seconds, deltas[i])
+        self.assertEqual(status.relative_created_at, relative[i])
+
+  def testDirectMessages(self):
+    '''Test twitterapi.GetCreatedAtTimes with direct messages'''
+    data = simplejson.loads(open(_GetTestDataPath('direct_messages.json')).read())
+    messages = [twitterapi.CompactDirectMessage.NewFromJsonDict(item)
+                for item in data]
+    now = messages[0].created_at_in_seconds + 120
+    seconds, deltas, relative = twitterapi.GetCreatedAtTimes(messages, now)
+    self.assertEqual([m.created_at_in_seconds for m in messages], list(seconds))
+    self.assertEqual(120, deltas[0])
+    self.assertEqual('about 2 minutes ago', relative[0])
+    self.assertEqual(len(messages), len(relative))
+
+  def testNumpy(self):
+    '''Test that the numpy path of GetCreatedAtTimes matches pure Python'''
+    if twitterapi.numpy is None:
+      self.skipTest('numpy is not installed')
+    data = simplejson.loads(open(_GetTestDataPath('public_timeline.json')).read())
+    statuses = [twitterapi.Status.NewFromJsonDict(item) for item in data]
+    posted = statuses[0].created_at_in_seconds
+    for offset in [-5, 0, 1, 47, 48, 2880, 4500, 108000, 10 ** 7]:
+      now = posted + offset
+      seconds, deltas, relative = twitterapi.GetCreatedAtTimes(statuses, now)
+      numpy = twitterapi.numpy
+      twitterapi.numpy = None
+      try:
+        expected = twitterapi.GetCreatedAtTimes(statuses, now)
+      finally:
+        twitterapi.numpy = numpy
+      self.assert_(isinstance(seconds, numpy.ndarray))
+      self.assertEqual(expected[0], seconds.tolist())
+      self.assertEqual(expected[1], deltas.tolist())
+      self.assertEqual(expected[2], relative)
+
+  def testEmpty(self):
+    '''Test twitterapi.GetCreatedAtTimes with no models'''
+    seconds, deltas, relative = twitterapi.GetCreatedAtTimes([])
+    self.assertEqual(0, len(seconds))
+    self.assertEqual([], relative)
+
+class TimelineFrameTest(unittest.TestCase):
+
+  def setUp(self):
+    self._data = simplejson.loads(
+        open(_GetTestDataPath('public_timeline.json')).read())
+    self._statuses = [twitterapi.Status.NewFromJsonDict(item)
+                      for item in self._data]
+    self._frame = twitterapi.TimelineFrame.NewFromJsonList(self._data)
+
+  def testColumns(self):
+    '''Test the twitterapi.TimelineFrame columns'''
+    self.assertEqual(len(self._statuses), len(self._frame))
+    self.assertEqual([s.id for s in self._statuses], list(self._frame.ids))
+    self.assertEqual([s.created_at_in_seconds for s in self._statuses],
+                     list(self._frame.created_at_in_seconds))
+    self.assertEqual([s.user.id for s in self._statuses],
+                     list(self._frame.user_ids))
+    self.assertEqual([s.text for s in self._statuses], self._frame.GetTexts())
+
+  def testMaterialize(self):
+    '''Test that a twitterapi.TimelineFrame builds the same statuses'''
+    self.assertEqual(self._statuses, self._frame.GetStatuses())
+    self.assertEqual(self._statuses[-1], self._frame[-1])
+    frame = twitterapi.TimelineFrame(self._statuses)
+    self.assertEqual(self._statuses, list(frame))
+    compact = twitterapi.TimelineFrame.NewFromJsonList(
+        self._data, status_class=twitterapi.CompactStatus)
+    self.assert_(isinstance(compact[0], twitterapi.CompactStatus))
+    self.assertEqual(self._statuses[0], compact[0])
+
+  def testSliceAndFilter(self):
+    '''Test slicing and filtering a twitterapi.TimelineFrame'''
+    self.assertEqual(self._statuses[2:5], list(self._frame[2:5]))
+    self.assertEqual(self._statuses[::-1], list(self._frame[::-1]))
+    since = self._statuses[5].created_at_in_seconds
+    self.assertEqual(
+        [s for s in self._statuses if s.created_at_in_seconds >= since],
+        list(self._frame.Filter(since=since)))
+    since_id = self._statuses[5].id
+    self.assertEqual([s for s in self._statuses if s.id > since_id],
+                     list(self._frame.Filter(since_id=since_id)))
+    user_id = self._statuses[0].user.id
+    frame = self._frame.Filter(user_ids=[user_id], max_id=self._statuses[0].id)
+    self.assertEqual(
+        [s for s in self._statuses
+         if s.user.id == user_id and s.id <= self._statuses[0].id],
+        list(frame))
+    self.assertEqual([s for s in self._statuses if 'the' in s.text],
+                     list(self._frame.Filter(text='the')))
+    self.assertEqual(0, len(self._frame.Filter(until=0)))
+
+  def testSortAndTop(self):
+    '''Test sorting a twitterapi.TimelineFrame'''
+    by_id = sorted(self._statuses, key=lambda s: s.id)
+    self.assertEqual(by_id, list(self._frame.Sort()))
+    self.assertEqual(by_id[::-1], list(self._frame.Sort(reverse=True)))
+    by_user = sorted(self._statuses, key=lambda s: s.user.id)
+    self.assertEqual(by_user, list(self._frame.Sort('user_id')))
+    newest = sorted(self._statuses, key=lambda s: s.created_at_in_seconds,
+                    reverse=True)[:3]
+    self.assertEqual(newest, list(self._frame.Top(3)))
+    self.assertEqual(by_id[::-1][:2], list(self._frame.Top(2, key='id')))
+    self.assertRaises(twitterapi.TwitterError, self._frame.Sort, 'text')
+
+  def testSortAndTopNumpy(self):
+    '''Test that sorting with numpy matches sorting in pure Python'''
+    if twitterapi.numpy is None:
+      self.skipTest('numpy is not installed')
+    for key in twitterapi.TimelineFrame.KEYS:
+      for reverse in (False, True):
+        self.assertEqual(
+            self._WithoutNumpy(lambda: list(self._frame.Sort(key, reverse))),
+            list(self._frame.Sort(key, reverse)))
+      for n in (0, 3, len(self._frame) + 1):
+        self.assertEqual(
+            self._WithoutNumpy(lambda: list(self._frame.Top(n, key))),
+            list(self._frame.Top(n, key)))
+
+  def testLargeIds(self):
+    '''Test that ids beyond the precision of a double are kept exactly'''
+    base = 2 ** 62
+    data = [{'id': base + i, 'user': {'id': base + i % 2}}
+            for i in (3, 1, 2)]
+    typecode = twitterapi._INT64_TYPECODE
+    # The columns of a platform whose C long has 32 bits
+    twitterapi._INT64_TYPECODE = None
+    try:
+      frame = twitterapi.TimelineFrame.NewFromJsonList(data)
+    finally:
+      twitterapi._INT64_TYPECODE = typecode
+    self.assertEqual([base + 3, base + 1, base + 2], list(frame.ids))
+    self.assertEqual(base + 3, frame[0].id)
+    self.assertEqual([base + 2], list(frame.Filter(since_id=base + 1).Sort(
+        reverse=True)[1:].ids))
+    sorts = [lambda: list(frame.Sort().ids),
+             lambda: list(frame.Top(2, key='id').ids),
+             lambda: list(frame.Sort('user_id').ids)]
+    expected = [[base + 1, base + 2, base + 3], [base + 3, base + 2],
+                [base + 2, base + 3, base + 1]]
+    self.assertEqual(expected, self._WithoutNumpy(
+        lambda: [sort() for sort in sorts]))
+    if twitterapi.numpy is not None:
+      self.assertEqual(expected, [sort() for sort in sorts])
+
+  def _WithoutNumpy(self, function):
+    numpy = twitterapi.numpy
+    twitterapi.numpy = None
+    try:
+      return function()
+    finally:
+      twitterapi.numpy = numpy
+
+  def testUsersWithoutIds(self):
+    '''Test that users without an id are not shared between statuses'''
+    data = [{'id': 1, 'user': {'screen_name': 'first'}},
+            {'id': 2, 'user': {'screen_name': 'second'}},
+            {'id': 3, 'user': {'id': 7, 'screen_name': 'new'}},
+            {'id': 4, 'user': {'id': 7, 'screen_name': 'old'}}]
+    frame = twitterapi.TimelineFrame.NewFromJsonList(data)
+    self.assertEqual(['first', 'second', 'new', 'new'],
+                     [status.user.screen_name for status in frame])
+    self.assertEqual([0, 0, 7, 7], list(frame.user_ids))
+
+  def testGroupByUser(self):
+    '''Test grouping a twitterapi.TimelineFrame by user'''
+    groups = self._frame.GroupByUser()
+    self.assertEqual(set([s.user.id for s in self._statuses]),
+                     set(groups.keys()))
+    for user_id, frame in groups.items():
+      self.assertEqual([s for s in self._statuses if s.user.id == user_id],
+                       list(frame))
+
+  def testEmpty(self):
+    '''Test an empty twitterapi.TimelineFrame'''
+    frame = twitterapi.TimelineFrame()
+    self.assertEqual(0, len(frame))
+    self.assertEqual([], list(frame.Sort()))
+    self.assertEqual([], list(frame.Top(5)))
+    self.assertEqual({}, frame.GroupByUser())
+
 class FileCacheTest(unittest.TestCase):
 
   def testInit(self):
@@ -299,6 +644,635 @@ class FileCacheTest(unittest.TestCase):
                  'Cached time differs from clock time by more than 1 second.')
     cache.Remove("foo")
 
+class CacheCompressorTest(unittest.TestCase):
+
+  def setUp(self):
+    self._data = open(_GetTestDataPath('public_timeline.json')).read()
+
+  def testCompress(self):
+    '''Test that entries are compressed and decompressed'''
+    compressor = twitterapi._CacheCompressor('zlib')
+    compressed = compressor.Compress(self._data)
+    self.assert_(len(compressed) < len(self._data) / 3)
+    self.assertEqual(self._data, compressor.Decompress(compressed))
+    self.assertEqual(len(self._data) - len(compressed),
+                     compressor.GetBytesSaved())
+
+  def testUncompressed(self):
+    '''Test that uncompressed and incompressible entries are readable'''
+    compressor = twitterapi._CacheCompressor('zlib')
+    self.assertEqual(self._data, compressor.Decompress(self._data))
+    for data in ['', 'x', '\x00z', '\x1f\x8b\x08']:
+      self.assertEqual(data, compressor.Decompress(compressor.Compress(data)))
+    self.assertEqual(0, compressor.GetBytesSaved())
+
+  def testFileCache(self):
+    '''Test that twitterapi._FileCache compresses entries on disk'''
+    directory = tempfile.mkdtemp()
+    try:
+      cache = twitterapi._FileCache(directory)
+      cache.Set('old', self._data)
+      cache = twitterapi._FileCache(directory, compress='zlib')
+      cache.Set('new', self._data)
+      self.assertEqual(self._data, cache.Get('old'))
+      self.assertEqual(self._data, cache.Get('new'))
+      self.assert_(cache.GetBytesSaved() > len(self._data) / 2)
+      self.assertEqual(len(self._data) - cache.GetBytesSaved(),
+                       os.path.getsize(cache._GetPath('new')))
+    finally:
+      shutil.rmtree(directory)
+
+  def testLz4(self):
+    '''Test the lz4 codec'''
+    try:
+      import lz4.block
+    except ImportError:
+      self.skipTest('lz4 is not installed')
+    compressor = twitterapi._CacheCompressor('lz4')
+    compressed = compressor.Compress(self._data)
+    self.assert_(compressed.startswith('\x00l'))
+    self.assert_(len(compressed) < len(self._data) / 2)
+    self.assertEqual(self._data, compressor.Decompress(compressed))
+
+  def testUnreadable(self):
+    '''Test that corrupt entries and unknown codecs decompress to None'''
+    compressed = twitterapi._CacheCompressor('zlib').Compress(self._data)
+    self.assertEqual(None, twitterapi._CacheCompressor.Decompress(
+        compressed[:len(compressed) / 2]))
+    self.assertEqual(None, twitterapi._CacheCompressor.Decompress('\x00qabc'))
+
+  def testRawEntriesEscaped(self):
+    '''Test that uncompressed caches keep entries starting with a NUL'''
+    directory = tempfile.mkdtemp()
+    try:
+      for cache in [twitterapi._FileCache(directory),
+                    twitterapi._SqliteCache(os.path.join(directory, 'db'))]:
+        for data in ['\x00zfoo', '\x00r', '\x00']:
+          cache.Set('foo', data)
+          self.assertEqual(data, cache.Get('foo'))
+    finally:
+      shutil.rmtree(directory)
+
+  def testCorruptEntryIsMiss(self):
+    '''Test that an unreadable entry is a miss and is removed'''
+    directory = tempfile.mkdtemp()
+    try:
+      cache = twitterapi._FileCache(directory, compress='zlib')
+      cache.Set('foo', self._data)
+      fp = open(cache._GetPath('foo'), 'wb')
+      fp.write('\x00zcorrupt')
+      fp.close()
+      self.assertEqual(None, cache.Get('foo'))
+      self.assertEqual(None, cache.GetCachedTime('foo'))
+      self.assertEqual(1, cache.GetStats().Get('misses'))
+      self.assertEqual(0, cache.GetStats().Get('hits'))
+    finally:
+      shutil.rmtree(directory)
+
+  def testSqliteCache(self):
+    '''Test that twitterapi._SqliteCache compresses entries'''
+    directory = tempfile.mkdtemp()
+    try:
+      cache = twitterapi._SqliteCache(os.path.join(directory, 'cache.sqlite'),
+                                      compress=True)
+      cache.Set('foo', self._data)
+      self.assertEqual(self._data, cache.Get('foo'))
+      self.assert_(cache.GetBytesSaved() > len(self._data) / 2)
+      cache.Close()
+    finally:
+      shutil.rmtree(directory)
+
+class FileCacheSweepTest(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._directory)
+
+  def testMaxBytes(self):
+    '''Test that the least recently read entries are evicted first'''
+    cache = twitterapi._FileCache(self._directory, max_bytes=25)
+    cache.Sweep()
+    cache.Set('a', 'x' * 10)
+    cache.Set('b', 'x' * 10)
+    self._Age(cache, 'a', 20)
+    self._Age(cache, 'b', 10)
+    cache.Get('a')
+    cache.Set('c', 'x' * 10)
+    self._WaitForSweep(cache)
+    self.assertEqual('x' * 10, cache.Get('a'))
+    self.assertEqual(None, cache.Get('b'))
+    self.assertEqual('x' * 10, cache.Get('c'))
+    self.assertEqual(10, cache.GetBytesReclaimed())
+
+  def testLowWaterMark(self):
+    '''Test that a full cache is swept down to its low water mark'''
+    cache = twitterapi._FileCache(self._directory, max_bytes=100)
+    cache.Sweep()
+    for i in range(10):
+      cache.Set(str(i), 'x' * 10)
+      self._Age(cache, str(i), 100 - i)
+    self.assertEqual(0, cache.GetBytesReclaimed())
+    cache.Set('10', 'x' * 10)
+    self._WaitForSweep(cache)
+    self.assertEqual(20, cache.GetBytesReclaimed())
+    self.assertEqual(None, cache.Get('0'))
+    self.assertEqual(None, cache.Get('1'))
+    self.assertEqual('x' * 10, cache.Get('2'))
+    # The next Set fits under max_bytes, so it doesn't sweep again
+    cache.Set('11', 'x' * 10)
+    self.assertEqual(False, cache._sweep_requested)
+
+  def testSweep(self):
+    '''Test that sweeping removes expired entries and reports their size'''
+    cache = twitterapi._FileCache(self._directory, max_age=60)
+    cache.Set('a', 'x' * 10)
+    cache.Set('b', 'x' * 5)
+    self._Age(cache, 'a', 120)
+    self.assertEqual(10, cache.Sweep())
+    self.assertEqual(1, cache.GetStats().Get('evictions'))
+    self.assertEqual(None, cache.Get('a'))
+    self.assertEqual('x' * 5, cache.Get('b'))
+    self.assertEqual(0, cache.Sweep())
+    self.assertEqual(10, cache.GetBytesReclaimed())
+
+  def testSweeper(self):
+    '''Test that the background sweeper sweeps the cache'''
+    cache = twitterapi._FileCache(self._directory, max_age=60)
+    cache.Set('a', 'x' * 10)
+    self._Age(cache, 'a', 120)
+    cache.StartSweeper(interval=0.01)
+    try:
+      deadline = time.time() + 5
+      while cache.GetBytesReclaimed() == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    finally:
+      cache.StopSweeper()
+    self.assertEqual(10, cache.GetBytesReclaimed())
+    self.assertEqual(None, cache.Get('a'))
+
+  def _WaitForSweep(self, cache):
+    '''Wait for a sweep started in the background by a Set to finish'''
+    deadline = time.time() + 5
+    while cache._sweep_requested and time.time() < deadline:
+      time.sleep(0.01)
+
+  def _Age(self, cache, key, seconds):
+    '''Make an entry look written and read the given seconds ago'''
+    then = time.time() - seconds
+    os.utime(cache._GetPath(key), (then, then))
+
+class SharedFileCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+    self._cache = twitterapi._FileCache(self._directory)
+
+  def tearDown(self):
+    shutil.rmtree(self._directory)
+
+  def testSetWritesInPlace(self):
+    '''Test that entries are written without leaving temporary files'''
+    self._cache.Set('foo', 'Hello World!')
+    self._cache.Set('foo', 'Hello again!')
+    self.assertEqual([self._cache._GetPath('foo')], self._ListFiles())
+
+  def testSweepKeepsLockFile(self):
+    '''Test that sweeping keeps the lock file and recent temporary files'''
+    cache = twitterapi._FileCache(self._directory, max_age=60)
+    cache.GetLock('foo')
+    temp_fd, temp_path = tempfile.mkstemp(prefix='.tmp', dir=self._directory)
+    os.close(temp_fd)
+    cache.Sweep()
+    self.assertEqual(2, len(self._ListFiles()))
+    an_hour_ago = time.time() - 3600
+    os.utime(temp_path, (an_hour_ago, an_hour_ago))
+    cache.Sweep()
+    self.assertEqual([os.path.join(self._directory, '.lock')],
+                     self._ListFiles())
+
+  def testLockExcludesOtherProcesses(self):
+    '''Test that a key's lock is held by one process at a time'''
+    if not hasattr(os, 'fork'):
+      return
+    url = 'http://twitter.com/users/show/dewitt.json'
+    key = 'test:' + url
+    data = open(_GetTestDataPath('show-dewitt.json')).read()
+    self._cache.Set(key, data)
+    an_hour_ago = time.time() - 3600
+    os.utime(self._cache._GetPath(key), (an_hour_ago, an_hour_ago))
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      # The child refreshes the entry while holding its lock
+      try:
+        cache = twitterapi._FileCache(self._directory)
+        lock = cache.GetLock(key)
+        lock.Acquire()
+        os.write(write_fd, 'x')
+        time.sleep(0.3)
+        cache.Set(key, data)
+        lock.Release()
+      finally:
+        os._exit(0)
+    os.read(read_fd, 1)
+    api = twitterapi.Api(username='test', password='test')
+    api.SetCache(twitterapi._MemoryCache(self._cache))
+    urllib = MockUrllib()
+    urllib.AddHandler(url, lambda: self.fail('entry was fetched again'))
+    api.SetUrllib(urllib)
+    start = time.time()
+    self.assertEqual('dewitt', api.GetUser('dewitt').screen_name)
+    self.assert_(time.time() - start > 0.1)
+    os.waitpid(pid, 0)
+    os.close(read_fd)
+    os.close(write_fd)
+
+  def testLockExcludesOtherInstances(self):
+    '''Test that caches sharing a directory in one process share its locks'''
+    if twitterapi.fcntl is None:
+      return
+    lock = self._cache.GetLock('foo')
+    other = twitterapi._FileCache(self._directory).GetLock('foo')
+    self.assert_(lock.Acquire())
+    self.assertFalse(other.Acquire(0.05))
+    lock.Release()
+    self.assert_(other.Acquire(0))
+    other.Release()
+    self.assertEqual({}, twitterapi._FILE_THREAD_LOCKS)
+
+  def testLockTimeout(self):
+    '''Test that an entry is fetched without the lock if it is held too long'''
+    if twitterapi.fcntl is None:
+      return
+    url = 'http://twitter.com/users/show/dewitt.json'
+    key = 'test:' + url
+    lock = twitterapi._FileCache(self._directory).GetLock(key)
+    lock.Acquire()
+    default_timeout = twitterapi._FileLock.DEFAULT_TIMEOUT
+    twitterapi._FileLock.DEFAULT_TIMEOUT = 0.05
+    try:
+      api = twitterapi.Api(username='test', password='test')
+      api.SetCache(self._cache)
+      urllib = MockUrllib()
+      urllib.AddHandler(url, curry(_OpenTestData, 'show-dewitt.json'))
+      api.SetUrllib(urllib)
+      self.assertEqual('dewitt', api.GetUser('dewitt').screen_name)
+    finally:
+      twitterapi._FileLock.DEFAULT_TIMEOUT = default_timeout
+      lock.Release()
+
+  def _ListFiles(self):
+    paths = []
+    for directory, directories, filenames in os.walk(self._directory):
+      paths.extend([os.path.join(directory, f) for f in filenames])
+    return paths
+
+class SqliteCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+    self._cache = twitterapi._SqliteCache(
+      os.path.join(self._directory, 'cache.sqlite'))
+
+  def tearDown(self):
+    self._cache.Close()
+    shutil.rmtree(self._directory)
+
+  def testGetAndSet(self):
+    '''Test the twitterapi._SqliteCache Get and Set methods'''
+    self.assertEqual(None, self._cache.Get('foo'))
+    self._cache.Set('foo', 'Hello World!')
+    self.assertEqual('Hello World!', self._cache.Get('foo'))
+    self._cache.Set('foo', '\x1f\x8b\x00\xff')
+    self.assertEqual('\x1f\x8b\x00\xff', self._cache.Get('foo'))
+
+  def testRemove(self):
+    '''Test the twitterapi._SqliteCache.Remove method'''
+    self._cache.Set('foo', 'Hello World!')
+    self._cache.Remove('foo')
+    self.assertEqual(None, self._cache.Get('foo'))
+    self.assertEqual(None, self._cache.GetCachedTime('foo'))
+
+  def testGetCachedTime(self):
+    '''Test the twitterapi._SqliteCache.GetCachedTime and Touch methods'''
+    now = time.time()
+    self._cache.Set('foo', 'Hello World!')
+    self.assert_(abs(self._cache.GetCachedTime('foo') - now) <= 1)
+    self._cache.Touch('foo')
+    self.assert_(self._cache.GetCachedTime('foo') >= now)
+
+  def testShared(self):
+    '''Test that entries are visible to other connections to the file'''
+    self._cache.Set('foo', 'Hello World!')
+    other = twitterapi._SqliteCache(os.path.join(self._directory,
+                                                 'cache.sqlite'))
+    self.assertEqual('Hello World!', other.Get('foo'))
+    other.Close()
+
+  def testApi(self):
+    '''Test that an Api can cache responses in a twitterapi._SqliteCache'''
+    urllib = MockUrllib()
+    api = twitterapi.Api(username='test', password='test')
+    api.SetCache(self._cache)
+    api.SetUrllib(urllib)
+    url = 'http://twitter.com/statuses/public_timeline.json'
+    urllib.AddHandler(url, lambda: _OpenTestData('public_timeline.json'))
+    statuses = api.GetPublicTimeline()
+    urllib.AddHandler(url, lambda: self.fail('response was not cached'))
+    self.assertEqual(statuses, api.GetPublicTimeline())
+
+class CacheStatsTest(unittest.TestCase):
+
+  def testAdd(self):
+    '''Test the twitterapi.CacheStats Add and Get methods'''
+    stats = twitterapi.CacheStats()
+    stats.Add('hits')
+    stats.Add('hits', endpoint='users/show')
+    stats.Add('bytes_read', 10, endpoint='users/show')
+    self.assertEqual(2, stats.Get('hits'))
+    self.assertEqual(1, stats.Get('hits', endpoint='users/show'))
+    self.assertEqual(10, stats.Get('bytes_read'))
+    self.assertEqual(0, stats.Get('misses', endpoint='statuses/show'))
+
+  def testIoTime(self):
+    '''Test that cache I/O times are summed and counted in a histogram'''
+    stats = twitterapi.CacheStats()
+    stats.AddIoTime(0.00005, endpoint='users/show')
+    stats.AddIoTime(0.005)
+    stats.AddIoTime(5)
+    snapshot = stats.GetSnapshot()
+    self.assertEqual([1, 0, 1, 0, 0, 1], snapshot['total']['io_time_histogram'])
+    self.assertEqual([1, 0, 0, 0, 0, 0],
+                     snapshot['endpoints']['users/show']['io_time_histogram'])
+    self.assertAlmostEqual(5.00505, stats.Get('io_time'))
+
+  def testReset(self):
+    '''Test that snapshots are copies and that Reset clears the counters'''
+    stats = twitterapi.CacheStats()
+    stats.Add('sets', endpoint='users/show')
+    snapshot = stats.GetSnapshot()
+    stats.Reset()
+    self.assertEqual(1, snapshot['total']['sets'])
+    self.assertEqual(0, stats.Get('sets'))
+    self.assertEqual({}, stats.GetSnapshot()['endpoints'])
+
+class ObjectCacheTest(unittest.TestCase):
+
+  def testGetAndSet(self):
+    '''Test the twitterapi._ObjectCache Get, Set and Remove methods'''
+    cache = twitterapi._ObjectCache()
+    value = object()
+    cache.Set('foo', value)
+    self.assert_(cache.Get('foo') is value)
+    cache.Remove('foo')
+    self.assertEqual(None, cache.Get('foo'))
+
+  def testMaxEntries(self):
+    '''Test that the least recently used entries are evicted first'''
+    cache = twitterapi._ObjectCache(max_entries=2)
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    cache.Get('a')
+    cache.Set('c', 3)
+    self.assertEqual(1, cache.Get('a'))
+    self.assertEqual(None, cache.Get('b'))
+    self.assertEqual(3, cache.Get('c'))
+    self.assertEqual(2, cache.GetSize())
+
+class MemoryCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._backing_cache = CountingCache()
+
+  def testGetAndSet(self):
+    '''Test the twitterapi._MemoryCache Get and Set methods'''
+    cache = twitterapi._MemoryCache(self._backing_cache)
+    cache.Set('foo', 'Hello World!')
+    self.assertEqual('Hello World!', self._backing_cache.Get('foo'))
+    self._backing_cache.calls = 0
+    self.assertEqual('Hello World!', cache.Get('foo'))
+    self.assert_(cache.GetCachedTime('foo') <= time.time())
+    self.assertEqual(0, self._backing_cache.calls)
+    cache.Remove('foo')
+    self.assertEqual(None, cache.Get('foo'))
+    self.assertEqual(None, self._backing_cache.Get('foo'))
+
+  def testPromote(self):
+    '''Test that backing cache hits are copied into memory'''
+    self._backing_cache.Set('foo', 'Hello World!')
+    cache = twitterapi._MemoryCache(self._backing_cache)
+    cached_time = cache.GetCachedTime('foo')
+    self.assertEqual(self._backing_cache.GetCachedTime('foo'), cached_time)
+    self._backing_cache.calls = 0
+    self.assertEqual(cached_time, cache.GetCachedTime('foo'))
+    self.assertEqual('Hello World!', cache.Get('foo'))
+    self.assertEqual(0, self._backing_cache.calls)
+
+  def testMaxEntries(self):
+    '''Test that the least recently used entries are evicted first'''
+    cache = twitterapi._MemoryCache(max_entries=2)
+    cache.Set('a', '1')
+    cache.Set('b', '2')
+    cache.Get('a')
+    cache.Set('c', '3')
+    self.assertEqual('1', cache.Get('a'))
+    self.assertEqual(None, cache.Get('b'))
+    self.assertEqual('3', cache.Get('c'))
+    self.assertEqual((2, 2), cache.GetSize())
+    self.assertEqual(1, cache.GetStats().Get('evictions'))
+
+  def testMaxBytes(self):
+    '''Test that the total size of the entries is bounded'''
+    cache = twitterapi._MemoryCache(self._backing_cache, max_bytes=10)
+    cache.Set('a', '12345')
+    cache.Set('b', '123456')
+    cache.Set('c', 'x' * 11)
+    self.assertEqual((1, 6), cache.GetSize())
+    # Evicted entries are still in the backing cache
+    self.assertEqual('12345', cache.Get('a'))
+    self.assertEqual('x' * 11, cache.Get('c'))
+
+  def testTtl(self):
+    '''Test that entries older than the ttl are not served from memory'''
+    cache = twitterapi._MemoryCache(self._backing_cache, ttl=-1)
+    cache.Set('foo', 'Hello World!')
+    self.assertEqual((1, 12), cache.GetSize())
+    self.assertEqual('Hello World!', cache.Get('foo'))
+    self.assertEqual((0, 0), cache.GetSize())
+    self.assertEqual(1, cache.GetStats().Get('evictions'))
+
+class JsonCodecTest(unittest.TestCase):
+
+  def testStandardLibrary(self):
+    '''Test a twitterapi.JsonCodec using the json module'''
+    codec = twitterapi.JsonCodec(decoder='json', encoder='json')
+    self.assertEqual({'id': 1}, codec.Decode('{"id": 1}'))
+    self.assertEqual('{"a": 2, "b": 1}', codec.Encode({'b': 1, 'a': 2},
+                                                      sort_keys=True))
+    self.assertEqual(({'id': 1}, 10), codec.RawDecode('[{"id": 1}]', 1))
+
+  def testDefault(self):
+    '''Test that the default twitterapi.JsonCodec picks an installed library'''
+    codec = twitterapi.JsonCodec()
+    self.assert_(codec.decoder in twitterapi.JsonCodec.DECODERS)
+    self.assert_(codec.encoder in twitterapi.JsonCodec.ENCODERS)
+
+  def testMissingLibrary(self):
+    '''Test that asking for a library that is not installed fails'''
+    self.assertRaises(ImportError, twitterapi.JsonCodec, 'no_such_json')
+
+  def testApiCodec(self):
+    '''Test the twitterapi.Api SetJsonCodec method'''
+    urllib = MockUrllib()
+    urllib.AddHandler('http://twitter.com/users/show/dewitt.json',
+                      curry(_OpenTestData, 'show-dewitt.json'))
+    api = twitterapi.Api()
+    api.SetCache(NullCache())
+    api.SetUrllib(urllib)
+    api.SetJsonCodec(twitterapi.JsonCodec(decoder='json', encoder='json'))
+    self.assertEqual(u'dewitt', api.GetUser('dewitt').screen_name)
+
+class IterJsonArrayTest(unittest.TestCase):
+
+  def _Iter(self, json, chunk_size):
+    return list(twitterapi._IterJsonArray(StringIO.StringIO(json), chunk_size))
+
+  def testSmallChunks(self):
+    '''Test that elements split across reads are decoded'''
+    json = _OpenTestData('public_timeline.json').read()
+    expected = simplejson.loads(json)
+    self.assertEqual(expected, self._Iter(json, 7))
+    self.assertEqual(expected, self._Iter(json, 1 << 20))
+
+  def testScalars(self):
+    '''Test that numbers at a chunk boundary are not cut short'''
+    self.assertEqual([1, 22, 333, u'x'], self._Iter(' [1, 22,333 ,"x"] ', 1))
+    self.assertEqual([], self._Iter('[]', 1))
+
+  def testStringsAcrossChunks(self):
+    '''Test that quotes, brackets and escapes inside strings are skipped'''
+    expected = [{'a': 'x\\"}]{['}, ['b\\', ']"'], '[\\"]', {'c': {}}, '"\\']
+    json = simplejson.dumps(expected)
+    for chunk_size in range(1, len(json) + 1):
+      self.assertEqual(expected, self._Iter(json, chunk_size))
+
+  def testLargeElementDecodedOnce(self):
+    '''Test that an element spanning many chunks is decoded once'''
+    class CountingCodec(twitterapi.JsonCodec):
+      calls = 0
+      def Decode(self, data):
+        CountingCodec.calls += 1
+        return twitterapi.JsonCodec.Decode(self, data)
+      def RawDecode(self, data, pos=0):
+        CountingCodec.calls += 1
+        return twitterapi.JsonCodec.RawDecode(self, data, pos)
+    json = '[{"text": "%s", "ids": [%s]}]' % (
+        'x' * 5000, ', '.join([str(i) for i in range(1000)]))
+    elements = list(twitterapi._IterJsonArray(StringIO.StringIO(json), 16,
+                                              CountingCodec()))
+    self.assertEqual(simplejson.loads(json), elements)
+    self.assertEqual(1, CountingCodec.calls)
+
+  def testUsesDecoder(self):
+    '''Test that streamed elements are decoded by the codec's decoder'''
+    json = '[{"text": "Hello"}, "World", 1]'
+    codec = twitterapi.JsonCodec(decoder='json', encoder='simplejson')
+    elements = list(twitterapi._IterJsonArray(StringIO.StringIO(json), 4,
+                                              codec))
+    self.assertEqual([{'text': 'Hello'}, 'World', 1], elements)
+    self.assert_(isinstance(elements[0]['text'], unicode))
+    self.assert_(isinstance(elements[1], unicode))
+
+  def testInvalid(self):
+    '''Test that truncated documents and non-arrays raise ValueError'''
+    self.assertRaises(ValueError, self._Iter, '[{"id": 1}, {"id"', 4)
+    self.assertRaises(ValueError, self._Iter, '[1, 2', 4)
+    self.assertRaises(ValueError, self._Iter, '{"id": 1}', 4)
+
+class KeepAliveTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = LocalHTTPServer()
+    self._urllib = twitterapi._KeepAliveUrllib()
+
+  def tearDown(self):
+    self._urllib.Close()
+    self._server.Stop()
+
+  def testReusesConnection(self):
+    '''Test that twitterapi._KeepAliveUrllib reuses a single connection'''
+    for i in range(3):
+      body = self._urllib.build_opener().open(self._server.url).read()
+      self.assertEqual('Hello World!', body)
+    stats = self._urllib.GetStats()
+    self.assertEqual(1, stats['created'])
+    self.assertEqual(2, stats['reused'])
+    self.assertEqual(1, stats['idle'])
+    self.assertEqual(0, stats['active'])
+
+  def testIdleTimeout(self):
+    '''Test that idle connections are not reused after idle_timeout'''
+    self._urllib = twitterapi._KeepAliveUrllib(
+        twitterapi._ConnectionPool(idle_timeout=-1))
+    for i in range(2):
+      self._urllib.build_opener().open(self._server.url).read()
+    stats = self._urllib.GetStats()
+    self.assertEqual(2, stats['created'])
+    self.assertEqual(0, stats['reused'])
+    self.assertEqual(1, stats['expired'])
+
+  def testPostNotResent(self):
+    '''Test that a POST sent in full on a reused connection is not resent'''
+    self._urllib.build_opener().open(self._server.url).read()
+    opener = self._urllib.build_opener()
+    self.assertRaises(urllib2.URLError, opener.open, self._server.url, 'a=1')
+    self.assertEqual(['a=1'], self._server.posts)
+
+  def testWaitTimeout(self):
+    '''Test that a full pool hands out an unpooled connection in the end'''
+    self._urllib = twitterapi._KeepAliveUrllib(
+        twitterapi._ConnectionPool(max_per_host=1, wait_timeout=0.1))
+    leaked = self._urllib.build_opener().open(self._server.url)
+    body = self._urllib.build_opener().open(self._server.url).read()
+    self.assertEqual('Hello World!', body)
+    stats = self._urllib.GetStats()
+    self.assertEqual(1, stats['unpooled'])
+    self.assertEqual(1, stats['active'])
+    leaked.close()
+    self.assertEqual(0, self._urllib.GetStats()['active'])
+
+  def testErrorsReleaseConnections(self):
+    '''Test that kept HTTPErrors do not hold on to pooled connections'''
+    self._urllib = twitterapi._KeepAliveUrllib(
+        twitterapi._ConnectionPool(wait_timeout=5))
+    errors = []
+    for i in range(twitterapi._ConnectionPool.DEFAULT_MAX_PER_HOST):
+      try:
+        self._urllib.build_opener().open(self._server.url + 'missing')
+      except urllib2.HTTPError, e:
+        errors.append(e)
+    self.assertEqual(4, len(errors))
+    self.assertEqual('Not found', errors[0].read())
+    stats = self._urllib.GetStats()
+    self.assertEqual(0, stats['active'])
+    self.assertEqual(1, stats['idle'])
+    start = time.time()
+    body = self._urllib.build_opener().open(self._server.url).read()
+    self.assertEqual('Hello World!', body)
+    self.assert_(time.time() - start < 1)
+    self.assertEqual(4, self._urllib.GetStats()['reused'])
+
+  def testPartialReadDiscardsConnection(self):
+    '''Test that a response closed before it was read is not reused'''
+    response = self._urllib.build_opener().open(self._server.url)
+    response.read(5)
+    response.close()
+    stats = self._urllib.GetStats()
+    self.assertEqual(1, stats['discarded'])
+    self.assertEqual(0, stats['idle'])
+
 class ApiTest(unittest.TestCase):
 
   def setUp(self):
@@ -335,6 +1309,26 @@ class ApiTest(unittest.TestCase):
     self.assertEqual(20, len(statuses))
     self.assertEqual(718443, statuses[0].user.id)
 
+  def testIterUserTimeline(self):
+    '''Test the twitterapi.Api IterUserTimeline method'''
+    self._AddHandler('http://twitter.com/statuses/user_timeline/kesuke.json?count=1',
+                     curry(self._OpenTestData, 'user_timeline-kesuke.json'))
+    statuses = self._api.IterUserTimeline('kesuke', count=1)
+    status = statuses.next()
+    self.assertEqual(89512102, status.id)
+    self.assertEqual(718443, status.user.id)
+
+  def testIterFollowersFromCache(self):
+    '''Test that iterators read fresh cache entries'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    url = 'http://twitter.com/statuses/followers.json'
+    self._AddHandler(url, curry(self._OpenTestData, 'followers.json'))
+    users = self._api.GetFollowers()
+    self._AddHandler(url, None)
+    self.assertEqual(users, list(self._api.IterFollowers()))
+    cache.Remove('test:' + url)
+
   def testGetStatus(self):
     '''Test the twitterapi.Api GetStatus method'''
     self._AddHandler('http://twitter.com/statuses/show/89512102.json',
@@ -350,6 +1344,19 @@ class ApiTest(unittest.TestCase):
     status = self._api.DestroyStatus(103208352)
     self.assertEqual(103208352, status.id)
 
+  def testDestroyStatusIsNotCached(self):
+    '''Test that writes with no post data are POSTed and never cached'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    url = 'http://twitter.com/statuses/destroy/103208352.json'
+    def Destroy(data):
+      self.assertEqual('', data)
+      return self._OpenTestData('status-destroy.json')
+    self._AddHandler(url, Destroy)
+    self._urllib.SetPassData(True)
+    self._api.DestroyStatus(103208352)
+    self.assertEqual(None, cache.Get('test:' + url))
+
   def testPostUpdate(self):
     '''Test the twitterapi.Api PostUpdate method'''
     self._AddHandler('http://twitter.com/statuses/update.json',
@@ -438,6 +1445,411 @@ class ApiTest(unittest.TestCase):
     self.assertEqual('dewitt', user.screen_name)
     self.assertEqual(89586072, user.status.id)
 
+  def testGetUsers(self):
+    '''Test the twitterapi.Api GetUsers method'''
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     curry(self._OpenTestData, 'show-dewitt.json'))
+    self._AddHandler('http://twitter.com/users/show/673483.json',
+                     curry(self._OpenTestData, 'show-dewitt.json'))
+    users = self._api.GetUsers(['dewitt', 'nobody', 673483])
+    self.assertEqual(3, len(users))
+    self.assertEqual('dewitt', users[0].screen_name)
+    self.assert_(isinstance(users[1], Exception))
+    self.assertEqual(673483, users[2].id)
+
+  def testGetUsersReleasesConnections(self):
+    '''Test that users that are not found do not use up pooled connections'''
+    data = open(_GetTestDataPath('show-dewitt.json')).read()
+    server = LocalHTTPServer(data)
+    # Send every request to the local server, as to a proxy
+    class ProxyUrllib(twitterapi._KeepAliveUrllib):
+      def build_opener(self, *handlers):
+        proxy = urllib2.ProxyHandler({'http': server.url})
+        return twitterapi._KeepAliveUrllib.build_opener(self, proxy, *handlers)
+    urllib = ProxyUrllib(twitterapi._ConnectionPool(wait_timeout=5))
+    self._api.SetUrllib(urllib)
+    try:
+      ids = ['missing%d' % i for i in range(6)] + ['dewitt']
+      users = self._api.GetUsers(ids, max_workers=1)
+      for error in users[:-1]:
+        self.assert_(isinstance(error, urllib2.HTTPError))
+      self.assertEqual('Not found', users[0].read())
+      self.assertEqual('dewitt', users[-1].screen_name)
+      self.assertEqual(0, urllib.GetStats()['active'])
+      start = time.time()
+      self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+      self.assert_(time.time() - start < 1)
+      self.assertEqual(0, urllib.GetStats()['unpooled'])
+    finally:
+      urllib.Close()
+      server.Stop()
+
+  def testGetUsersDetachesErrors(self):
+    '''Test that GetUsers reads and closes the responses of its errors'''
+    url = 'http://twitter.com/users/show/nobody.json'
+    response = ClosingResponse('Not found')
+    def Fail():
+      raise urllib2.HTTPError(url, 404, 'Not Found', {}, response)
+    self._AddHandler(url, Fail)
+    error = self._api.GetUsers(['nobody'])[0]
+    self.assert_(response.closed)
+    self.assertEqual(404, error.code)
+    self.assertEqual('Not found', error.read())
+
+  def testGetStatuses(self):
+    '''Test the twitterapi.Api GetStatuses method'''
+    self._AddHandler('http://twitter.com/statuses/show/89512102.json',
+                     curry(self._OpenTestData, 'show-89512102.json'))
+    statuses = self._api.GetStatuses([89512102, 'bogus'])
+    self.assertEqual(89512102, statuses[0].id)
+    self.assert_(isinstance(statuses[1], twitterapi.TwitterError))
+    self.assertEqual([], self._api.GetStatuses([]))
+
+  def testCoalescesConcurrentFetches(self):
+    '''Test that concurrent requests for one URL share a single fetch'''
+    url = 'http://twitter.com/statuses/public_timeline.json'
+    release = threading.Event()
+    calls = []
+    def Fetch():
+      calls.append(url)
+      release.wait(10)
+      return self._OpenTestData('public_timeline.json')
+    self._AddHandler(url, Fetch)
+    results = []
+    threads = [threading.Thread(
+                   target=lambda: results.append(self._api.GetPublicTimeline()))
+               for i in range(5)]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+      thread.join(10)
+    self.assertEqual(1, len(calls))
+    self.assertEqual(5, len(results))
+    self.assertEqual(89497702, results[4][0].id)
+
+  def testGzipResponse(self):
+    '''Test that the twitterapi.Api decompresses gzip encoded responses'''
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     curry(self._OpenEncodedTestData, 'show-dewitt.json', 'gzip'))
+    user = self._api.GetUser('dewitt')
+    self.assertEqual('dewitt', user.screen_name)
+
+  def testDeflateResponse(self):
+    '''Test that the twitterapi.Api decompresses deflate encoded responses'''
+    self._AddHandler('http://twitter.com/statuses/public_timeline.json',
+                     curry(self._OpenEncodedTestData, 'public_timeline.json',
+                           'deflate'))
+    statuses = self._api.GetPublicTimeline()
+    self.assertEqual(89497702, statuses[0].id)
+
+  def testAcceptEncoding(self):
+    '''Test that the twitterapi.Api asks for compressed responses'''
+    url = 'http://twitter.com/statuses/public_timeline.json'
+    opener = self._api._GetOpener(url)
+    self.assert_(('Accept-Encoding', 'gzip, deflate') in opener.addheaders)
+    self._api.SetCompression(False)
+    opener = self._api._GetOpener(url)
+    self.assertEqual([], [h for h in opener.addheaders
+                          if h[0] == 'Accept-Encoding'])
+
+  def testCacheCompressed(self):
+    '''Test that gzip responses can be cached without being decoded'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    self._api.SetCacheCompressed(True)
+    url = 'http://twitter.com/users/show/dewitt.json'
+    self._AddHandler(url, curry(self._OpenEncodedTestData, 'show-dewitt.json',
+                                'gzip'))
+    self._api.GetUser('dewitt')
+    self.assert_(cache.Get('test:' + url).startswith('\x1f\x8b'))
+    self._AddHandler(url, None)
+    user = self._api.GetUser('dewitt')
+    self.assertEqual('dewitt', user.screen_name)
+    cache.Remove('test:' + url)
+
+  def testConditionalRevalidation(self):
+    '''Test that an expired entry is revalidated with its ETag'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    url = 'http://twitter.com/users/show/dewitt.json'
+    key = 'test:' + url
+    data = open(self._GetTestDataPath('show-dewitt.json')).read()
+    self._AddHandler(url, lambda: MockResponse(data, {'ETag': '"v1"'}))
+    self._api.GetUser('dewitt')
+    # Age the entry past the cache timeout
+    an_hour_ago = time.time() - 3600
+    os.utime(cache._GetPath(key), (an_hour_ago, an_hour_ago))
+    def NotModified():
+      self.assert_(('If-None-Match', '"v1"') in self._urllib.opener.addheaders)
+      raise urllib2.HTTPError(url, 304, 'Not Modified', {}, None)
+    self._AddHandler(url, NotModified)
+    user = self._api.GetUser('dewitt')
+    self.assertEqual('dewitt', user.screen_name)
+    self.assert_(cache.GetCachedTime(key) > time.time() - 60)
+    cache.Remove(key)
+    cache.Remove(key + '#validators')
+
+  def testObjectCache(self):
+    '''Test that models are reused while their cache entry is unchanged'''
+    cache = twitterapi._MemoryCache()
+    self._api.SetCache(cache)
+    self._api.SetObjectCache(twitterapi._ObjectCache())
+    url = 'http://twitter.com/statuses/public_timeline.json'
+    self._AddHandler(url, curry(self._OpenTestData, 'public_timeline.json'))
+    statuses = self._api.GetPublicTimeline()
+    self._AddHandler(url, lambda: self.fail('response was not cached'))
+    cached_statuses = self._api.GetPublicTimeline()
+    self.assert_(statuses is not cached_statuses)
+    self.assert_(statuses[0] is cached_statuses[0])
+    # Changing the underlying entry invalidates the models
+    cache.Set('test:' + url, '[]')
+    self.assertEqual([], self._api.GetPublicTimeline())
+
+  def testCachePolicy(self):
+    '''Test that each endpoint is cached for its own timeout'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    self._api.GetCachePolicy().SetDefaultTimeout(30)
+    user_url = 'http://twitter.com/users/show/dewitt.json'
+    self._AddHandler(user_url, curry(self._OpenTestData, 'show-dewitt.json'))
+    self._api.GetUser('dewitt')
+    timeline_url = 'http://twitter.com/statuses/public_timeline.json'
+    self._AddHandler(timeline_url,
+                     curry(self._OpenTestData, 'public_timeline.json'))
+    self._api.GetPublicTimeline()
+    # Age both entries past the default timeout, but not the profile's
+    ten_minutes_ago = time.time() - 600
+    for url in (user_url, timeline_url):
+      os.utime(cache._GetPath('test:' + url), (ten_minutes_ago, ten_minutes_ago))
+    calls = []
+    self._AddHandler(user_url, lambda: self.fail('profile was not cached'))
+    self._AddHandler(timeline_url, lambda: calls.append(timeline_url) or
+                     self._OpenTestData('public_timeline.json'))
+    self._api.GetUser('dewitt')
+    self._api.GetPublicTimeline()
+    self.assertEqual(1, len(calls))
+    policy = self._api.GetCachePolicy()
+    self.assertEqual(30, policy.GetTimeout(timeline_url))
+    self.assertEqual(3600, policy.GetTimeout(user_url))
+    self.assertEqual(twitterapi.CachePolicy.NEVER, policy.GetTimeout(
+        'http://twitter.com/statuses/destroy/1.json'))
+    cache.Remove('test:' + user_url)
+    cache.Remove('test:' + timeline_url)
+
+  def testSetCacheTimeout(self):
+    '''Test that SetCacheTimeout overrides the per-endpoint timeouts'''
+    user_url = 'http://twitter.com/users/show/dewitt.json'
+    destroy_url = 'http://twitter.com/statuses/destroy/1.json'
+    policy = self._api.GetCachePolicy()
+    self.assertEqual(60, policy.GetDefaultTimeout())
+    self._api.SetCacheTimeout(30)
+    self.assertEqual(30, policy.GetTimeout(user_url))
+    self.assertEqual(twitterapi.CachePolicy.NEVER, policy.GetTimeout(destroy_url))
+    self._api.SetCacheTimeout(0)
+    self.assertEqual(0, policy.GetTimeout(user_url))
+    self.assertEqual(0, policy.GetTimeout(
+        'http://twitter.com/statuses/featured.json'))
+    # Caching is off, so every call fetches the profile
+    calls = []
+    self._api.SetCache(twitterapi._MemoryCache())
+    self._AddHandler(user_url, lambda: calls.append(user_url) or
+                     self._OpenTestData('show-dewitt.json'))
+    self._api.GetUser('dewitt')
+    self._api.GetUser('dewitt')
+    self.assertEqual(2, len(calls))
+
+  def testCanonicalCacheKeys(self):
+    '''Test that cache keys don't depend on the order of parameters'''
+    self.assertEqual(
+        self._api._GetCacheKey('http://twitter.com/a.json?b=2&a=1'),
+        self._api._GetCacheKey('http://Twitter.com/a.json?a=1&b=%32'))
+    self.assertNotEqual(
+        self._api._GetCacheKey('http://twitter.com/a.json?a=1&b=2'),
+        self._api._GetCacheKey('http://twitter.com/a.json?a=2&b=1'))
+
+  def testCompactModels(self):
+    '''Test that the twitterapi.Api can return compact models'''
+    self._api.SetCompactModels(True)
+    self._AddHandler('http://twitter.com/statuses/public_timeline.json',
+                     curry(self._OpenTestData, 'public_timeline.json'))
+    statuses = self._api.GetPublicTimeline()
+    self.assert_(isinstance(statuses[0], twitterapi.CompactStatus))
+    self.assert_(isinstance(statuses[0].user, twitterapi.CompactUser))
+    self.assertEqual(89497702, statuses[0].id)
+
+  def testLazyModels(self):
+    '''Test that the twitterapi.Api can return lazy models'''
+    self._api.SetLazyModels(True)
+    self._AddHandler('http://twitter.com/statuses/public_timeline.json',
+                     curry(self._OpenTestData, 'public_timeline.json'))
+    statuses = self._api.GetPublicTimeline()
+    self.assert_(isinstance(statuses[0], twitterapi.LazyStatus))
+    self.assert_(isinstance(statuses[0].user, twitterapi.LazyUser))
+    self.assertEqual(89497702, statuses[0].id)
+
+  def testTimelineFrame(self):
+    '''Test that the twitterapi.Api can return a TimelineFrame'''
+    self._AddHandler('http://twitter.com/statuses/public_timeline.json',
+                     curry(self._OpenTestData, 'public_timeline.json'))
+    frame = self._api.GetPublicTimelineFrame()
+    self.assert_(isinstance(frame, twitterapi.TimelineFrame))
+    self.assertEqual(20, len(frame))
+    self.assertEqual(89497702, frame.ids[0])
+    self.assertEqual(self._api.GetPublicTimeline(), list(frame))
+    self._api.SetCompactModels(True)
+    frame = self._api.GetPublicTimelineFrame()
+    self.assert_(isinstance(frame[0], twitterapi.CompactStatus))
+
+  def testUnreadableCacheEntry(self):
+    '''Test that the twitterapi.Api refetches an unreadable cache entry'''
+    directory = tempfile.mkdtemp()
+    try:
+      cache = twitterapi._FileCache(directory, compress='zlib')
+      self._api.SetCache(cache)
+      url = 'http://twitter.com/statuses/public_timeline.json'
+      self._AddHandler(url, curry(self._OpenTestData, 'public_timeline.json'))
+      self._api.GetPublicTimeline()
+      fp = open(cache._GetPath('test:' + url), 'wb')
+      fp.write('\x00zcorrupt')
+      fp.close()
+      self.assertEqual(20, len(self._api.GetPublicTimeline()))
+      self.assertEqual(2, self._api.GetCacheStats().Get('sets'))
+    finally:
+      shutil.rmtree(directory)
+
+  def testCorruptGzipCacheEntry(self):
+    '''Test that the twitterapi.Api refetches a corrupt gzipped cache entry'''
+    cache = twitterapi._MemoryCache()
+    self._api.SetCache(cache)
+    url = 'http://twitter.com/statuses/public_timeline.json'
+    key = 'test:' + url
+    self._AddHandler(url, curry(self._OpenTestData, 'public_timeline.json'))
+    cache.Set(key, twitterapi._GZIP_MAGIC + 'garbage')
+    cache.Set(key + '#validators', '{"ETag": "\\"1\\""}')
+    self.assertEqual(None,
+                     self._api._ReadCache(key, 'statuses/public_timeline'))
+    self.assertEqual(None, cache.Get(key))
+    self.assertEqual(None, cache.Get(key + '#validators'))
+    cache.Set(key, twitterapi._GZIP_MAGIC + 'garbage')
+    self.assertEqual(20, len(self._api.GetPublicTimeline()))
+    self.assertEqual(20, len(self._api.GetPublicTimeline()))
+
+  def testCacheStats(self):
+    '''Test that the twitterapi.Api counts cache hits and misses'''
+    self._api.SetCache(twitterapi._MemoryCache())
+    url = 'http://twitter.com/users/show/dewitt.json'
+    self._AddHandler(url, curry(self._OpenTestData, 'show-dewitt.json'))
+    self._api.GetUser('dewitt')
+    self._api.GetUser('dewitt')
+    self._api.GetUser('dewitt')
+    stats = self._api.GetCacheStats()
+    self.assertEqual(2, stats.Get('hits', endpoint='users/show'))
+    self.assertEqual(1, stats.Get('misses', endpoint='users/show'))
+    self.assertEqual(1, stats.Get('sets'))
+    size = len(self._OpenTestData('show-dewitt.json').read())
+    self.assertEqual(size, stats.Get('bytes_written'))
+    self.assertEqual(2 * size, stats.Get('bytes_read'))
+    snapshot = stats.GetSnapshot(reset=True)
+    self.assertEqual(['users/show'], snapshot['endpoints'].keys())
+    self.assertEqual(2, snapshot['total']['hits'])
+    self.assert_(sum(snapshot['total']['io_time_histogram']) >= 3)
+    self.assertEqual(0, stats.Get('hits'))
+
+  def testPrefetch(self):
+    '''Test that Prefetch fills the cache in the background'''
+    self._api.SetCache(twitterapi._MemoryCache())
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     curry(self._OpenTestData, 'show-dewitt.json'))
+    self._AddHandler('http://twitter.com/statuses/user_timeline/kesuke.json?count=1',
+                     curry(self._OpenTestData, 'user_timeline-kesuke.json'))
+    futures = self._api.Prefetch([('GetUser', ('dewitt',)),
+                                  ('GetUserTimeline', ('kesuke',), {'count': 1})])
+    self.assertEqual('dewitt', futures[0].Result(timeout=10).screen_name)
+    self.assertEqual(1, len(futures[1].Result(timeout=10)))
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     lambda: self.fail('user was not prefetched'))
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    self.assertRaises(twitterapi.TwitterError, self._api.Prefetch,
+                      [('PostUpdate', ('Hello',))])
+
+  def testPrefetchLeavesReserve(self):
+    '''Test that Prefetch never waits for, or uses up, the rate limit'''
+    governor = twitterapi.RateGovernor(limits={'users': (2, 3600)})
+    self._api.SetRateGovernor(governor)
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     curry(self._OpenTestData, 'show-dewitt.json'))
+    futures = self._api.Prefetch([('GetUser', ('dewitt',))] * 2, max_workers=1,
+                                 reserve=1)
+    futures[0].Result(timeout=10)
+    self.assert_(isinstance(futures[1].Exception(timeout=10),
+                            twitterapi.TwitterRateLimitError))
+    # The reserved request is left for the foreground
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+
+  def testPrefetchReserveDoesNotFailForeground(self):
+    '''Test that callers joining a declined prefetch fetch on their own'''
+    governor = twitterapi.RateGovernor(limits={'users': (1, 3600)})
+    self._api.SetRateGovernor(governor)
+    entered = threading.Event()
+    proceed = threading.Event()
+    class BlockingCache(twitterapi._MemoryCache):
+      def GetLock(self, key):
+        # Hold the prefetch in flight until the foreground call joins it
+        if not entered.isSet():
+          entered.set()
+          proceed.wait(10)
+        return None
+    self._api.SetCache(BlockingCache())
+    self._AddHandler('http://twitter.com/users/show/dewitt.json',
+                     curry(self._OpenTestData, 'show-dewitt.json'))
+    futures = self._api.Prefetch([('GetUser', ('dewitt',))], reserve=1)
+    entered.wait(10)
+    results = []
+    foreground = threading.Thread(
+        target=lambda: results.append(self._api.GetUser('dewitt')))
+    foreground.start()
+    time.sleep(0.2)
+    proceed.set()
+    foreground.join(10)
+    self.assert_(isinstance(futures[0].Exception(timeout=10),
+                            twitterapi.TwitterRateLimitError))
+    self.assertEqual('dewitt', results[0].screen_name)
+
+  def testStaleWhileRevalidate(self):
+    '''Test that stale entries are served while they are refreshed'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    executor = DeferredExecutor()
+    self._api.SetCache(cache)
+    self._api.SetStaleWhileRevalidate(600, executor=executor)
+    self._api.GetCachePolicy().SetTimeout('users/show', None)
+    url = 'http://twitter.com/users/show/dewitt.json'
+    key = 'test:' + url
+    calls = []
+    def Fetch():
+      calls.append(url)
+      return self._OpenTestData('show-dewitt.json')
+    self._AddHandler(url, Fetch)
+    self._api.GetUser('dewitt')
+    two_minutes_ago = time.time() - 120
+    os.utime(cache._GetPath(key), (two_minutes_ago, two_minutes_ago))
+    # Both callers get the stale entry, and only one refresh is scheduled
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    self.assertEqual(1, len(calls))
+    self.assertEqual(1, len(executor.calls))
+    executor.RunAll()
+    self.assertEqual(2, len(calls))
+    self.assert_(cache.GetCachedTime(key) > time.time() - 60)
+    # Past the window, the caller waits for the refresh
+    an_hour_ago = time.time() - 3600
+    os.utime(cache._GetPath(key), (an_hour_ago, an_hour_ago))
+    self._api.GetUser('dewitt')
+    self.assertEqual(3, len(calls))
+    self.assertEqual(0, len(executor.calls))
+    cache.Remove(key)
+
   def _AddHandler(self, url, callback):
     self._urllib.AddHandler(url, callback)
 
@@ -449,6 +1861,296 @@ class ApiTest(unittest.TestCase):
   def _OpenTestData(self, filename):
     return open(self._GetTestDataPath(filename))
 
+  def _OpenEncodedTestData(self, filename, encoding):
+    data = open(self._GetTestDataPath(filename)).read()
+    if encoding == 'gzip':
+      buffer = StringIO.StringIO()
+      gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb')
+      gzip_file.write(data)
+      gzip_file.close()
+      data = buffer.getvalue()
+    else:
+      # A raw deflate stream, without the zlib header and checksum
+      data = zlib.compress(data)[2:-4]
+    return MockResponse(data, {'Content-Encoding': encoding})
+
+class RateGovernorTest(unittest.TestCase):
+
+  def setUp(self):
+    self._urllib = MockUrllib()
+    self._urllib.AddHandler('http://twitter.com/users/show/dewitt.json',
+                            curry(_OpenTestData, 'show-dewitt.json'))
+    api = twitterapi.Api(username='test', password='test')
+    api.SetCache(NullCache())
+    api.SetUrllib(self._urllib)
+    self._api = api
+
+  def testGetFamily(self):
+    '''Test the twitterapi.RateGovernor GetFamily method'''
+    governor = twitterapi.RateGovernor()
+    self.assertEqual('timelines', governor.GetFamily(
+        'http://twitter.com/statuses/user_timeline/kesuke.json?count=1'))
+    self.assertEqual('users', governor.GetFamily(
+        'http://twitter.com/users/show/dewitt.json'))
+    self.assertEqual('direct_messages', governor.GetFamily(
+        'http://twitter.com/direct_messages.json'))
+    self.assertEqual('writes', governor.GetFamily(
+        'http://twitter.com/statuses/update.json', write=True))
+
+  def testRaise(self):
+    '''Test that RAISE mode raises once the budget is spent'''
+    governor = twitterapi.RateGovernor(limits={'users': (2, 3600)},
+                                       mode=twitterapi.RateGovernor.RAISE)
+    self._api.SetRateGovernor(governor)
+    self._api.GetUser('dewitt')
+    self._api.GetUser('dewitt')
+    self.assertRaises(twitterapi.TwitterRateLimitError,
+                      self._api.GetUser, 'dewitt')
+    budget = self._api.GetRateBudget()['users']
+    self.assertEqual(0, budget['remaining'])
+    self.assert_(budget['next_in'] > 0)
+    # Other accounts have budgets of their own
+    self.assertEqual(2, governor.GetBudget('other', 'users')['remaining'])
+
+  def testBlock(self):
+    '''Test that BLOCK mode waits for the bucket to refill'''
+    governor = twitterapi.RateGovernor(limits={'users': (1, 0.2)})
+    self._api.SetRateGovernor(governor)
+    start = time.time()
+    self._api.GetUser('dewitt')
+    self._api.GetUser('dewitt')
+    self.assert_(time.time() - start >= 0.15)
+    governor.SetMode(twitterapi.RateGovernor.BLOCK, timeout=0)
+    self.assertRaises(twitterapi.TwitterRateLimitError,
+                      self._api.GetUser, 'dewitt')
+
+  def testNonBlockServesStale(self):
+    '''Test that NONBLOCK mode serves expired cache entries when limited'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    governor = twitterapi.RateGovernor(limits={'users': (1, 3600)},
+                                       mode=twitterapi.RateGovernor.NONBLOCK)
+    self._api.SetRateGovernor(governor)
+    self._api.GetUser('dewitt')
+    self._api.GetCachePolicy().SetTimeout('users/show', -1)
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    self.assertRaises(twitterapi.TwitterRateLimitError,
+                      self._api.GetUser, 'kesuke')
+    cache.Remove('test:http://twitter.com/users/show/dewitt.json')
+
+class RetryTest(unittest.TestCase):
+
+  _URL = 'http://twitter.com/users/show/dewitt.json'
+
+  def setUp(self):
+    self._urllib = MockUrllib()
+    self._sleeps = []
+    api = twitterapi.Api(username='test', password='test')
+    api.SetCache(NullCache())
+    api.SetUrllib(self._urllib)
+    api.SetRetryPolicy(twitterapi.RetryPolicy(sleep=self._sleeps.append))
+    self._api = api
+    self._calls = 0
+
+  def _Flaky(self, failures, code=503):
+    self._calls += 1
+    if self._calls <= failures:
+      raise urllib2.HTTPError(self._URL, code, 'Unavailable', {}, None)
+    return _OpenTestData('show-dewitt.json')
+
+  def testRetriesTransientErrors(self):
+    '''Test that GET requests are retried after 5xx responses'''
+    self._urllib.AddHandler(self._URL, curry(self._Flaky, 2))
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    self.assertEqual(3, self._calls)
+    self.assertEqual(2, len(self._sleeps))
+    self.assert_(0 <= self._sleeps[1] <= 1.0)
+
+  def testGivesUp(self):
+    '''Test that retries stop after max_attempts'''
+    self._urllib.AddHandler(self._URL, curry(self._Flaky, 5))
+    self.assertRaises(urllib2.HTTPError, self._api.GetUser, 'dewitt')
+    self.assertEqual(3, self._calls)
+
+  def testDoesNotRetryClientErrors(self):
+    '''Test that 4xx responses are not retried'''
+    self._urllib.AddHandler(self._URL, curry(self._Flaky, 1, 404))
+    self.assertRaises(urllib2.HTTPError, self._api.GetUser, 'dewitt')
+    self.assertEqual(1, self._calls)
+
+  def testGetDelay(self):
+    '''Test the twitterapi.RetryPolicy GetDelay method'''
+    policy = twitterapi.RetryPolicy(max_attempts=5, base_delay=1, max_delay=3,
+                                    max_elapsed=10, jitter=False)
+    self.assertEqual(1, policy.GetDelay(1, 0))
+    self.assertEqual(2, policy.GetDelay(2, 0))
+    self.assertEqual(3, policy.GetDelay(3, 0))
+    self.assertEqual(None, policy.GetDelay(3, 8))
+    self.assertEqual(None, policy.GetDelay(5, 0))
+
+  def testCircuitBreaker(self):
+    '''Test that an open circuit breaker stops requests'''
+    self._api.SetRetryPolicy(None)
+    breaker = twitterapi.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    self._api.SetCircuitBreaker(breaker)
+    self._urllib.AddHandler(self._URL, curry(self._Flaky, 10))
+    self.assertRaises(urllib2.HTTPError, self._api.GetUser, 'dewitt')
+    self.assertRaises(urllib2.HTTPError, self._api.GetUser, 'dewitt')
+    self.assertEqual(twitterapi.CircuitBreaker.OPEN, breaker.GetState())
+    self.assertRaises(twitterapi.TwitterUnavailableError,
+                      self._api.GetUser, 'dewitt')
+    self.assertEqual(2, self._calls)
+
+  def testCircuitBreakerServesStale(self):
+    '''Test that an open circuit breaker serves expired cache entries'''
+    cache = twitterapi._FileCache(tempfile.mkdtemp())
+    self._api.SetCache(cache)
+    self._api.SetRetryPolicy(None)
+    breaker = twitterapi.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    self._api.SetCircuitBreaker(breaker)
+    self._urllib.AddHandler(self._URL, curry(_OpenTestData, 'show-dewitt.json'))
+    self._api.GetUser('dewitt')
+    self._api.GetCachePolicy().SetTimeout('users/show', -1)
+    self._urllib.AddHandler(self._URL, curry(self._Flaky, 10))
+    self.assertRaises(urllib2.HTTPError, self._api.GetUser, 'dewitt')
+    self.assertEqual('dewitt', self._api.GetUser('dewitt').screen_name)
+    cache.Remove('test:' + self._URL)
+
+  def testCircuitBreakerStreams(self):
+    '''Test that streamed requests report to the circuit breaker'''
+    url = 'http://twitter.com/statuses/friends_timeline/kesuke.json'
+    breaker = twitterapi.CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    self._api.SetCircuitBreaker(breaker)
+    self._urllib.AddHandler(url, curry(self._Flaky, 1))
+    self.assertRaises(urllib2.HTTPError, self._api.IterFriendsTimeline,
+                      'kesuke')
+    self.assertEqual(twitterapi.CircuitBreaker.OPEN, breaker.GetState())
+    time.sleep(0.15)
+    # The half open trial succeeds, and closes the breaker
+    self._urllib.AddHandler(
+        url, curry(_OpenTestData, 'friends_timeline-kesuke.json'))
+    self.assertEqual(20, len(list(self._api.IterFriendsTimeline('kesuke'))))
+    self.assertEqual(twitterapi.CircuitBreaker.CLOSED, breaker.GetState())
+
+  def testCircuitBreakerRecovers(self):
+    '''Test that a half open circuit breaker closes after a success'''
+    breaker = twitterapi.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.RecordFailure()
+    self.assertEqual(twitterapi.CircuitBreaker.OPEN, breaker.GetState())
+    self.assert_(breaker.Allow())
+    self.assertEqual(twitterapi.CircuitBreaker.HALF_OPEN, breaker.GetState())
+    breaker.RecordSuccess()
+    self.assertEqual(twitterapi.CircuitBreaker.CLOSED, breaker.GetState())
+
+class AsyncApiTest(unittest.TestCase):
+
+  def setUp(self):
+    self._urllib = MockUrllib()
+    api = twitterapi.AsyncApi(username='test', password='test')
+    api.SetCache(NullCache())
+    api.SetUrllib(self._urllib)
+    self._api = api
+
+  def tearDown(self):
+    self._api.Close()
+
+  def testGetUser(self):
+    '''Test the twitterapi.AsyncApi GetUser method'''
+    self._urllib.AddHandler('http://twitter.com/users/show/dewitt.json',
+                            curry(_OpenTestData, 'show-dewitt.json'))
+    future = self._api.GetUser('dewitt')
+    user = future.Result(timeout=10)
+    self.assert_(future.Done())
+    self.assertEqual('dewitt', user.screen_name)
+
+  def testConcurrentCalls(self):
+    '''Test that twitterapi.AsyncApi calls can be in flight together'''
+    self._urllib.AddHandler('http://twitter.com/users/show/dewitt.json',
+                            curry(_OpenTestData, 'show-dewitt.json'))
+    self._urllib.AddHandler('http://twitter.com/statuses/public_timeline.json',
+                            curry(_OpenTestData, 'public_timeline.json'))
+    user = self._api.GetUser('dewitt')
+    statuses = self._api.GetPublicTimeline()
+    self.assertEqual(20, len(statuses.Result(timeout=10)))
+    self.assertEqual('dewitt', user.Result(timeout=10).screen_name)
+
+  def testException(self):
+    '''Test that errors are raised from twitterapi.Future.Result'''
+    self._api.ClearCredentials()
+    future = self._api.GetReplies()
+    self.assertRaises(twitterapi.TwitterError, future.Result, 10)
+    self.assert_(isinstance(future.Exception(), twitterapi.TwitterError))
+
+  def testExecutor(self):
+    '''Test that the twitterapi.AsyncApi executor can be replaced'''
+    api = twitterapi.AsyncApi(api=self._api.GetApi(), executor=InlineExecutor())
+    self._urllib.AddHandler('http://twitter.com/users/show/dewitt.json',
+                            curry(_OpenTestData, 'show-dewitt.json'))
+    future = api.GetUser('dewitt')
+    self.assert_(future.Done())
+    self.assertEqual('dewitt', future.Result().screen_name)
+
+  def testCallback(self):
+    '''Test the twitterapi.Future AddCallback method'''
+    future = twitterapi.Future()
+    results = []
+    future.AddCallback(lambda f: results.append(f.Result()))
+    future.SetResult(42)
+    future.AddCallback(lambda f: results.append(f.Result()))
+    self.assertEqual([42, 42], results)
+
+  def testFailingCallback(self):
+    '''Test that a callback that raises does not kill the worker thread'''
+    pool = twitterapi._WorkerPool(1)
+    stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+    try:
+      started = threading.Event()
+      first = pool.Submit(started.wait, 10)
+      first.AddCallback(lambda f: 1 / 0)
+      started.set()
+      first.Result(timeout=10)
+      self.assertEqual(2, pool.Submit(lambda: 2).Result(timeout=10))
+    finally:
+      sys.stderr = stderr
+      pool.Shutdown()
+
+class InlineExecutor(object):
+  '''An executor that runs each call immediately, in the calling thread'''
+
+  def Submit(self, function, *args, **kwargs):
+    future = twitterapi.Future()
+    try:
+      future.SetResult(function(*args, **kwargs))
+    except:
+      future.SetException(sys.exc_info())
+    return future
+
+class DeferredExecutor(object):
+  '''An executor that queues calls until RunAll is called'''
+
+  def __init__(self):
+    self.calls = []
+
+  def Submit(self, function, *args, **kwargs):
+    future = twitterapi.Future()
+    self.calls.append((future, function, args, kwargs))
+    return future
+
+  def RunAll(self):
+    calls, self.calls = self.calls, []
+    for future, function, args, kwargs in calls:
+      try:
+        future.SetResult(function(*args, **kwargs))
+      except:
+        future.SetException(sys.exc_info())
+
+def _GetTestDataPath(filename):
+  directory = os.path.dirname(os.path.abspath(__file__))
+  return os.path.join(directory, 'testdata', filename)
+
+def _OpenTestData(filename):
+  return open(_GetTestDataPath(filename))
+
 class MockUrllib(object):
   '''A mock replacement for urllib that hardcodes specific responses.'''
 
@@ -459,21 +2161,39 @@ class MockUrllib(object):
   def AddHandler(self, url, callback):
     self._handlers[url] = callback
 
+  def SetPassData(self, pass_data):
+    '''If true, handlers are called with the request's POST data'''
+    self._pass_data = pass_data
+
   def build_opener(self, *handlers):
-    return MockOpener(self._handlers)
+    self.opener = MockOpener(self._handlers, getattr(self, '_pass_data', False))
+    return self.opener
 
 class MockOpener(object):
   '''A mock opener for urllib'''
 
-  def __init__(self, handlers):
+  def __init__(self, handlers, pass_data=False):
     self._handlers = handlers
+    self._pass_data = pass_data
 
   def open(self, url, data=None):
-    if url in self._handlers:
+    if url in self._handlers and self._pass_data:
+      return self._handlers[url](data)
+    elif url in self._handlers:
       return self._handlers[url]()
     else:
       raise Exception('Unexpected URL %s' % url)
 
+class MockResponse(StringIO.StringIO):
+  '''A mock urllib response that carries HTTP headers'''
+
+  def __init__(self, data, headers=None):
+    StringIO.StringIO.__init__(self, data)
+    self._headers = headers or {}
+
+  def info(self):
+    return self._headers
+
 class MockHTTPBasicAuthHandler(object):
   '''A mock replacement for HTTPBasicAuthHandler'''
 
@@ -482,6 +2202,86 @@ class MockHTTPBasicAuthHandler(object):
     pass
 
 
+class CountingCache(object):
+  '''A dict-backed cache that counts the calls made to it'''
+
+  def __init__(self):
+    self._entries = {}
+    self.calls = 0
+
+  def Get(self, key):
+    self.calls += 1
+    return self._entries.get(key, (None, None))[0]
+
+  def Set(self, key, data):
+    self.calls += 1
+    self._entries[key] = (data, time.time())
+
+  def Remove(self, key):
+    self.calls += 1
+    self._entries.pop(key, None)
+
+  def GetCachedTime(self, key):
+    self.calls += 1
+    return self._entries.get(key, (None, None))[1]
+
+class LocalHTTPServer(object):
+  '''A keep-alive HTTP/1.1 server on localhost, run in a background thread'''
+
+  def __init__(self, body='Hello World!'):
+    posts = self.posts = []
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def do_GET(self):
+        if '/missing' in self.path:
+          error = 'Not found'
+          self.send_response(404)
+          self.send_header('Content-Length', str(len(error)))
+          self.end_headers()
+          self.wfile.write(error)
+          return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+      def do_POST(self):
+        # Read the request, then drop the connection without a response
+        posts.append(self.rfile.read(int(self.headers['Content-Length'])))
+        self.close_connection = 1
+      def log_message(self, *args):
+        pass
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      daemon_threads = True
+      def handle_error(self, request, client_address):
+        pass # Clients closing pooled connections show up as resets
+    self._server = Server(('127.0.0.1', 0), Handler)
+    self.url = 'http://127.0.0.1:%d/' % self._server.server_port
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+class ClosingResponse(object):
+  '''A file-like response body that records whether it was closed'''
+
+  def __init__(self, data):
+    self._data = StringIO.StringIO(data)
+    self.closed = False
+
+  def read(self, size=-1):
+    return self._data.read(size)
+
+  def readline(self):
+    return self._data.readline()
+
+  def close(self):
+    self.closed = True
+
+
 class NullCache(object):
   '''A no-op replacement for the cache class'''
 
@@ -517,10 +2317,28 @@ class curry:
 
 def suite():
   suite = unittest.TestSuite()
+  suite.addTests(unittest.makeSuite(CompactModelTest))
+  suite.addTests(unittest.makeSuite(LazyModelTest))
+  suite.addTests(unittest.makeSuite(CreatedAtTest))
+  suite.addTests(unittest.makeSuite(CreatedAtTimesTest))
+  suite.addTests(unittest.makeSuite(TimelineFrameTest))
   suite.addTests(unittest.makeSuite(FileCacheTest))
+  suite.addTests(unittest.makeSuite(FileCacheSweepTest))
+  suite.addTests(unittest.makeSuite(CacheCompressorTest))
+  suite.addTests(unittest.makeSuite(SharedFileCacheTest))
+  suite.addTests(unittest.makeSuite(SqliteCacheTest))
+  suite.addTests(unittest.makeSuite(MemoryCacheTest))
+  suite.addTests(unittest.makeSuite(ObjectCacheTest))
+  suite.addTests(unittest.makeSuite(CacheStatsTest))
+  suite.addTests(unittest.makeSuite(JsonCodecTest))
+  suite.addTests(unittest.makeSuite(IterJsonArrayTest))
+  suite.addTests(unittest.makeSuite(KeepAliveTest))
   suite.addTests(unittest.makeSuite(StatusTest))
   suite.addTests(unittest.makeSuite(UserTest))
   suite.addTests(unittest.makeSuite(ApiTest))
+  suite.addTests(unittest.makeSuite(RateGovernorTest))
+  suite.addTests(unittest.makeSuite(RetryTest))
+  suite.addTests(unittest.makeSuite(AsyncApiTest))
   return suite
 
 if __name__ == '__main__':
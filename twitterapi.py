@@ -8,27 +8,327 @@ __author__ = 'dewitt@google.com'
 __version__ = '0.6.1-devel'
 
 
+import array
 import base64
+import bisect
+import errno
 try:
 	from hashlib import md5
 except ImportError:
 	from md5 import new as md5
+import heapq
+import httplib
+try:
+  import numpy
+except ImportError:
+  numpy = None
 import os
-import simplejson
+import Queue
+import random
+import re
+import socket
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
+import StringIO
 import sys
 import tempfile
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+import threading
 import time
+import traceback
 import calendar
+import collections
 import urllib
 import urllib2
 import urlparse
+import zlib
 import twitterapi
 
 class TwitterError(Exception):
   '''Base class for Twitter errors'''
 
 
-class Status(object):
+class TwitterRateLimitError(TwitterError):
+  '''Raised when a request would exceed a twitterapi.RateGovernor limit'''
+
+
+class TwitterUnavailableError(TwitterError):
+  '''Raised instead of calling Twitter while a twitterapi.CircuitBreaker is open'''
+
+
+class _PrefetchReserveError(TwitterRateLimitError):
+  '''Raised when a prefetch would use up the rate limit reserve'''
+
+
+class JsonCodec(object):
+  '''Decodes and encodes JSON using the best library available.
+
+  By default decoding is done by the first of JsonCodec.DECODERS that can
+  be imported: simplejson, or the json module of the standard library.
+  ujson is faster, but it is only used when asked for with
+  decoder='ujson': it parses floats with a fast routine that may differ
+  from simplejson in the last digit, and raises ValueError for integers
+  that do not fit in 64 bits, which simplejson and json decode.  Encoding
+  needs sort_keys, and finding where a bare number ends while streaming
+  needs JSONDecoder.raw_decode, so they use the first of
+  JsonCodec.ENCODERS that can be imported; streamed objects, arrays and
+  strings are decoded by the decoder.
+  '''
+
+  DECODERS = ('simplejson', 'json', 'ujson')
+  ENCODERS = ('simplejson', 'json')
+
+  def __init__(self, decoder=None, encoder=None):
+    '''Instantiate a new twitterapi.JsonCodec object.
+
+    Args:
+      decoder:
+        The name of the module used to decode JSON, one of
+        JsonCodec.DECODERS.  Defaults to the first installed. [optional]
+      encoder:
+        The name of the module used to encode JSON, one of
+        JsonCodec.ENCODERS.  Defaults to the first installed. [optional]
+    '''
+    self.decoder = decoder or JsonCodec._FindModule(JsonCodec.DECODERS)
+    self.encoder = encoder or JsonCodec._FindModule(JsonCodec.ENCODERS)
+    self._loads = __import__(self.decoder).loads
+    encoder_module = __import__(self.encoder)
+    self._dumps = encoder_module.dumps
+    self._raw_decode = encoder_module.JSONDecoder().raw_decode
+
+  def Decode(self, data):
+    '''Return the python object represented by the JSON string data.'''
+    return self._loads(data)
+
+  def Encode(self, obj, sort_keys=False):
+    '''Return obj as a JSON string.'''
+    return self._dumps(obj, sort_keys=sort_keys)
+
+  def RawDecode(self, data, pos=0):
+    '''Decode the JSON value starting at data[pos].
+
+    Returns:
+      A (value, end) tuple, where end is the index just past the value
+    '''
+    return self._raw_decode(data, pos)
+
+  @staticmethod
+  def _FindModule(names):
+    for name in names:
+      try:
+        __import__(name)
+        return name
+      except ImportError:
+        pass
+    raise ImportError('None of %s is installed' % ', '.join(names))
+
+_DEFAULT_JSON_CODEC = JsonCodec()
+
+_CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+_MONTH_DAYS = {'Jan': 0, 'Feb': 31, 'Mar': 59, 'Apr': 90, 'May': 120,
+               'Jun': 151, 'Jul': 181, 'Aug': 212, 'Sep': 243, 'Oct': 273,
+               'Nov': 304, 'Dec': 334}
+
+_MONTH_LENGTHS = {'Jan': 31, 'Feb': 28, 'Mar': 31, 'Apr': 30, 'May': 31,
+                  'Jun': 30, 'Jul': 31, 'Aug': 31, 'Sep': 30, 'Oct': 31,
+                  'Nov': 30, 'Dec': 31}
+
+_WEEKDAYS = frozenset(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+
+def _LeapDays(year):
+  '''Return the number of leap years from year 1 to year inclusive.'''
+  return year / 4 - year / 100 + year / 400
+
+_LEAP_DAYS_BEFORE_EPOCH = _LeapDays(1969)
+
+def _ParseCreatedAt(created_at):
+  '''Convert a twitter timestamp to seconds since the epoch.
+
+  Twitter always formats timestamps as _CREATED_AT_FORMAT, for example
+  "Sat Jan 27 04:17:38 +0000 2007", so the fields are read at fixed
+  offsets, which is much faster than time.strptime.  Anything else,
+  including fields out of range such as Feb 30 or 24:00:00, is handed to
+  time.strptime, which raises ValueError if it does not match.
+
+  Args:
+    created_at: A timestamp in the form "Sat Jan 27 04:17:38 +0000 2007"
+  Returns:
+    The timestamp in seconds since the epoch
+  '''
+  if len(created_at) == 30 and created_at[19:26] == ' +0000 ' and \
+     created_at[:3] in _WEEKDAYS and created_at[4:7] in _MONTH_DAYS and \
+     created_at[3] + created_at[7] + created_at[10] == '   ' and \
+     created_at[13] + created_at[16] == '::' and \
+     (created_at[8:10] + created_at[11:13] + created_at[14:16] +
+      created_at[17:19] + created_at[26:]).isdigit():
+    month = created_at[4:7]
+    year = int(created_at[26:])
+    day = int(created_at[8:10])
+    hour = int(created_at[11:13])
+    minute = int(created_at[14:16])
+    second = int(created_at[17:19])
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    month_length = _MONTH_LENGTHS[month]
+    if month == 'Feb' and leap:
+      month_length += 1
+    if 1 <= day <= month_length and hour < 24 and minute < 60 and \
+       second < 60:
+      days = (365 * (year - 1970) + _LeapDays(year - 1) -
+              _LEAP_DAYS_BEFORE_EPOCH + _MONTH_DAYS[month] + day - 1)
+      if leap and month not in ('Jan', 'Feb'):
+        days += 1
+      return days * 86400 + hour * 3600 + minute * 60 + second
+  return calendar.timegm(time.strptime(created_at, _CREATED_AT_FORMAT))
+
+# relative_created_at rounds to the nearest unit within a fudge factor of
+# 1.25: a delta below each limit uses the format alongside it, and formats
+# with a unit are given the delta in that unit.
+_RELATIVE_TIME_LIMITS = [1 * 1.25, 60 / 1.25, 60 * 1.25, 60 * 60 / 1.25,
+                         60 * 60 * 1.25, 60 * 60 * 24 / 1.25,
+                         60 * 60 * 24 * 1.25]
+
+_RELATIVE_TIME_FORMATS = [('about a second ago', None),
+                          ('about %d seconds ago', 1),
+                          ('about a minute ago', None),
+                          ('about %d minutes ago', 60),
+                          ('about an hour ago', None),
+                          ('about %d hours ago', 60 * 60),
+                          ('about a day ago', None),
+                          ('about %d days ago', 60 * 60 * 24)]
+
+def _RelativeTime(delta):
+  '''Return a human readable string for a number of seconds ago.'''
+  format, unit = _RELATIVE_TIME_FORMATS[
+      bisect.bisect_right(_RELATIVE_TIME_LIMITS, delta)]
+  if unit is None:
+    return format
+  return format % (delta / unit)
+
+
+class _StatusBase(object):
+  '''The behaviour shared by twitterapi.Status and twitterapi.CompactStatus.'''
+
+  __slots__ = ()
+
+  def GetCreatedAtInSeconds(self):
+    '''Get the time this status message was posted, in seconds since the epoch.
+
+    The value is parsed once and kept until created_at changes.
+
+    Returns:
+      The time this status message was posted, in seconds since the epoch.
+    '''
+    created_at = self.created_at
+    parsed = self._parsed_created_at
+    if parsed is None or parsed[0] is not created_at:
+      parsed = (created_at, _ParseCreatedAt(created_at))
+      self._parsed_created_at = parsed
+    return parsed[1]
+
+  created_at_in_seconds = property(GetCreatedAtInSeconds,
+                                   doc="The time this status message was "
+                                       "posted, in seconds since the epoch")
+
+  def GetRelativeCreatedAt(self):
+    '''Get a human redable string representing the posting time
+
+    Returns:
+      A human readable string representing the posting time
+    '''
+    return _RelativeTime(int(self.now) - int(self.created_at_in_seconds))
+
+  relative_created_at = property(GetRelativeCreatedAt,
+                                 doc='Get a human readable string representing'
+                                     'the posting time')
+
+  def GetNow(self):
+    '''Get the wallclock time for this status message.
+
+    Used to calculate relative_created_at.  Defaults to the time
+    the object was instantiated.
+
+    Returns:
+      Whatever the status instance believes the current time to be,
+      in seconds since the epoch.
+    '''
+    if self._now is None:
+      self._now = time.time()
+    return self._now
+
+  def SetNow(self, now):
+    '''Set the wallclock time for this status message.
+
+    Used to calculate relative_created_at.  Defaults to the time
+    the object was instantiated.
+
+    Args:
+      now: The wallclock time for this instance.
+    '''
+    self._now = now
+
+  now = property(GetNow, SetNow,
+                 doc='The wallclock time for this status instance.')
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __eq__(self, other):
+    try:
+      return other and \
+             self.created_at == other.created_at and \
+             self.id == other.id and \
+             self.text == other.text and \
+             self.user == other.user
+    except AttributeError:
+      return False
+
+  def __str__(self):
+    '''A string representation of this twitterapi.Status instance.
+
+    The return value is the same as the JSON string representation.
+
+    Returns:
+      A string representation of this twitterapi.Status instance.
+    '''
+    return self.AsJsonString()
+
+  def AsJsonString(self):
+    '''A JSON string representation of this twitterapi.Status instance.
+
+    Returns:
+      A JSON string representation of this twitterapi.Status instance
+   '''
+    return _DEFAULT_JSON_CODEC.Encode(self.AsDict(), sort_keys=True)
+
+  def AsDict(self):
+    '''A dict representation of this twitterapi.Status instance.
+
+    The return value uses the same key names as the JSON representation.
+
+    Return:
+      A dict representing this twitterapi.Status instance
+    '''
+    data = {}
+    if self.created_at:
+      data['created_at'] = self.created_at
+    if self.favorited:
+      data['favorited'] = self.favorited
+    if self.id:
+      data['id'] = self.id
+    if self.text:
+      data['text'] = self.text
+    if self.user:
+      data['user'] = self.user.AsDict()
+    return data
+
+
+class Status(_StatusBase):
   '''A class representing the Status structure used by the twitter API.
 
   The Status structure exposes the following properties:
@@ -90,22 +390,11 @@ class Status(object):
       created_at: The time this status message was created
     '''
     self._created_at = created_at
+    self._parsed_created_at = None
 
   created_at = property(GetCreatedAt, SetCreatedAt,
                         doc='The time this status message was posted.')
 
-  def GetCreatedAtInSeconds(self):
-    '''Get the time this status message was posted, in seconds since the epoch.
-
-    Returns:
-      The time this status message was posted, in seconds since the epoch.
-    '''
-    return calendar.timegm(time.strptime(self.created_at, '%a %b %d %H:%M:%S +0000 %Y'))
-
-  created_at_in_seconds = property(GetCreatedAtInSeconds,
-                                   doc="The time this status message was "
-                                       "posted, in seconds since the epoch")
-
   def GetFavorited(self):
     '''Get the favorited setting of this status message.
 
@@ -163,36 +452,6 @@ class Status(object):
   text = property(GetText, SetText,
                   doc='The text of this status message')
 
-  def GetRelativeCreatedAt(self):
-    '''Get a human redable string representing the posting time
-
-    Returns:
-      A human readable string representing the posting time
-    '''
-    fudge = 1.25
-    delta  = int(self.now) - int(self.created_at_in_seconds)
-
-    if delta < (1 * fudge):
-      return 'about a second ago'
-    elif delta < (60 * (1/fudge)):
-      return 'about %d seconds ago' % (delta)
-    elif delta < (60 * fudge):
-      return 'about a minute ago'
-    elif delta < (60 * 60 * (1/fudge)):
-      return 'about %d minutes ago' % (delta / 60)
-    elif delta < (60 * 60 * fudge):
-      return 'about an hour ago'
-    elif delta < (60 * 60 * 24 * (1/fudge)):
-      return 'about %d hours ago' % (delta / (60 * 60))
-    elif delta < (60 * 60 * 24 * fudge):
-      return 'about a day ago'
-    else:
-      return 'about %d days ago' % (delta / (60 * 60 * 24))
-
-  relative_created_at = property(GetRelativeCreatedAt,
-                                 doc='Get a human readable string representing'
-                                     'the posting time')
-
   def GetUser(self):
     '''Get a twitterapi.User reprenting the entity posting this status message.
 
@@ -213,34 +472,30 @@ class Status(object):
                   doc='A twitterapi.User reprenting the entity posting this '
                       'status message')
 
-  def GetNow(self):
-    '''Get the wallclock time for this status message.
-
-    Used to calculate relative_created_at.  Defaults to the time
-    the object was instantiated.
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance based on a JSON dict.
 
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
     Returns:
-      Whatever the status instance believes the current time to be,
-      in seconds since the epoch.
+      A twitterapi.Status instance
     '''
-    if self._now is None:
-      self._now = time.time()
-    return self._now
-
-  def SetNow(self, now):
-    '''Set the wallclock time for this status message.
-
-    Used to calculate relative_created_at.  Defaults to the time
-    the object was instantiated.
+    if 'user' in data:
+      user = User.NewFromJsonDict(data['user'])
+    else:
+      user = None
+    return Status(created_at=data.get('created_at', None),
+                  favorited=data.get('favorited', None),
+                  id=data.get('id', None),
+                  text=data.get('text', None),
+                  user=user)
 
-    Args:
-      now: The wallclock time for this instance.
-    '''
-    self._now = now
 
-  now = property(GetNow, SetNow,
-                 doc='The wallclock time for this status instance.')
+class _UserBase(object):
+  '''The behaviour shared by twitterapi.User and twitterapi.CompactUser.'''
 
+  __slots__ = ()
 
   def __ne__(self, other):
     return not self.__eq__(other)
@@ -248,73 +503,64 @@ class Status(object):
   def __eq__(self, other):
     try:
       return other and \
-             self.created_at == other.created_at and \
              self.id == other.id and \
-             self.text == other.text and \
-             self.user == other.user
+             self.name == other.name and \
+             self.screen_name == other.screen_name and \
+             self.location == other.location and \
+             self.description == other.description and \
+             self.profile_image_url == other.profile_image_url and \
+             self.url == other.url and \
+             self.status == other.status
     except AttributeError:
       return False
 
   def __str__(self):
-    '''A string representation of this twitterapi.Status instance.
+    '''A string representation of this twitterapi.User instance.
 
     The return value is the same as the JSON string representation.
 
     Returns:
-      A string representation of this twitterapi.Status instance.
+      A string representation of this twitterapi.User instance.
     '''
     return self.AsJsonString()
 
   def AsJsonString(self):
-    '''A JSON string representation of this twitterapi.Status instance.
+    '''A JSON string representation of this twitterapi.User instance.
 
     Returns:
-      A JSON string representation of this twitterapi.Status instance
+      A JSON string representation of this twitterapi.User instance
    '''
-    return simplejson.dumps(self.AsDict(), sort_keys=True)
+    return _DEFAULT_JSON_CODEC.Encode(self.AsDict(), sort_keys=True)
 
   def AsDict(self):
-    '''A dict representation of this twitterapi.Status instance.
+    '''A dict representation of this twitterapi.User instance.
 
     The return value uses the same key names as the JSON representation.
 
     Return:
-      A dict representing this twitterapi.Status instance
+      A dict representing this twitterapi.User instance
     '''
     data = {}
-    if self.created_at:
-      data['created_at'] = self.created_at
-    if self.favorited:
-      data['favorited'] = self.favorited
     if self.id:
       data['id'] = self.id
-    if self.text:
-      data['text'] = self.text
-    if self.user:
-      data['user'] = self.user.AsDict()
+    if self.name:
+      data['name'] = self.name
+    if self.screen_name:
+      data['screen_name'] = self.screen_name
+    if self.location:
+      data['location'] = self.location
+    if self.description:
+      data['description'] = self.description
+    if self.profile_image_url:
+      data['profile_image_url'] = self.profile_image_url
+    if self.url:
+      data['url'] = self.url
+    if self.status:
+      data['status'] = self.status.AsDict()
     return data
 
-  @staticmethod
-  def NewFromJsonDict(data):
-    '''Create a new instance based on a JSON dict.
 
-    Args:
-      data: A JSON dict, as converted from the JSON in the twitter API
-    Returns:
-      A twitterapi.Status instance
-    '''
-    if 'user' in data:
-      user = User.NewFromJsonDict(data['user'])
-    else:
-      user = None
-    return Status(created_at=data.get('created_at', None),
-                  favorited=data.get('favorited', None),
-                  id=data.get('id', None),
-                  text=data.get('text', None),
-                  user=user)
-
-
-class User(object):
+class User(_UserBase):
   '''A class representing the User structure used by the twitter API.
 
   The User structure exposes the following properties:
@@ -499,91 +745,114 @@ class User(object):
   status = property(GetStatus, SetStatus,
                   doc='The latest twitterapi.Status of this user.')
 
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance based on a JSON dict.
+
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.User instance
+    '''
+    if 'status' in data:
+      status = Status.NewFromJsonDict(data['status'])
+    else:
+      status = None
+    return User(id=data.get('id', None),
+                name=data.get('name', None),
+                screen_name=data.get('screen_name', None),
+                location=data.get('location', None),
+                description=data.get('description', None),
+                profile_image_url=data.get('profile_image_url', None),
+                url=data.get('url', None),
+                status=status)
+
+class _DirectMessageBase(object):
+  '''The behaviour shared by twitterapi.DirectMessage and
+  twitterapi.CompactDirectMessage.'''
+
+  __slots__ = ()
+
+  def GetCreatedAtInSeconds(self):
+    '''Get the time this direct message was posted, in seconds since the epoch.
+
+    The value is parsed once and kept until created_at changes.
+
+    Returns:
+      The time this direct message was posted, in seconds since the epoch.
+    '''
+    created_at = self.created_at
+    parsed = self._parsed_created_at
+    if parsed is None or parsed[0] is not created_at:
+      parsed = (created_at, _ParseCreatedAt(created_at))
+      self._parsed_created_at = parsed
+    return parsed[1]
+
+  created_at_in_seconds = property(GetCreatedAtInSeconds,
+                                   doc="The time this direct message was "
+                                       "posted, in seconds since the epoch")
+
   def __ne__(self, other):
     return not self.__eq__(other)
 
   def __eq__(self, other):
     try:
       return other and \
-             self.id == other.id and \
-             self.name == other.name and \
-             self.screen_name == other.screen_name and \
-             self.location == other.location and \
-             self.description == other.description and \
-             self.profile_image_url == other.profile_image_url and \
-             self.url == other.url and \
-             self.status == other.status
+          self.id == other.id and \
+          self.created_at == other.created_at and \
+          self.sender_id == other.sender_id and \
+          self.sender_screen_name == other.sender_screen_name and \
+          self.recipient_id == other.recipient_id and \
+          self.recipient_screen_name == other.recipient_screen_name and \
+          self.text == other.text
     except AttributeError:
       return False
 
   def __str__(self):
-    '''A string representation of this twitterapi.User instance.
+    '''A string representation of this twitterapi.DirectMessage instance.
 
     The return value is the same as the JSON string representation.
 
     Returns:
-      A string representation of this twitterapi.User instance.
+      A string representation of this twitterapi.DirectMessage instance.
     '''
     return self.AsJsonString()
 
   def AsJsonString(self):
-    '''A JSON string representation of this twitterapi.User instance.
+    '''A JSON string representation of this twitterapi.DirectMessage instance.
 
     Returns:
-      A JSON string representation of this twitterapi.User instance
+      A JSON string representation of this twitterapi.DirectMessage instance
    '''
-    return simplejson.dumps(self.AsDict(), sort_keys=True)
+    return _DEFAULT_JSON_CODEC.Encode(self.AsDict(), sort_keys=True)
 
   def AsDict(self):
-    '''A dict representation of this twitterapi.User instance.
+    '''A dict representation of this twitterapi.DirectMessage instance.
 
     The return value uses the same key names as the JSON representation.
 
     Return:
-      A dict representing this twitterapi.User instance
+      A dict representing this twitterapi.DirectMessage instance
     '''
     data = {}
     if self.id:
       data['id'] = self.id
-    if self.name:
-      data['name'] = self.name
-    if self.screen_name:
-      data['screen_name'] = self.screen_name
-    if self.location:
-      data['location'] = self.location
-    if self.description:
-      data['description'] = self.description
-    if self.profile_image_url:
-      data['profile_image_url'] = self.profile_image_url
-    if self.url:
-      data['url'] = self.url
-    if self.status:
-      data['status'] = self.status.AsDict()
+    if self.created_at:
+      data['created_at'] = self.created_at
+    if self.sender_id:
+      data['sender_id'] = self.sender_id
+    if self.sender_screen_name:
+      data['sender_screen_name'] = self.sender_screen_name
+    if self.recipient_id:
+      data['recipient_id'] = self.recipient_id
+    if self.recipient_screen_name:
+      data['recipient_screen_name'] = self.recipient_screen_name
+    if self.text:
+      data['text'] = self.text
     return data
 
-  @staticmethod
-  def NewFromJsonDict(data):
-    '''Create a new instance based on a JSON dict.
-
-    Args:
-      data: A JSON dict, as converted from the JSON in the twitter API
-    Returns:
-      A twitterapi.User instance
-    '''
-    if 'status' in data:
-      status = Status.NewFromJsonDict(data['status'])
-    else:
-      status = None
-    return User(id=data.get('id', None),
-                name=data.get('name', None),
-                screen_name=data.get('screen_name', None),
-                location=data.get('location', None),
-                description=data.get('description', None),
-                profile_image_url=data.get('profile_image_url', None),
-                url=data.get('url', None),
-                status=status)
 
-class DirectMessage(object):
+class DirectMessage(_DirectMessageBase):
   '''A class representing the DirectMessage structure used by the twitter API.
 
   The DirectMessage structure exposes the following properties:
@@ -664,22 +933,11 @@ class DirectMessage(object):
       created_at: The time this direct message was created
     '''
     self._created_at = created_at
+    self._parsed_created_at = None
 
   created_at = property(GetCreatedAt, SetCreatedAt,
                         doc='The time this direct message was posted.')
 
-  def GetCreatedAtInSeconds(self):
-    '''Get the time this direct message was posted, in seconds since the epoch.
-
-    Returns:
-      The time this direct message was posted, in seconds since the epoch.
-    '''
-    return calendar.timegm(time.strptime(self.created_at, '%a %b %d %H:%M:%S +0000 %Y'))
-
-  created_at_in_seconds = property(GetCreatedAtInSeconds,
-                                   doc="The time this direct message was "
-                                       "posted, in seconds since the epoch")
-
   def GetSenderId(self):
     '''Get the unique sender id of this direct message.
 
@@ -775,65 +1033,6 @@ class DirectMessage(object):
   text = property(GetText, SetText,
                   doc='The text of this direct message')
 
-  def __ne__(self, other):
-    return not self.__eq__(other)
-
-  def __eq__(self, other):
-    try:
-      return other and \
-          self.id == other.id and \
-          self.created_at == other.created_at and \
-          self.sender_id == other.sender_id and \
-          self.sender_screen_name == other.sender_screen_name and \
-          self.recipient_id == other.recipient_id and \
-          self.recipient_screen_name == other.recipient_screen_name and \
-          self.text == other.text
-    except AttributeError:
-      return False
-
-  def __str__(self):
-    '''A string representation of this twitterapi.DirectMessage instance.
-
-    The return value is the same as the JSON string representation.
-
-    Returns:
-      A string representation of this twitterapi.DirectMessage instance.
-    '''
-    return self.AsJsonString()
-
-  def AsJsonString(self):
-    '''A JSON string representation of this twitterapi.DirectMessage instance.
-
-    Returns:
-      A JSON string representation of this twitterapi.DirectMessage instance
-   '''
-    return simplejson.dumps(self.AsDict(), sort_keys=True)
-
-  def AsDict(self):
-    '''A dict representation of this twitterapi.DirectMessage instance.
-
-    The return value uses the same key names as the JSON representation.
-
-    Return:
-      A dict representing this twitterapi.DirectMessage instance
-    '''
-    data = {}
-    if self.id:
-      data['id'] = self.id
-    if self.created_at:
-      data['created_at'] = self.created_at
-    if self.sender_id:
-      data['sender_id'] = self.sender_id
-    if self.sender_screen_name:
-      data['sender_screen_name'] = self.sender_screen_name
-    if self.recipient_id:
-      data['recipient_id'] = self.recipient_id
-    if self.recipient_screen_name:
-      data['recipient_screen_name'] = self.recipient_screen_name
-    if self.text:
-      data['text'] = self.text
-    return data
-
   @staticmethod
   def NewFromJsonDict(data):
     '''Create a new instance based on a JSON dict.
@@ -851,38 +1050,837 @@ class DirectMessage(object):
                          id=data.get('id', None),
                          recipient_screen_name=data.get('recipient_screen_name', None))
 
-class Api(object):
-  '''A python interface into the Twitter API
+def _DefineAccessors(cls, names):
+  '''Add a GetXxx and a SetXxx method to cls for each attribute in names.
 
-  By default, the Api caches results for 1 minute.
+  For example, 'screen_name' gets GetScreenName and SetScreenName methods.
+  '''
+  def MakeGetter(name):
+    def Get(self):
+      return getattr(self, name)
+    return Get
+  def MakeSetter(name):
+    def Set(self, value):
+      setattr(self, name, value)
+    return Set
+  for name in names:
+    suffix = ''.join([part.capitalize() for part in name.split('_')])
+    getter = MakeGetter(name)
+    getter.__name__ = 'Get' + suffix
+    getter.__doc__ = 'Get the %s attribute.' % name
+    setter = MakeSetter(name)
+    setter.__name__ = 'Set' + suffix
+    setter.__doc__ = 'Set the %s attribute.' % name
+    setattr(cls, getter.__name__, getter)
+    setattr(cls, setter.__name__, setter)
+
+class CompactStatus(_StatusBase):
+  '''A replacement for twitterapi.Status that stores its fields in __slots__.
+
+  CompactStatus has the same public API as twitterapi.Status, but its
+  instances have no __dict__ and their fields are plain attributes rather
+  than properties, so they take much less memory and their fields are
+  faster to read and write.  Unlike a twitterapi.Status, new attributes
+  cannot be added to an instance.  See benchmarks/model_benchmark.py.
+
+  CompactStatus is not a subclass of twitterapi.Status, so code that
+  checks isinstance(status, twitterapi.Status) must also accept it.
+  '''
 
-  Example usage:
+  __slots__ = ('created_at', 'favorited', 'id', 'text', 'user', '_now',
+               '_parsed_created_at')
 
-    To create an instance of the twitterapi.Api class, with no authentication:
+  def __init__(self,
+               created_at=None,
+               favorited=None,
+               id=None,
+               text=None,
+               user=None,
+               now=None):
+    self.created_at = created_at
+    self.favorited = favorited
+    self.id = id
+    self.text = text
+    self.user = user
+    self._now = now
+    self._parsed_created_at = None
 
-      >>> import twitter
-      >>> api = twitterapi.Api()
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance based on a JSON dict.
 
-    To fetch the most recently posted public twitter status messages:
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.CompactStatus instance
+    '''
+    if 'user' in data:
+      user = CompactUser.NewFromJsonDict(data['user'])
+    else:
+      user = None
+    return CompactStatus(created_at=data.get('created_at', None),
+                         favorited=data.get('favorited', None),
+                         id=data.get('id', None),
+                         text=data.get('text', None),
+                         user=user)
 
-      >>> statuses = api.GetPublicTimeline()
-      >>> print [s.user.name for s in statuses]
-      [u'DeWitt', u'Kesuke Miyagi', u'ev', u'Buzz Andersen', u'Biz Stone'] #...
+_DefineAccessors(CompactStatus, ('created_at', 'favorited', 'id', 'text',
+                                 'user'))
 
-    To fetch a single user's public status messages, where "user" is either
-    a Twitter "short name" or their user id.
+class CompactUser(_UserBase):
+  '''A replacement for twitterapi.User that stores its fields in __slots__.
 
-      >>> statuses = api.GetUserTimeline(user)
-      >>> print [s.text for s in statuses]
+  CompactUser has the same public API as twitterapi.User, but is not a
+  subclass of it; see twitterapi.CompactStatus.
+  '''
 
-    To use authentication, instantiate the twitterapi.Api class with a
-    username and password:
+  __slots__ = ('id', 'name', 'screen_name', 'location', 'description',
+               'profile_image_url', 'url', 'status')
 
-      >>> api = twitterapi.Api(username='twitter user', password='twitter pass')
+  def __init__(self,
+               id=None,
+               name=None,
+               screen_name=None,
+               location=None,
+               description=None,
+               profile_image_url=None,
+               url=None,
+               status=None):
+    self.id = id
+    self.name = name
+    self.screen_name = screen_name
+    self.location = location
+    self.description = description
+    self.profile_image_url = profile_image_url
+    self.url = url
+    self.status = status
 
-    To fetch your friends (after being authenticated):
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance based on a JSON dict.
 
-      >>> users = api.GetFriends()
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.CompactUser instance
+    '''
+    if 'status' in data:
+      status = CompactStatus.NewFromJsonDict(data['status'])
+    else:
+      status = None
+    return CompactUser(id=data.get('id', None),
+                       name=data.get('name', None),
+                       screen_name=data.get('screen_name', None),
+                       location=data.get('location', None),
+                       description=data.get('description', None),
+                       profile_image_url=data.get('profile_image_url', None),
+                       url=data.get('url', None),
+                       status=status)
+
+_DefineAccessors(CompactUser, CompactUser.__slots__)
+
+class CompactDirectMessage(_DirectMessageBase):
+  '''A replacement for twitterapi.DirectMessage that uses __slots__.
+
+  CompactDirectMessage has the same public API as twitterapi.DirectMessage,
+  but is not a subclass of it; see twitterapi.CompactStatus.
+  '''
+
+  __slots__ = ('id', 'created_at', 'sender_id', 'sender_screen_name',
+               'recipient_id', 'recipient_screen_name', 'text',
+               '_parsed_created_at')
+
+  def __init__(self,
+               id=None,
+               created_at=None,
+               sender_id=None,
+               sender_screen_name=None,
+               recipient_id=None,
+               recipient_screen_name=None,
+               text=None):
+    self.id = id
+    self.created_at = created_at
+    self.sender_id = sender_id
+    self.sender_screen_name = sender_screen_name
+    self.recipient_id = recipient_id
+    self.recipient_screen_name = recipient_screen_name
+    self.text = text
+    self._parsed_created_at = None
+
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance based on a JSON dict.
+
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.CompactDirectMessage instance
+    '''
+    return CompactDirectMessage(
+        created_at=data.get('created_at', None),
+        recipient_id=data.get('recipient_id', None),
+        sender_id=data.get('sender_id', None),
+        text=data.get('text', None),
+        sender_screen_name=data.get('sender_screen_name', None),
+        id=data.get('id', None),
+        recipient_screen_name=data.get('recipient_screen_name', None))
+
+_DefineAccessors(CompactDirectMessage, ('id', 'created_at', 'sender_id',
+                                        'sender_screen_name', 'recipient_id',
+                                        'recipient_screen_name', 'text'))
+
+class _LazyField(object):
+  '''A model attribute read from the JSON dict that the model wraps.
+
+  If builder is set, it is called with the JSON value the first time the
+  attribute is read, and the model it returns is kept in the named slot.
+  '''
+
+  def __init__(self, key, slot=None, builder=None):
+    self._key = key
+    self._slot = slot
+    self._builder = builder
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    if self._slot is None:
+      return instance._data.get(self._key)
+    try:
+      return getattr(instance, self._slot)
+    except AttributeError:
+      value = instance._data.get(self._key)
+      if value is not None:
+        value = self._builder(value)
+      setattr(instance, self._slot, value)
+      return value
+
+  def __set__(self, instance, value):
+    if self._slot is None:
+      instance._data[self._key] = value
+    else:
+      setattr(instance, self._slot, value)
+
+def _NewLazyDict(**kwargs):
+  '''Return the JSON dict for a lazy model built from keyword arguments.'''
+  data = {}
+  for key, value in kwargs.items():
+    if value is not None:
+      data[key] = value
+  return data
+
+class LazyStatus(_StatusBase):
+  '''A replacement for twitterapi.Status that wraps its JSON dict.
+
+  LazyStatus has the same public API as twitterapi.Status, but
+  NewFromJsonDict only keeps a reference to the dict: fields are read
+  from it when they are accessed, and the nested twitterapi.LazyUser is
+  only built the first time status.user is read.  Code that filters many
+  statuses on a field or two skips most of the work of building them.
+
+  The dict is not copied, so setting a field changes it.  LazyStatus is
+  not a subclass of twitterapi.Status, so code that checks
+  isinstance(status, twitterapi.Status) must also accept it.
+  '''
+
+  __slots__ = ('_data', '_user', '_now', '_parsed_created_at')
+
+  def __init__(self,
+               created_at=None,
+               favorited=None,
+               id=None,
+               text=None,
+               user=None,
+               now=None):
+    self._data = _NewLazyDict(created_at=created_at, favorited=favorited,
+                              id=id, text=text)
+    self._user = user
+    self._now = now
+    self._parsed_created_at = None
+
+  created_at = _LazyField('created_at')
+  favorited = _LazyField('favorited')
+  id = _LazyField('id')
+  text = _LazyField('text')
+  user = _LazyField('user', '_user',
+                    lambda data: LazyUser.NewFromJsonDict(data))
+
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance wrapping a JSON dict.
+
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.LazyStatus instance
+    '''
+    status = LazyStatus.__new__(LazyStatus)
+    status._data = data
+    status._now = None
+    status._parsed_created_at = None
+    return status
+
+_DefineAccessors(LazyStatus, ('created_at', 'favorited', 'id', 'text', 'user'))
+
+class LazyUser(_UserBase):
+  '''A replacement for twitterapi.User that wraps its JSON dict.
+
+  LazyUser has the same public API as twitterapi.User, but is not a
+  subclass of it; its nested twitterapi.LazyStatus is only built when
+  user.status is read.  See twitterapi.LazyStatus.
+  '''
+
+  __slots__ = ('_data', '_status')
+
+  def __init__(self,
+               id=None,
+               name=None,
+               screen_name=None,
+               location=None,
+               description=None,
+               profile_image_url=None,
+               url=None,
+               status=None):
+    self._data = _NewLazyDict(id=id, name=name, screen_name=screen_name,
+                              location=location, description=description,
+                              profile_image_url=profile_image_url, url=url)
+    self._status = status
+
+  id = _LazyField('id')
+  name = _LazyField('name')
+  screen_name = _LazyField('screen_name')
+  location = _LazyField('location')
+  description = _LazyField('description')
+  profile_image_url = _LazyField('profile_image_url')
+  url = _LazyField('url')
+  status = _LazyField('status', '_status',
+                      lambda data: LazyStatus.NewFromJsonDict(data))
+
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance wrapping a JSON dict.
+
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.LazyUser instance
+    '''
+    user = LazyUser.__new__(LazyUser)
+    user._data = data
+    return user
+
+_DefineAccessors(LazyUser, ('id', 'name', 'screen_name', 'location',
+                            'description', 'profile_image_url', 'url',
+                            'status'))
+
+class LazyDirectMessage(_DirectMessageBase):
+  '''A replacement for twitterapi.DirectMessage that wraps its JSON dict.
+
+  LazyDirectMessage has the same public API as twitterapi.DirectMessage,
+  but is not a subclass of it; see twitterapi.LazyStatus.
+  '''
+
+  __slots__ = ('_data', '_parsed_created_at')
+
+  def __init__(self,
+               id=None,
+               created_at=None,
+               sender_id=None,
+               sender_screen_name=None,
+               recipient_id=None,
+               recipient_screen_name=None,
+               text=None):
+    self._data = _NewLazyDict(id=id, created_at=created_at,
+                              sender_id=sender_id,
+                              sender_screen_name=sender_screen_name,
+                              recipient_id=recipient_id,
+                              recipient_screen_name=recipient_screen_name,
+                              text=text)
+    self._parsed_created_at = None
+
+  id = _LazyField('id')
+  created_at = _LazyField('created_at')
+  sender_id = _LazyField('sender_id')
+  sender_screen_name = _LazyField('sender_screen_name')
+  recipient_id = _LazyField('recipient_id')
+  recipient_screen_name = _LazyField('recipient_screen_name')
+  text = _LazyField('text')
+
+  @staticmethod
+  def NewFromJsonDict(data):
+    '''Create a new instance wrapping a JSON dict.
+
+    Args:
+      data: A JSON dict, as converted from the JSON in the twitter API
+    Returns:
+      A twitterapi.LazyDirectMessage instance
+    '''
+    message = LazyDirectMessage.__new__(LazyDirectMessage)
+    message._data = data
+    message._parsed_created_at = None
+    return message
+
+_DefineAccessors(LazyDirectMessage, ('id', 'created_at', 'sender_id',
+                                     'sender_screen_name', 'recipient_id',
+                                     'recipient_screen_name', 'text'))
+
+def GetCreatedAtTimes(models, now=None):
+  '''Convert the posting times of many statuses or messages in one pass.
+
+  This is faster than reading created_at_in_seconds and
+  relative_created_at from each model when rendering a whole timeline,
+  and every model is measured against the same reference time.  If numpy
+  is installed the seconds and deltas are numpy arrays, and the relative
+  times are chosen for all the models at once.
+
+  Args:
+    models:
+      A sequence of twitterapi.Status or twitterapi.DirectMessage
+      instances, or their compact or lazy variants
+    now:
+      The reference time, in seconds since the epoch.  Defaults to the
+      wall clock time.  [Optional]
+  Returns:
+    A (seconds, deltas, relative_created_ats) tuple: the time each model
+    was posted in seconds since the epoch, the number of seconds from then
+    to now, and the human readable strings relative_created_at returns.
+    seconds and deltas are numpy arrays if numpy is installed and lists
+    otherwise.
+  '''
+  if now is None:
+    now = time.time()
+  now = int(now)
+  if numpy is None:
+    seconds = [int(model.created_at_in_seconds) for model in models]
+    deltas = [now - s for s in seconds]
+    return seconds, deltas, [_RelativeTime(delta) for delta in deltas]
+  seconds = numpy.fromiter([model.created_at_in_seconds for model in models],
+                           dtype=numpy.int64)
+  deltas = now - seconds
+  indexes = numpy.searchsorted(_RELATIVE_TIME_LIMITS, deltas, side='right')
+  units = numpy.array([unit or 1 for format, unit in _RELATIVE_TIME_FORMATS],
+                      dtype=numpy.int64)
+  quantities = deltas // units[indexes]
+  relative_created_ats = []
+  for index, quantity in zip(indexes.tolist(), quantities.tolist()):
+    format, unit = _RELATIVE_TIME_FORMATS[index]
+    if unit is None:
+      relative_created_ats.append(format)
+    else:
+      relative_created_ats.append(format % quantity)
+  return seconds, deltas, relative_created_ats
+
+# The typecode of the integer columns of a TimelineFrame: a C long where it
+# holds 64 bits.  Otherwise there is no array typecode that holds every id
+# exactly, and the columns are lists.
+if array.array('l').itemsize >= 8:
+  _INT64_TYPECODE = 'l'
+else:
+  _INT64_TYPECODE = None
+
+def _NewInt64Column():
+  '''Return an empty column of 64-bit integers for a TimelineFrame.'''
+  if _INT64_TYPECODE is None:
+    return []
+  return array.array(_INT64_TYPECODE)
+
+def _StatusToJsonDict(status):
+  '''Return the JSON dict a status could have been built from.
+
+  Unlike AsDict, this keeps fields that are set to false values.
+  '''
+  data = {}
+  for name in ('created_at', 'favorited', 'id', 'text'):
+    value = getattr(status, name)
+    if value is not None:
+      data[name] = value
+  if status.user is not None:
+    data['user'] = _UserToJsonDict(status.user)
+  return data
+
+def _UserToJsonDict(user):
+  '''Return the JSON dict a user could have been built from.'''
+  data = {}
+  for name in ('id', 'name', 'screen_name', 'location', 'description',
+               'profile_image_url', 'url'):
+    value = getattr(user, name)
+    if value is not None:
+      data[name] = value
+  if user.status is not None:
+    data['status'] = _StatusToJsonDict(user.status)
+  return data
+
+class TimelineFrame(object):
+  '''A compact, column-oriented sequence of status messages.
+
+  A TimelineFrame keeps the ids, posting times and user ids of its
+  statuses in typed arrays (or lists, where a C long has fewer than 64
+  bits), and their text, timestamps and users in
+  tables that store each distinct value once, rather than holding a
+  twitterapi.Status per message.  It can be filtered, sorted, sliced and
+  grouped by user without building any models; twitterapi.Status
+  instances are only built when an element is read.
+
+  Filter, Sort, Top, GroupByUser and slicing return new frames that
+  share the tables of this one.
+
+  Each user is stored once per id, as it appears in the first status that
+  carries it; since timelines list the newest statuses first, that is the
+  most recent snapshot.  Fields that differ in later copies of the same
+  user, such as followers_count, are dropped.  Users without an id are
+  never shared.
+
+  The TimelineFrame structure exposes the following properties:
+
+    frame.ids # read only
+    frame.created_at_in_seconds # read only
+    frame.user_ids # read only
+  '''
+
+  KEYS = ('id', 'created_at_in_seconds', 'user_id')
+
+  def __init__(self, statuses=None, status_class=None):
+    '''Create a frame holding a sequence of status messages.
+
+    Args:
+      statuses:
+        A sequence of twitterapi.Status instances, or their compact or
+        lazy variants [optional]
+      status_class:
+        The class of the models built from the frame.  Defaults to the
+        class of the first status, or twitterapi.Status. [optional]
+    '''
+    statuses = list(statuses or [])
+    if status_class is None and statuses:
+      status_class = type(statuses[0])
+    self._Load([_StatusToJsonDict(status) for status in statuses],
+               status_class)
+
+  @staticmethod
+  def NewFromJsonList(data, status_class=None):
+    '''Create a new instance based on a JSON list of statuses.
+
+    Args:
+      data: A JSON list, as converted from the JSON in the twitter API
+      status_class:
+        The class of the models built from the frame.  Defaults to
+        twitterapi.Status. [optional]
+    Returns:
+      A twitterapi.TimelineFrame instance
+    '''
+    frame = TimelineFrame.__new__(TimelineFrame)
+    frame._Load(data, status_class)
+    return frame
+
+  def _Load(self, data, status_class):
+    self._status_class = status_class or Status
+    self._strings = []
+    self._users = []
+    self._ids = _NewInt64Column()
+    self._created_at_in_seconds = _NewInt64Column()
+    self._user_ids = _NewInt64Column()
+    self._favorited = array.array('b')
+    self._texts = array.array('l')
+    self._created_ats = array.array('l')
+    self._user_indexes = array.array('l')
+    string_indexes = {}
+    user_indexes = {}
+    def AddString(value):
+      if value is None:
+        return -1
+      index = string_indexes.get(value)
+      if index is None:
+        index = string_indexes[value] = len(self._strings)
+        self._strings.append(value)
+      return index
+    for item in data:
+      self._ids.append(item.get('id') or 0)
+      created_at = item.get('created_at')
+      if created_at:
+        self._created_at_in_seconds.append(_ParseCreatedAt(created_at))
+      else:
+        self._created_at_in_seconds.append(0)
+      self._created_ats.append(AddString(created_at))
+      self._texts.append(AddString(item.get('text')))
+      favorited = item.get('favorited')
+      if favorited is None:
+        self._favorited.append(-1)
+      else:
+        self._favorited.append(bool(favorited))
+      user = item.get('user')
+      if user is None:
+        self._user_ids.append(0)
+        self._user_indexes.append(-1)
+      else:
+        # Users with an id are shared between their statuses, as first seen
+        user_id = user.get('id') or 0
+        index = None
+        if user_id:
+          index = user_indexes.get(user_id)
+        if index is None:
+          index = len(self._users)
+          self._users.append(user)
+          if user_id:
+            user_indexes[user_id] = index
+        self._user_ids.append(user_id)
+        self._user_indexes.append(index)
+
+  def _Take(self, rows):
+    '''Return a new frame holding the given rows of this one.'''
+    frame = TimelineFrame.__new__(TimelineFrame)
+    frame._status_class = self._status_class
+    frame._strings = self._strings
+    frame._users = self._users
+    for name in ('_ids', '_created_at_in_seconds', '_user_ids', '_favorited',
+                 '_texts', '_created_ats', '_user_indexes'):
+      column = getattr(self, name)
+      values = [column[row] for row in rows]
+      if not isinstance(column, list):
+        values = array.array(column.typecode, values)
+      setattr(frame, name, values)
+    return frame
+
+  def _WithStatusClass(self, status_class):
+    '''Return a frame sharing this one's columns that builds status_class.'''
+    frame = TimelineFrame.__new__(TimelineFrame)
+    frame.__dict__.update(self.__dict__)
+    frame._status_class = status_class
+    return frame
+
+  def _GetColumn(self, key):
+    if key == 'id':
+      return self._ids
+    if key == 'created_at_in_seconds':
+      return self._created_at_in_seconds
+    if key == 'user_id':
+      return self._user_ids
+    raise TwitterError('Unknown key %r; expected one of %s' %
+                       (key, ', '.join(self.KEYS)))
+
+  def __len__(self):
+    return len(self._ids)
+
+  def __iter__(self):
+    for row in xrange(len(self._ids)):
+      yield self.GetStatus(row)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return self._Take(xrange(*index.indices(len(self._ids))))
+    return self.GetStatus(index)
+
+  def GetStatus(self, index):
+    '''Build the status message at an index.
+
+    Args:
+      index: The position of the status message in this frame
+    Returns:
+      An instance of the frame's status class
+    '''
+    data = {}
+    if self._ids[index]:
+      data['id'] = int(self._ids[index])
+    if self._created_ats[index] >= 0:
+      data['created_at'] = self._strings[self._created_ats[index]]
+    if self._texts[index] >= 0:
+      data['text'] = self._strings[self._texts[index]]
+    if self._favorited[index] >= 0:
+      data['favorited'] = bool(self._favorited[index])
+    if self._user_indexes[index] >= 0:
+      data['user'] = dict(self._users[self._user_indexes[index]])
+    return self._status_class.NewFromJsonDict(data)
+
+  def GetStatuses(self):
+    '''Build every status message in this frame.
+
+    Returns:
+      A list of instances of the frame's status class
+    '''
+    return list(self)
+
+  def GetIds(self):
+    '''Get the ids of the status messages in this frame.
+
+    Returns:
+      An array.array, or list, of ids.  It must not be modified.
+    '''
+    return self._ids
+
+  ids = property(GetIds, doc='The ids of the status messages in this frame.')
+
+  def GetCreatedAtInSeconds(self):
+    '''Get the times the status messages were posted, in seconds since the epoch.
+
+    Returns:
+      An array.array, or list, of times.  It must not be modified.
+    '''
+    return self._created_at_in_seconds
+
+  created_at_in_seconds = property(GetCreatedAtInSeconds,
+                                   doc='The times the status messages were '
+                                       'posted, in seconds since the epoch.')
+
+  def GetUserIds(self):
+    '''Get the ids of the users who posted the status messages.
+
+    Returns:
+      An array.array, or list, of user ids, with 0 where a status has no
+      user.  It must not be modified.
+    '''
+    return self._user_ids
+
+  user_ids = property(GetUserIds,
+                      doc='The ids of the users who posted the status '
+                          'messages.')
+
+  def GetTexts(self):
+    '''Get the text of the status messages in this frame.
+
+    Returns:
+      A list of the text of each status message
+    '''
+    texts = []
+    for index in self._texts:
+      if index >= 0:
+        texts.append(self._strings[index])
+      else:
+        texts.append(None)
+    return texts
+
+  def Filter(self, since=None, until=None, since_id=None, max_id=None,
+             user_ids=None, text=None):
+    '''Select the status messages that match every given condition.
+
+    Args:
+      since:
+        Only statuses posted at or after this time, in seconds since the
+        epoch [optional]
+      until:
+        Only statuses posted before this time, in seconds since the
+        epoch [optional]
+      since_id:
+        Only statuses with an id greater than this one [optional]
+      max_id:
+        Only statuses with an id less than or equal to this one [optional]
+      user_ids:
+        Only statuses posted by one of these user ids [optional]
+      text:
+        Only statuses whose text contains this string [optional]
+    Returns:
+      A twitterapi.TimelineFrame holding the matching statuses, in order
+    '''
+    rows = xrange(len(self._ids))
+    if since is not None:
+      column = self._created_at_in_seconds
+      rows = [row for row in rows if column[row] >= since]
+    if until is not None:
+      column = self._created_at_in_seconds
+      rows = [row for row in rows if column[row] < until]
+    if since_id is not None:
+      column = self._ids
+      rows = [row for row in rows if column[row] > since_id]
+    if max_id is not None:
+      column = self._ids
+      rows = [row for row in rows if column[row] <= max_id]
+    if user_ids is not None:
+      user_ids = set(user_ids)
+      column = self._user_ids
+      rows = [row for row in rows if column[row] in user_ids]
+    if text is not None:
+      # Each distinct text is only searched once
+      matches = set([index for index, string in enumerate(self._strings)
+                     if text in string])
+      column = self._texts
+      rows = [row for row in rows if column[row] in matches]
+    return self._Take(rows)
+
+  def Sort(self, key='id', reverse=False):
+    '''Sort the status messages by one of KEYS.
+
+    The sort is stable.  If numpy is installed it sorts the column.
+
+    Args:
+      key: 'id', 'created_at_in_seconds' or 'user_id' [optional]
+      reverse: True to sort in descending order [optional]
+    Returns:
+      A sorted twitterapi.TimelineFrame
+    '''
+    return self._Take(self._ArgSort(self._GetColumn(key), reverse))
+
+  def Top(self, n, key='created_at_in_seconds'):
+    '''Select the n status messages with the largest value of one of KEYS.
+
+    Args:
+      n: The number of status messages to select
+      key: 'id', 'created_at_in_seconds' or 'user_id' [optional]
+    Returns:
+      A twitterapi.TimelineFrame of at most n statuses, largest first
+    '''
+    column = self._GetColumn(key)
+    if numpy is not None:
+      return self._Take(self._ArgSort(column, True)[:n])
+    return self._Take(heapq.nlargest(n, xrange(len(column)),
+                                     key=column.__getitem__))
+
+  def GroupByUser(self):
+    '''Split the status messages by the user who posted them.
+
+    Returns:
+      A dict mapping each user id to a twitterapi.TimelineFrame of that
+      user's statuses, in order.  Statuses without a user are under 0.
+    '''
+    groups = {}
+    for row, user_id in enumerate(self._user_ids):
+      groups.setdefault(user_id, []).append(row)
+    return dict([(user_id, self._Take(rows))
+                 for user_id, rows in groups.items()])
+
+  @staticmethod
+  def _ArgSort(column, reverse):
+    '''Return the rows of a column in (stable) sorted order.'''
+    if numpy is not None and len(column):
+      if isinstance(column, list):
+        values = numpy.array(column, dtype=numpy.int64)
+      else:
+        values = numpy.frombuffer(column, dtype=column.typecode)
+      if reverse:
+        values = -values
+      return numpy.argsort(values, kind='mergesort').tolist()
+    return sorted(xrange(len(column)), key=column.__getitem__,
+                  reverse=reverse)
+
+class Api(object):
+  '''A python interface into the Twitter API
+
+  By default, the Api caches results for 1 minute.
+
+  Example usage:
+
+    To create an instance of the twitterapi.Api class, with no authentication:
+
+      >>> import twitter
+      >>> api = twitterapi.Api()
+
+    To fetch the most recently posted public twitter status messages:
+
+      >>> statuses = api.GetPublicTimeline()
+      >>> print [s.user.name for s in statuses]
+      [u'DeWitt', u'Kesuke Miyagi', u'ev', u'Buzz Andersen', u'Biz Stone'] #...
+
+    To fetch a single user's public status messages, where "user" is either
+    a Twitter "short name" or their user id.
+
+      >>> statuses = api.GetUserTimeline(user)
+      >>> print [s.text for s in statuses]
+
+    To use authentication, instantiate the twitterapi.Api class with a
+    username and password:
+
+      >>> api = twitterapi.Api(username='twitter user', password='twitter pass')
+
+    To fetch your friends (after being authenticated):
+
+      >>> users = api.GetFriends()
       >>> print [u.name for u in users]
 
     To post a twitter status message (after being authenticated):
@@ -895,9 +1893,12 @@ class Api(object):
 
       >>> api.PostDirectMessage(user, text)
       >>> api.GetUser(user)
+      >>> api.GetUsers(users)
       >>> api.GetReplies()
       >>> api.GetUserTimeline(user)
+      >>> api.IterUserTimeline(user)
       >>> api.GetStatus(id)
+      >>> api.GetStatuses(ids)
       >>> api.DestroyStatus(id)
       >>> api.GetFriendsTimeline(user)
       >>> api.GetFriends(user)
@@ -912,8 +1913,24 @@ class Api(object):
 
   DEFAULT_CACHE_TIMEOUT = 60 # cache for 1 minute
 
+  # Concurrent requests made by GetUsers and GetStatuses; matches the
+  # default per-host limit of twitterapi._ConnectionPool
+  DEFAULT_MAX_WORKERS = 4
+
   _API_REALM = 'Twitter API'
 
+  # Cache entries holding the HTTP validators of a response are stored
+  # under the response's own key plus this suffix
+  _VALIDATORS_SUFFIX = '#validators'
+
+  # The methods Prefetch can call, which make cacheable GET requests
+  _PREFETCHABLE = frozenset([
+    'GetPublicTimeline', 'GetFriendsTimeline', 'GetUserTimeline', 'GetStatus',
+    'GetReplies', 'GetFriends', 'GetFollowers', 'GetFeatured', 'GetUser',
+    'GetDirectMessages', 'GetPublicTimelineFrame', 'GetFriendsTimelineFrame',
+    'GetUserTimelineFrame', 'GetRepliesFrame',
+  ])
+
   def __init__(self,
                username=None,
                password=None,
@@ -927,9 +1944,26 @@ class Api(object):
       input_encoding: The encoding used to encode input strings. [optional]
       request_header: A dictionary of additional HTTP request headers. [optional]
     '''
-    self._cache = _FileCache()
-    self._urllib = urllib2
-    self._cache_timeout = Api.DEFAULT_CACHE_TIMEOUT
+    self._cache = _MemoryCache(_FileCache())
+    self._urllib = _KeepAliveUrllib()
+    self._cache_policy = CachePolicy()
+    self._compression = True
+    self._cache_compressed = False
+    self._single_flight = _SingleFlight()
+    self._rate_governor = None
+    self._retry_policy = RetryPolicy()
+    self._circuit_breaker = None
+    self._json_codec = _DEFAULT_JSON_CODEC
+    self._object_cache = None
+    self._status_class = Status
+    self._user_class = User
+    self._direct_message_class = DirectMessage
+    self._cache_stats = CacheStats()
+    self._stale_while_revalidate = 0
+    self._refresh_executor = None
+    self._refreshing = set()
+    self._refreshing_lock = threading.Lock()
+    self._prefetching = threading.local()
     self._InitializeRequestHeaders(request_headers)
     self._InitializeUserAgent()
     self._InitializeDefaultParameters()
@@ -947,13 +1981,53 @@ class Api(object):
     Returns:
       An sequence of twitterapi.Status instances, one for each message
     '''
+    url, parameters = self._PublicTimelineRequest(since_id)
+    return self._FetchModels(url, parameters,
+                             self._status_class.NewFromJsonDict)
+
+  def GetPublicTimelineFrame(self, since_id=None):
+    '''Fetch the public status messages for all users as a TimelineFrame.
+
+    Like GetPublicTimeline, but the statuses are returned in a
+    twitterapi.TimelineFrame, which holds them in columns and only builds
+    models when they are read.
+
+    Args:
+      since_id:
+        Returns only public statuses with an ID greater than (that is,
+        more recent than) the specified ID. [Optional]
+
+    Returns:
+      A twitterapi.TimelineFrame of the messages
+    '''
+    url, parameters = self._PublicTimelineRequest(since_id)
+    return self._FetchTimelineFrame(url, parameters)
+
+  def IterPublicTimeline(self, since_id=None):
+    '''Iterate over the public twitterapi.Status messages for all users.
+
+    Like GetPublicTimeline, but the response is parsed incrementally and
+    each twitterapi.Status is yielded as soon as it has been read, so memory
+    use does not grow with the size of the response.  See _StreamUrl for
+    how this interacts with the cache.
+
+    Args:
+      since_id:
+        Returns only public statuses with an ID greater than (that is,
+        more recent than) the specified ID. [Optional]
+
+    Returns:
+      An iterator of twitterapi.Status instances, one for each message
+    '''
+    url, parameters = self._PublicTimelineRequest(since_id)
+    return self._IterUrl(url, parameters, self._status_class.NewFromJsonDict)
+
+  def _PublicTimelineRequest(self, since_id):
     parameters = {}
     if since_id:
       parameters['since_id'] = since_id
     url = 'http://twitter.com/statuses/public_timeline.json'
-    json = self._FetchUrl(url,  parameters=parameters)
-    data = simplejson.loads(json)
-    return [Status.NewFromJsonDict(x) for x in data]
+    return url, parameters
 
   def GetFriendsTimeline(self, user=None, since=None, since_id=None):
     '''Fetch the sequence of twitterapi.Status messages for a user's friends
@@ -975,33 +2049,84 @@ class Api(object):
     Returns:
       A sequence of twitterapi.Status instances, one for each message
     '''
-    if user:
-      url = 'http://twitter.com/statuses/friends_timeline/%s.json' % user
-    elif not user and not self._username:
-      raise TwitterError("User must be specified if API is not authenticated.")
-    else:
-      url = 'http://twitter.com/statuses/friends_timeline.json'
-    parameters = {}
-    if since:
-      parameters['since'] = since
-    if since_id:
-      parameters['since_id'] = since_id
-    json = self._FetchUrl(url, parameters=parameters)
-    data = simplejson.loads(json)
-    return [Status.NewFromJsonDict(x) for x in data]
+    url, parameters = self._FriendsTimelineRequest(user, since, since_id)
+    return self._FetchModels(url, parameters,
+                             self._status_class.NewFromJsonDict)
 
-  def GetUserTimeline(self, user=None, count=None, since=None, since_id=None):
-    '''Fetch the sequence of public twitterapi.Status messages for a single user.
+  def GetFriendsTimelineFrame(self, user=None, since=None, since_id=None):
+    '''Fetch the status messages for a user's friends as a TimelineFrame.
 
-    The twitterapi.Api instance must be authenticated if the user is private.
+    Like GetFriendsTimeline, but the statuses are returned in a
+    twitterapi.TimelineFrame.
 
     Args:
       user:
-        either the username (short_name) or id of the user to retrieve.  If
-        not specified, then the current authenticated user is used. [optional]
-      count: the number of status messages to retrieve [optional]
-      since:
-        Narrows the returned results to just those statuses created
+        Specifies the ID or screen name of the user for whom to return
+        the friends_timeline.  If unspecified, the username and password
+        must be set in the twitterapi.Api instance.  [optional]
+      since:
+        Narrows the returned results to just those statuses created
+        after the specified HTTP-formatted date. [optional]
+      since_id:
+        Returns only statuses with an ID greater than (that is,
+        more recent than) the specified ID. [optional]
+
+    Returns:
+      A twitterapi.TimelineFrame of the messages
+    '''
+    url, parameters = self._FriendsTimelineRequest(user, since, since_id)
+    return self._FetchTimelineFrame(url, parameters)
+
+  def IterFriendsTimeline(self, user=None, since=None, since_id=None):
+    '''Iterate over the twitterapi.Status messages for a user's friends
+
+    Like GetFriendsTimeline, but each twitterapi.Status is yielded as soon
+    as it has been parsed from the response.
+
+    Args:
+      user:
+        Specifies the ID or screen name of the user for whom to return
+        the friends_timeline.  If unspecified, the username and password
+        must be set in the twitterapi.Api instance.  [optional]
+      since:
+        Narrows the returned results to just those statuses created
+        after the specified HTTP-formatted date. [optional]
+      since_id:
+        Returns only statuses with an ID greater than (that is,
+        more recent than) the specified ID. [optional]
+
+    Returns:
+      An iterator of twitterapi.Status instances, one for each message
+    '''
+    url, parameters = self._FriendsTimelineRequest(user, since, since_id)
+    return self._IterUrl(url, parameters, self._status_class.NewFromJsonDict)
+
+  def _FriendsTimelineRequest(self, user, since, since_id):
+    if user:
+      url = 'http://twitter.com/statuses/friends_timeline/%s.json' % user
+    elif not user and not self._username:
+      raise TwitterError("User must be specified if API is not authenticated.")
+    else:
+      url = 'http://twitter.com/statuses/friends_timeline.json'
+    parameters = {}
+    if since:
+      parameters['since'] = since
+    if since_id:
+      parameters['since_id'] = since_id
+    return url, parameters
+
+  def GetUserTimeline(self, user=None, count=None, since=None, since_id=None):
+    '''Fetch the sequence of public twitterapi.Status messages for a single user.
+
+    The twitterapi.Api instance must be authenticated if the user is private.
+
+    Args:
+      user:
+        either the username (short_name) or id of the user to retrieve.  If
+        not specified, then the current authenticated user is used. [optional]
+      count: the number of status messages to retrieve [optional]
+      since:
+        Narrows the returned results to just those statuses created
         after the specified HTTP-formatted date. [optional]
       since_id:
         Returns only statuses with an ID greater than (that is,
@@ -1010,6 +2135,61 @@ class Api(object):
     Returns:
       A sequence of twitterapi.Status instances, one for each message up to count
     '''
+    url, parameters = self._UserTimelineRequest(user, count, since, since_id)
+    return self._FetchModels(url, parameters,
+                             self._status_class.NewFromJsonDict)
+
+  def GetUserTimelineFrame(self, user=None, count=None, since=None,
+                           since_id=None):
+    '''Fetch the public status messages for a single user as a TimelineFrame.
+
+    Like GetUserTimeline, but the statuses are returned in a
+    twitterapi.TimelineFrame.
+
+    Args:
+      user:
+        either the username (short_name) or id of the user to retrieve.  If
+        not specified, then the current authenticated user is used. [optional]
+      count: the number of status messages to retrieve [optional]
+      since:
+        Narrows the returned results to just those statuses created
+        after the specified HTTP-formatted date. [optional]
+      since_id:
+        Returns only statuses with an ID greater than (that is,
+        more recent than) the specified ID. [optional]
+
+    Returns:
+      A twitterapi.TimelineFrame of the messages, up to count
+    '''
+    url, parameters = self._UserTimelineRequest(user, count, since, since_id)
+    return self._FetchTimelineFrame(url, parameters)
+
+  def IterUserTimeline(self, user=None, count=None, since=None, since_id=None):
+    '''Iterate over the public twitterapi.Status messages for a single user.
+
+    Like GetUserTimeline, but each twitterapi.Status is yielded as soon as
+    it has been parsed from the response.
+
+    Args:
+      user:
+        either the username (short_name) or id of the user to retrieve.  If
+        not specified, then the current authenticated user is used. [optional]
+      count: the number of status messages to retrieve [optional]
+      since:
+        Narrows the returned results to just those statuses created
+        after the specified HTTP-formatted date. [optional]
+      since_id:
+        Returns only statuses with an ID greater than (that is,
+        more recent than) the specified ID. [optional]
+
+    Returns:
+      An iterator of twitterapi.Status instances, one for each message up
+      to count
+    '''
+    url, parameters = self._UserTimelineRequest(user, count, since, since_id)
+    return self._IterUrl(url, parameters, self._status_class.NewFromJsonDict)
+
+  def _UserTimelineRequest(self, user, count, since, since_id):
     try:
       if count:
         int(count)
@@ -1028,9 +2208,7 @@ class Api(object):
       raise TwitterError("User must be specified if API is not authenticated.")
     else:
       url = 'http://twitter.com/statuses/user_timeline.json'
-    json = self._FetchUrl(url, parameters=parameters)
-    data = simplejson.loads(json)
-    return [Status.NewFromJsonDict(x) for x in data]
+    return url, parameters
 
   def GetStatus(self, id):
     '''Returns a single status message.
@@ -1049,9 +2227,25 @@ class Api(object):
     except:
       raise TwitterError("id must be an integer")
     url = 'http://twitter.com/statuses/show/%s.json' % id
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return Status.NewFromJsonDict(data)
+    return self._FetchModels(url, None, self._status_class.NewFromJsonDict,
+                             is_list=False)
+
+  def GetStatuses(self, ids, max_workers=None):
+    '''Returns a sequence of status messages, fetched concurrently.
+
+    Each status is fetched with GetStatus, so cached statuses are not
+    fetched again.  A failure to fetch one status does not affect the others.
+
+    Args:
+      ids: A sequence of the numerical IDs of the statuses to retrieve.
+      max_workers:
+        The maximum number of statuses to fetch at the same time. [optional]
+
+    Returns:
+      A list with one entry for each id, in the same order: either the
+      twitterapi.Status instance, or the exception raised while fetching it.
+    '''
+    return self._FetchEach(self.GetStatus, ids, max_workers)
 
   def DestroyStatus(self, id):
     '''Destroys the status specified by the required ID parameter.
@@ -1072,8 +2266,8 @@ class Api(object):
       raise TwitterError("id must be an integer")
     url = 'http://twitter.com/statuses/destroy/%s.json' % id
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return Status.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._status_class.NewFromJsonDict(data)
 
   def PostUpdate(self, text):
     '''Post a twitter status message from the authenticated user.
@@ -1093,8 +2287,8 @@ class Api(object):
     url = 'http://twitter.com/statuses/update.json'
     data = {'status': text}
     json = self._FetchUrl(url, post_data=data)
-    data = simplejson.loads(json)
-    return Status.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._status_class.NewFromJsonDict(data)
 
   def GetReplies(self):
     '''Get a sequence of status messages representing the 20 most recent
@@ -1104,12 +2298,39 @@ class Api(object):
     Returns:
       A sequence of twitterapi.Status instances, one for each reply to the user.
     '''
+    url = self._RepliesRequest()
+    return self._FetchModels(url, None, self._status_class.NewFromJsonDict)
+
+  def GetRepliesFrame(self):
+    '''Get the 20 most recent replies to the authenticating user as a
+    TimelineFrame.
+
+    Like GetReplies, but the statuses are returned in a
+    twitterapi.TimelineFrame.
+
+    Returns:
+      A twitterapi.TimelineFrame of the replies to the user.
+    '''
+    url = self._RepliesRequest()
+    return self._FetchTimelineFrame(url, None)
+
+  def IterReplies(self):
+    '''Iterate over the 20 most recent replies to the authenticating user.
+
+    Like GetReplies, but each twitterapi.Status is yielded as soon as it
+    has been parsed from the response.
+
+    Returns:
+      An iterator of twitterapi.Status instances, one for each reply to the user.
+    '''
+    return self._IterUrl(self._RepliesRequest(), None,
+                         self._status_class.NewFromJsonDict)
+
+  def _RepliesRequest(self):
     url = 'http://twitter.com/statuses/replies.json'
     if not self._username:
       raise TwitterError("The twitterapi.Api instance must be authenticated.")
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return [Status.NewFromJsonDict(x) for x in data]
+    return url
 
   def GetFriends(self, user=None):
     '''Fetch the sequence of twitterapi.User instances, one for each friend.
@@ -1123,15 +2344,34 @@ class Api(object):
     Returns:
       A sequence of twitterapi.User instances, one for each friend
     '''
+    url = self._FriendsRequest(user)
+    return self._FetchModels(url, None, self._user_class.NewFromJsonDict)
+
+  def IterFriends(self, user=None):
+    '''Iterate over the twitterapi.User instances, one for each friend.
+
+    Like GetFriends, but each twitterapi.User is yielded as soon as it has
+    been parsed from the response.
+
+    Args:
+      user: the username or id of the user whose friends you are fetching.  If
+      not specified, defaults to the authenticated user. [optional]
+
+    The twitterapi.Api instance must be authenticated.
+
+    Returns:
+      An iterator of twitterapi.User instances, one for each friend
+    '''
+    return self._IterUrl(self._FriendsRequest(user), None,
+                         self._user_class.NewFromJsonDict)
+
+  def _FriendsRequest(self, user):
     if not self._username:
       raise TwitterError("twitterapi.Api instance must be authenticated")
     if user:
-      url = 'http://twitter.com/statuses/friends/%s.json' % user
+      return 'http://twitter.com/statuses/friends/%s.json' % user
     else:
-      url = 'http://twitter.com/statuses/friends.json'
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return [User.NewFromJsonDict(x) for x in data]
+      return 'http://twitter.com/statuses/friends.json'
 
   def GetFollowers(self):
     '''Fetch the sequence of twitterapi.User instances, one for each follower
@@ -1141,12 +2381,27 @@ class Api(object):
     Returns:
       A sequence of twitterapi.User instances, one for each follower
     '''
+    url = self._FollowersRequest()
+    return self._FetchModels(url, None, self._user_class.NewFromJsonDict)
+
+  def IterFollowers(self):
+    '''Iterate over the twitterapi.User instances, one for each follower
+
+    Like GetFollowers, but each twitterapi.User is yielded as soon as it
+    has been parsed from the response.
+
+    The twitterapi.Api instance must be authenticated.
+
+    Returns:
+      An iterator of twitterapi.User instances, one for each follower
+    '''
+    return self._IterUrl(self._FollowersRequest(), None,
+                         self._user_class.NewFromJsonDict)
+
+  def _FollowersRequest(self):
     if not self._username:
       raise TwitterError("twitterapi.Api instance must be authenticated")
-    url = 'http://twitter.com/statuses/followers.json'
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return [User.NewFromJsonDict(x) for x in data]
+    return 'http://twitter.com/statuses/followers.json'
 
   def GetFeatured(self):
     '''Fetch the sequence of twitterapi.User instances featured on twitter.com
@@ -1157,9 +2412,19 @@ class Api(object):
       A sequence of twitterapi.User instances
     '''
     url = 'http://twitter.com/statuses/featured.json'
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return [User.NewFromJsonDict(x) for x in data]
+    return self._FetchModels(url, None, self._user_class.NewFromJsonDict)
+
+  def IterFeatured(self):
+    '''Iterate over the twitterapi.User instances featured on twitter.com
+
+    Like GetFeatured, but each twitterapi.User is yielded as soon as it has
+    been parsed from the response.
+
+    Returns:
+      An iterator of twitterapi.User instances
+    '''
+    url = 'http://twitter.com/statuses/featured.json'
+    return self._IterUrl(url, None, self._user_class.NewFromJsonDict)
 
   def GetUser(self, user):
     '''Returns a single user.
@@ -1173,9 +2438,25 @@ class Api(object):
       A twitterapi.User instance representing that user
     '''
     url = 'http://twitter.com/users/show/%s.json' % user
-    json = self._FetchUrl(url)
-    data = simplejson.loads(json)
-    return User.NewFromJsonDict(data)
+    return self._FetchModels(url, None, self._user_class.NewFromJsonDict,
+                             is_list=False)
+
+  def GetUsers(self, users, max_workers=None):
+    '''Returns a sequence of users, fetched concurrently.
+
+    Each user is fetched with GetUser, so cached users are not fetched
+    again.  A failure to fetch one user does not affect the others.
+
+    Args:
+      users: A sequence of the usernames or ids of the users to retrieve.
+      max_workers:
+        The maximum number of users to fetch at the same time. [optional]
+
+    Returns:
+      A list with one entry for each user, in the same order: either the
+      twitterapi.User instance, or the exception raised while fetching it.
+    '''
+    return self._FetchEach(self.GetUser, users, max_workers)
 
   def GetDirectMessages(self, since=None):
     '''Returns a list of the direct messages sent to the authenticating user.
@@ -1190,15 +2471,36 @@ class Api(object):
     Returns:
       A sequence of twitterapi.DirectMessage instances
     '''
+    url, parameters = self._DirectMessagesRequest(since)
+    return self._FetchModels(url, parameters,
+                             self._direct_message_class.NewFromJsonDict)
+
+  def IterDirectMessages(self, since=None):
+    '''Iterate over the direct messages sent to the authenticating user.
+
+    Like GetDirectMessages, but each twitterapi.DirectMessage is yielded as
+    soon as it has been parsed from the response.
+
+    Args:
+      since:
+        Narrows the returned results to just those statuses created
+        after the specified HTTP-formatted date. [optional]
+
+    Returns:
+      An iterator of twitterapi.DirectMessage instances
+    '''
+    url, parameters = self._DirectMessagesRequest(since)
+    return self._IterUrl(url, parameters,
+                         self._direct_message_class.NewFromJsonDict)
+
+  def _DirectMessagesRequest(self, since):
     url = 'http://twitter.com/direct_messages.json'
     if not self._username:
       raise TwitterError("The twitterapi.Api instance must be authenticated.")
     parameters = {}
     if since:
       parameters['since'] = since
-    json = self._FetchUrl(url, parameters=parameters)
-    data = simplejson.loads(json)
-    return [DirectMessage.NewFromJsonDict(x) for x in data]
+    return url, parameters
 
   def PostDirectMessage(self, user, text):
     '''Post a twitter direct message from the authenticated user
@@ -1217,8 +2519,8 @@ class Api(object):
     url = 'http://twitter.com/direct_messages/new.json'
     data = {'text': text, 'user': user}
     json = self._FetchUrl(url, post_data=data)
-    data = simplejson.loads(json)
-    return DirectMessage.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._direct_message_class.NewFromJsonDict(data)
 
   def DestroyDirectMessage(self, id):
     '''Destroys the direct message specified in the required ID parameter.
@@ -1235,8 +2537,8 @@ class Api(object):
     '''
     url = 'http://twitter.com/direct_messages/destroy/%s.json' % id
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return DirectMessage.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._direct_message_class.NewFromJsonDict(data)
 
   def CreateFriendship(self, user):
     '''Befriends the user specified in the user parameter as the authenticating user.
@@ -1250,8 +2552,8 @@ class Api(object):
     '''
     url = 'http://twitter.com/friendships/create/%s.json' % user
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return User.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._user_class.NewFromJsonDict(data)
 
   def DestroyFriendship(self, user):
     '''Discontinues friendship with the user specified in the user parameter.
@@ -1265,8 +2567,8 @@ class Api(object):
     '''
     url = 'http://twitter.com/friendships/destroy/%s.json' % user
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return User.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._user_class.NewFromJsonDict(data)
 
   def CreateFavorite(self, status):
     '''Favorites the status specified in the status parameter as the authenticating user.
@@ -1281,8 +2583,8 @@ class Api(object):
     '''
     url = 'http://twitter.com/favorites/create/%s.json' % status.id
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return Status.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._status_class.NewFromJsonDict(data)
 
   def DestroyFavorite(self, status):
     '''Un-favorites the status specified in the ID parameter as the authenticating user.
@@ -1297,8 +2599,89 @@ class Api(object):
     '''
     url = 'http://twitter.com/favorites/destroy/%s.json' % status.id
     json = self._FetchUrl(url, post_data={})
-    data = simplejson.loads(json)
-    return Status.NewFromJsonDict(data)
+    data = self._json_codec.Decode(json)
+    return self._status_class.NewFromJsonDict(data)
+
+  def Prefetch(self, calls, max_workers=None, reserve=0):
+    '''Fill the cache in the background with the results of GET calls.
+
+    Use this to warm the cache with responses that will soon be requested,
+    so that the requests are answered from the cache.  The calls run on a
+    bounded pool of threads, and already cached responses are not fetched
+    again.  With a rate governor, prefetching never waits for a request to
+    be allowed: calls that would have to, or that would use up the reserve,
+    fail with twitterapi.TwitterRateLimitError instead.  Other requests for
+    the same URL that were waiting on such a call are then made on their
+    own budget.
+
+    Args:
+      calls:
+        A sequence of (method name, args) or (method name, args, kwargs)
+        tuples, each naming a GET method of this class and its arguments,
+        e.g. [('GetUser', ('dewitt',)), ('GetUserTimeline', ('dewitt',))]
+      max_workers:
+        The maximum number of calls to run at the same time. [optional]
+      reserve:
+        With a rate governor, the number of requests of each endpoint
+        family's budget to leave for other requests. [optional]
+
+    Returns:
+      A list of one twitterapi.Future per call, for the call's result
+    '''
+    calls = [len(call) == 2 and tuple(call) + ({},) or tuple(call)
+             for call in calls]
+    for name, args, kwargs in calls:
+      if name not in Api._PREFETCHABLE:
+        raise TwitterError('%s cannot be prefetched' % name)
+    if not calls:
+      return []
+    pool = _WorkerPool(min(max_workers or Api.DEFAULT_MAX_WORKERS, len(calls)))
+    try:
+      return [pool.Submit(self._RunPrefetch, getattr(self, name), args,
+                          kwargs, reserve)
+              for name, args, kwargs in calls]
+    finally:
+      # The workers exit once the calls have run
+      pool.Shutdown(wait=False)
+
+  def _RunPrefetch(self, method, args, kwargs, reserve):
+    self._prefetching.reserve = reserve
+    try:
+      return method(*args, **kwargs)
+    finally:
+      self._prefetching.reserve = None
+
+  def _FetchEach(self, method, args, max_workers=None):
+    '''Call method once per item of args on a bounded pool of threads.
+
+    Returns:
+      A list of the results, or of the exceptions raised, in the order of args
+    '''
+    def Call(arg):
+      try:
+        return method(arg)
+      except urllib2.HTTPError, e:
+        # The error is kept in the results, so it must not keep the
+        # response's connection open too
+        _DetachHttpError(e)
+        raise
+    args = list(args)
+    if not args:
+      return []
+    max_workers = min(max_workers or Api.DEFAULT_MAX_WORKERS, len(args))
+    pool = _WorkerPool(max_workers)
+    try:
+      futures = [pool.Submit(Call, arg) for arg in args]
+      results = []
+      for future in futures:
+        exception = future.Exception()
+        if exception is not None:
+          results.append(exception)
+        else:
+          results.append(future.Result())
+      return results
+    finally:
+      pool.Shutdown(wait=False)
 
   def SetCredentials(self, username, password):
     '''Set the username and password for this instance
@@ -1319,11 +2702,116 @@ class Api(object):
   def SetCache(self, cache):
     '''Override the default cache.  Set to None to prevent caching.
 
+    The default cache is a twitterapi._MemoryCache in front of a
+    twitterapi._FileCache.  twitterapi._SqliteCache keeps all entries in a
+    single database file instead, which scales better to many keys:
+
+      >>> api.SetCache(twitterapi._MemoryCache(twitterapi._SqliteCache()))
+
+    The default file cache grows without bound and stores responses as
+    is; to limit its size, use a twitterapi._FileCache with max_bytes or
+    max_age set, and to compress entries on disk, set compress=True.
+
     Args:
       cache: an instance that supports the same API as the  twitterapi._FileCache
     '''
     self._cache = cache
 
+  def SetCompactModels(self, compact):
+    '''Return compact models, which store their fields in __slots__.
+
+    If compact is true, methods return twitterapi.CompactStatus,
+    twitterapi.CompactUser and twitterapi.CompactDirectMessage instances
+    instead of twitterapi.Status, twitterapi.User and
+    twitterapi.DirectMessage instances.  They have the same public API but
+    take much less memory, which matters when holding many of them.  They
+    are not subclasses of the default models, so isinstance checks against
+    twitterapi.Status, twitterapi.User or twitterapi.DirectMessage fail.
+
+    Args:
+      compact: True to return compact models, False for the default ones
+    '''
+    if compact:
+      self._status_class = CompactStatus
+      self._user_class = CompactUser
+      self._direct_message_class = CompactDirectMessage
+    else:
+      self._status_class = Status
+      self._user_class = User
+      self._direct_message_class = DirectMessage
+
+  def SetLazyModels(self, lazy):
+    '''Return lazy models, which wrap the JSON dicts they are created from.
+
+    If lazy is true, methods return twitterapi.LazyStatus,
+    twitterapi.LazyUser and twitterapi.LazyDirectMessage instances
+    instead of twitterapi.Status, twitterapi.User and
+    twitterapi.DirectMessage instances.  They have the same public API,
+    but read their fields from the JSON dict and only build nested models
+    when they are accessed, which saves time when only a few fields of
+    each model are read.  Like the compact models, they are not subclasses
+    of the default models, so isinstance checks against them fail.  This
+    replaces any earlier SetCompactModels.
+
+    Args:
+      lazy: True to return lazy models, False for the default ones
+    '''
+    if lazy:
+      self._status_class = LazyStatus
+      self._user_class = LazyUser
+      self._direct_message_class = LazyDirectMessage
+    else:
+      self._status_class = Status
+      self._user_class = User
+      self._direct_message_class = DirectMessage
+
+  def SetCacheStats(self, cache_stats):
+    '''Override the statistics kept on the use of the cache.
+
+    Statistics are kept by default.
+
+    Args:
+      cache_stats:
+        A twitterapi.CacheStats instance, or None to keep no statistics.
+    '''
+    self._cache_stats = cache_stats
+
+  def GetCacheStats(self):
+    '''Return the statistics kept on the use of the cache.
+
+    The 'hits', 'misses' and 'stale_hits' counters count GET requests that
+    were answered from a fresh cache entry, that found the entry missing or
+    expired, and that were answered from an expired entry.  A request that
+    is answered with its expired entry because Twitter could not be reached
+    counts as both a miss and a stale hit.  The other counters cover every
+    read and write of the cache, including the validators stored alongside
+    entries.  Evictions are counted by the cache itself.
+
+    Returns:
+      A twitterapi.CacheStats instance, or None if statistics are not kept
+    '''
+    return self._cache_stats
+
+  def SetObjectCache(self, object_cache):
+    '''Reuse the model objects built from unchanged cached responses.
+
+    Normally every call decodes the response text and builds new
+    twitterapi.Status, twitterapi.User or twitterapi.DirectMessage
+    instances, even when the text came from the cache.  With an object
+    cache, the objects built from a response are kept under the same key
+    as the response, and returned again for as long as the response text
+    is unchanged, skipping decoding and construction entirely.
+
+    The objects are shared between calls, so callers must not modify them.
+    Lists are copied, so they may be modified freely.
+
+    Args:
+      object_cache:
+        A twitterapi._ObjectCache instance, or None to build new objects
+        on every call.
+    '''
+    self._object_cache = object_cache
+
   def SetUrllib(self, urllib):
     '''Override the default urllib implementation.
 
@@ -1332,13 +2820,141 @@ class Api(object):
     '''
     self._urllib = urllib
 
+  def GetConnectionStats(self):
+    '''Return the connection reuse statistics of the current urllib.
+
+    Returns:
+      A dict of counters as returned by twitterapi._ConnectionPool.GetStats,
+      or None if the urllib in use does not pool its connections.
+    '''
+    if hasattr(self._urllib, 'GetStats'):
+      return self._urllib.GetStats()
+    return None
+
+  def SetRateGovernor(self, rate_governor):
+    '''Limit the rate of requests made to Twitter.  Set to None to disable.
+
+    The same twitterapi.RateGovernor may be shared by several Api
+    instances, in which case their requests count against common limits.
+
+    Args:
+      rate_governor: a twitterapi.RateGovernor instance
+    '''
+    self._rate_governor = rate_governor
+
+  def GetRateBudget(self):
+    '''Return the remaining request budget of the current credentials.
+
+    Returns:
+      A dict mapping each endpoint family to the dict returned by
+      twitterapi.RateGovernor.GetBudget, or None if no rate governor is set.
+    '''
+    if not self._rate_governor:
+      return None
+    return self._rate_governor.GetBudgets(self._username)
+
+  def SetRetryPolicy(self, retry_policy):
+    '''Override the default retry policy.  Set to None to disable retries.
+
+    Only requests without post data are ever retried.
+
+    Args:
+      retry_policy: a twitterapi.RetryPolicy instance
+    '''
+    self._retry_policy = retry_policy
+
+  def SetCircuitBreaker(self, circuit_breaker):
+    '''Stop calling Twitter while it keeps failing.  Set to None to disable.
+
+    While the breaker is open, requests without post data are served from
+    the cache, even if the cached copy has expired, or fail at once with
+    twitterapi.TwitterUnavailableError.
+
+    Args:
+      circuit_breaker: a twitterapi.CircuitBreaker instance
+    '''
+    self._circuit_breaker = circuit_breaker
+
+  def SetJsonCodec(self, json_codec):
+    '''Override the JSON library used to decode responses.
+
+    Args:
+      json_codec: a twitterapi.JsonCodec instance
+    '''
+    self._json_codec = json_codec
+
   def SetCacheTimeout(self, cache_timeout):
-    '''Override the default cache timeout.
+    '''Override the cache timeout of every endpoint.
+
+    This replaces the per-endpoint timeouts of the cache policy, except
+    that endpoints which change data are still never cached, so 0 turns
+    caching off everywhere.  To give some endpoints timeouts of their own,
+    call GetCachePolicy().SetTimeout afterwards.
 
     Args:
       cache_timeout: time, in seconds, that responses should be reused.
     '''
-    self._cache_timeout = cache_timeout
+    self._cache_policy.SetAllTimeouts(cache_timeout)
+
+  def SetCachePolicy(self, cache_policy):
+    '''Override the default per-endpoint cache timeouts.
+
+    Args:
+      cache_policy: a twitterapi.CachePolicy instance
+    '''
+    self._cache_policy = cache_policy
+
+  def GetCachePolicy(self):
+    '''Return the twitterapi.CachePolicy in use, for changing its rules.'''
+    return self._cache_policy
+
+  def SetStaleWhileRevalidate(self, window, executor=None):
+    '''Serve expired responses while they are refreshed in the background.
+
+    Once a cached response is older than the cache timeout but by no more
+    than window seconds, it is returned immediately and a refresh is
+    scheduled in the background instead of blocking on the network.  Only
+    one background refresh runs per URL at a time.  Responses older than
+    that are fetched in the foreground as usual.
+
+    Args:
+      window:
+        The number of seconds past the cache timeout that a response may
+        be served stale, or 0 to disable stale-while-revalidate.
+      executor:
+        An object whose Submit method runs the refreshes in the background.
+        Defaults to a twitterapi._WorkerPool. [optional]
+    '''
+    self._stale_while_revalidate = window
+    if executor is None and window and self._refresh_executor is None:
+      executor = _WorkerPool(Api.DEFAULT_MAX_WORKERS)
+    if executor is not None:
+      self._refresh_executor = executor
+
+  def SetCompression(self, compression):
+    '''Enable or disable gzip/deflate compressed responses.
+
+    Compression is enabled by default.
+
+    Args:
+      compression:
+        If true, ask the server for a gzip or deflate encoded body and
+        decompress it as it is read.
+    '''
+    self._compression = compression
+
+  def SetCacheCompressed(self, cache_compressed):
+    '''Store gzip encoded responses in the cache as they were received.
+
+    By default the cache holds decompressed bodies, which makes cache hits
+    cheapest.  Storing the compressed body instead trades a decompression
+    on every hit for a much smaller cache.
+
+    Args:
+      cache_compressed:
+        If true, gzip encoded responses are cached without being decoded.
+    '''
+    self._cache_compressed = cache_compressed
 
   def SetUserAgent(self, user_agent):
     '''Override the default user agent
@@ -1437,6 +3053,8 @@ class Api(object):
     else:
       opener = self._urllib.build_opener()
     opener.addheaders = self._request_headers.items()
+    if self._compression and 'Accept-Encoding' not in self._request_headers:
+      opener.addheaders.append(('Accept-Encoding', 'gzip, deflate'))
     return opener
 
   def _Encode(self, s):
@@ -1499,95 +3117,1962 @@ class Api(object):
     Returns:
       A string containing the body of the response.
     '''
-    # Build the extra parameters dict
-    extra_params = {}
-    if self._default_params:
-      extra_params.update(self._default_params)
-    if parameters:
-      extra_params.update(parameters)
-
-    # Add key/value parameters to the query string of the url
-    url = self._BuildUrl(url, extra_params=extra_params)
+    url = self._BuildRequestUrl(url, parameters)
 
     # Get a url opener that can handle basic auth
     opener = self._GetOpener(url, username=self._username, password=self._password)
 
     encoded_post_data = self._EncodePostData(post_data)
 
-    # Open and return the URL immediately if we're not going to cache
-    if encoded_post_data or no_cache or not self._cache or not self._cache_timeout:
-      url_data = opener.open(url, encoded_post_data).read()
+    # The endpoint names the URL in the cache policy and statistics
+    endpoint = _GetEndpoint(url)
+    cache_timeout = self._cache_policy.GetEndpointTimeout(endpoint)
+
+    # Open and return the URL immediately if we're not going to cache.
+    # Note that an empty dict of post_data still makes this a POST.
+    if post_data is not None or no_cache:
+      url_data = self._OpenUrl(opener, url, encoded_post_data).read()
+    elif not self._cache or not cache_timeout:
+      # Identical requests that are already in flight share one response
+      url_data = self._DoOnce(self._GetCacheKey(url),
+                              self._ReadUrl, opener, url)
     else:
-      # Unique keys are a combination of the url and the username
-      if self._username:
-        key = self._username + ':' + url
-      else:
-        key = url
+      key = self._GetCacheKey(url)
 
       # See if it has been cached before
-      last_cached = self._cache.GetCachedTime(key)
-
-      # If the cached version is outdated then fetch another and store it
-      if not last_cached or time.time() >= last_cached + self._cache_timeout:
-        url_data = opener.open(url, encoded_post_data).read()
-        self._cache.Set(key, url_data)
+      last_cached = self._GetCachedTime(key, endpoint)
+
+      # If the cached version is outdated then fetch another and store it,
+      # letting concurrent callers that missed on the same key wait for it.
+      # Within the stale-while-revalidate window, return the outdated copy
+      # and fetch the new one in the background.
+      if not last_cached:
+        age = None
       else:
-        url_data = self._cache.Get(key)
+        age = time.time() - last_cached
+      url_data = None
+      if age is not None and age < cache_timeout:
+        url_data = self._ReadCache(key, endpoint)
+        if url_data is not None:
+          self._CountCache(endpoint, 'hits')
+      elif age is not None and \
+           age < cache_timeout + self._stale_while_revalidate:
+        url_data = self._ReadCache(key, endpoint)
+        if url_data is not None:
+          self._CountCache(endpoint, 'stale_hits')
+          self._RefreshCacheInBackground(opener, url, key, endpoint,
+                                         last_cached, cache_timeout)
+      # The entry may have been removed, or been unreadable, since
+      # GetCachedTime found it
+      if url_data is None:
+        self._CountCache(endpoint, 'misses')
+        url_data = self._DoOnce(key, self._RefreshSharedCache,
+                                opener, url, key, endpoint,
+                                last_cached, cache_timeout)
 
     # Always return the latest version
     return url_data
 
-class _FileCacheError(Exception):
+  def _DoOnce(self, key, function, *args):
+    '''Return function(*args), sharing the call with concurrent callers.
+
+    A prefetch that declines to use up the rate limit reserve fails only
+    the prefetch: callers that joined it make the call again, on their own
+    budget.
+    '''
+    while True:
+      try:
+        return self._single_flight.Do(key, function, *args)
+      except _PrefetchReserveError:
+        if getattr(self._prefetching, 'reserve', None) is not None:
+          raise
+
+  def _BuildRequestUrl(self, url, parameters):
+    # Build the extra parameters dict
+    extra_params = {}
+    if self._default_params:
+      extra_params.update(self._default_params)
+    if parameters:
+      extra_params.update(parameters)
+
+    # Add key/value parameters to the query string of the url
+    return self._BuildUrl(url, extra_params=extra_params)
+
+  def _StreamUrl(self, url, parameters=None):
+    '''Return a file-like object over the body of a GET request.
+
+    A fresh cached copy of the response is read from the cache.  Otherwise
+    the body is streamed from the network and, since caching it would mean
+    holding all of it in memory, it is not cached.  Streamed requests are
+    not retried, as the caller may already have consumed part of the body.
+
+    Args:
+      url: The URL to retrieve
+      parameters: A dict of key/value pairs that should added to
+                  the query string. [OPTIONAL]
+    '''
+    url = self._BuildRequestUrl(url, parameters)
+    endpoint = _GetEndpoint(url)
+    cache_timeout = self._cache_policy.GetEndpointTimeout(endpoint)
+    if self._cache and cache_timeout:
+      key = self._GetCacheKey(url)
+      last_cached = self._GetCachedTime(key, endpoint)
+      if last_cached and time.time() < last_cached + cache_timeout:
+        url_data = self._ReadCache(key, endpoint)
+        if url_data is not None:
+          self._CountCache(endpoint, 'hits')
+          return StringIO.StringIO(url_data)
+      self._CountCache(endpoint, 'misses')
+    breaker = self._circuit_breaker
+    if breaker and not breaker.Allow():
+      raise TwitterUnavailableError(
+          'Not calling %s while the circuit breaker is open' % url)
+    opener = self._GetOpener(url, username=self._username, password=self._password)
+    try:
+      response = self._OpenUrl(opener, url, None)
+    except Exception, e:
+      if breaker:
+        if RetryPolicy.IsTransient(e):
+          breaker.RecordFailure()
+        elif not isinstance(e, TwitterError):
+          breaker.RecordSuccess()
+      raise
+    # Once the headers have arrived the upstream is answering
+    if breaker:
+      breaker.RecordSuccess()
+    return response
+
+  def _FetchModels(self, url, parameters, new_from_json_dict, is_list=True):
+    '''Fetch a GET request and build model objects from its response.
+
+    Args:
+      url: The URL to retrieve
+      parameters: A dict of key/value pairs for the query string
+      new_from_json_dict: The function that builds a model from a JSON dict
+      is_list: True if the response is a JSON array of models [optional]
+
+    Returns:
+      A list of models if is_list is true, otherwise a single model
+    '''
+    json = self._FetchUrl(url, parameters=parameters)
+    if self._object_cache is None:
+      return self._BuildModels(json, new_from_json_dict, is_list)
+    # The models are only reused while they were built from the same text,
+    # so they are invalidated along with the underlying cache entry
+    key = self._GetCacheKey(self._BuildRequestUrl(url, parameters))
+    entry = self._object_cache.Get(key)
+    if entry is not None and entry[0] == json and \
+       entry[1] == new_from_json_dict:
+      models = entry[2]
+    else:
+      models = self._BuildModels(json, new_from_json_dict, is_list)
+      self._object_cache.Set(key, (json, new_from_json_dict, models))
+    if is_list:
+      return list(models)
+    return models
+
+  def _BuildModels(self, json, new_from_json_dict, is_list):
+    data = self._json_codec.Decode(json)
+    if is_list:
+      return [new_from_json_dict(x) for x in data]
+    return new_from_json_dict(data)
+
+  def _FetchTimelineFrame(self, url, parameters):
+    '''Fetch a GET request for a timeline and return a TimelineFrame.
+
+    The frame is kept in the object cache like other models, and shared
+    between calls that use different status classes.
+    '''
+    frame = self._FetchModels(url, parameters, TimelineFrame.NewFromJsonList,
+                              is_list=False)
+    return frame._WithStatusClass(self._status_class)
+
+  def _IterUrl(self, url, parameters, new_from_json_dict):
+    '''Open a URL returning a JSON array and iterate over its elements.
+
+    The request is made right away, so errors are raised by the call
+    rather than by the first step of the iteration.
+
+    Args:
+      url: The URL to retrieve
+      parameters: A dict of key/value pairs for the query string
+      new_from_json_dict: The function that builds a model from a JSON dict
+
+    Returns:
+      An iterator over new_from_json_dict(element) for each element
+    '''
+    response = self._StreamUrl(url, parameters)
+    def Iterate():
+      try:
+        for data in _IterJsonArray(response, codec=self._json_codec):
+          yield new_from_json_dict(data)
+      finally:
+        response.close()
+    return Iterate()
+
+  def _GetCacheKey(self, url):
+    # Unique keys are a combination of the url and the username.  The url
+    # is canonicalized so the order of its parameters doesn't matter.
+    url = _CanonicalizeUrl(url)
+    if self._username:
+      return self._username + ':' + url
+    else:
+      return url
+
+  def _ReadUrl(self, opener, url):
+    return self._DownloadUrl(opener, url)[1]
+
+  def _RefreshCache(self, opener, url, key, endpoint, last_cached):
+    '''Fetch a URL and store the response in the cache.
+
+    If the expired entry came with an ETag or Last-Modified validator the
+    request is made conditional, and a 304 Not Modified response just
+    renews the cached entry.  While the circuit breaker is open, or the
+    rate governor is out of tokens in NONBLOCK mode, the expired entry is
+    returned as is.
+
+    Returns:
+      A string containing the body of the response.
+    '''
+    validators = None
+    if last_cached:
+      validators = self._GetValidators(key, endpoint)
+    headers = []
+    if validators:
+      if 'ETag' in validators:
+        headers.append(('If-None-Match', validators['ETag']))
+      if 'Last-Modified' in validators:
+        headers.append(('If-Modified-Since', validators['Last-Modified']))
+    try:
+      response, url_data = self._DownloadUrl(opener, url, headers)
+    except (TwitterRateLimitError, TwitterUnavailableError), e:
+      if last_cached and (isinstance(e, TwitterUnavailableError) or
+                          self._rate_governor.GetMode() == RateGovernor.NONBLOCK):
+        url_data = self._ReadCache(key, endpoint)
+        if url_data is not None:
+          self._CountCache(endpoint, 'stale_hits')
+          return url_data
+      raise
+    except urllib2.HTTPError, e:
+      if e.code != 304 or not validators:
+        raise
+      url_data = self._ReadCache(key, endpoint)
+      if url_data is not None:
+        self._TouchCache(key, endpoint)
+        return url_data
+      # The entry vanished while we were revalidating it; fetch it again
+      self._RemoveCache(key + Api._VALIDATORS_SUFFIX, endpoint)
+      return self._RefreshCache(opener, url, key, endpoint, None)
+    if self._cache_compressed and isinstance(response, _DecodingReader) \
+       and response.encoding == 'gzip':
+      self._WriteCache(key, endpoint, response.GetRawData())
+    else:
+      self._WriteCache(key, endpoint, url_data)
+    self._SetValidators(key, endpoint, response)
+    return url_data
+
+  def _DownloadUrl(self, opener, url, headers=None):
+    '''Open and read a URL without post data.
+
+    Transient failures are retried according to the retry policy, and no
+    request is made while the circuit breaker is open.
+
+    Args:
+      opener: The opener to use
+      url: The URL to retrieve
+      headers: A list of (name, value) headers to add to the request [optional]
+
+    Returns:
+      A (response, body) tuple
+    '''
+    breaker = self._circuit_breaker
+    policy = self._retry_policy
+    start = time.time()
+    attempt = 0
+    base_headers = opener.addheaders
+    if headers:
+      opener.addheaders = base_headers + headers
+    try:
+      while True:
+        if breaker and not breaker.Allow():
+          raise TwitterUnavailableError(
+              'Not calling %s while the circuit breaker is open' % url)
+        attempt += 1
+        try:
+          response = self._OpenUrl(opener, url, None)
+          url_data = response.read()
+        except Exception, e:
+          if not RetryPolicy.IsTransient(e):
+            if breaker and not isinstance(e, TwitterError):
+              breaker.RecordSuccess()
+            raise
+          if breaker:
+            breaker.RecordFailure()
+          delay = None
+          if policy:
+            delay = policy.GetDelay(attempt, time.time() - start)
+          if delay is None:
+            raise
+          policy.Sleep(delay)
+        else:
+          if breaker:
+            breaker.RecordSuccess()
+          return response, url_data
+    finally:
+      opener.addheaders = base_headers
+
+  def _RefreshCacheInBackground(self, opener, url, key, endpoint, last_cached,
+                                cache_timeout):
+    '''Schedule a refresh of a cache entry, unless one is already running.'''
+    self._refreshing_lock.acquire()
+    try:
+      if key in self._refreshing:
+        return
+      self._refreshing.add(key)
+    finally:
+      self._refreshing_lock.release()
+    try:
+      self._refresh_executor.Submit(self._RunBackgroundRefresh,
+                                    opener, url, key, endpoint, last_cached,
+                                    cache_timeout)
+    except:
+      self._FinishBackgroundRefresh(key)
+      raise
+
+  def _RunBackgroundRefresh(self, opener, url, key, endpoint, last_cached,
+                            cache_timeout):
+    # Foreground callers that miss on the same key share this refresh.
+    # Failures leave the stale entry in place for the next caller to retry.
+    try:
+      return self._DoOnce(key, self._RefreshSharedCache,
+                          opener, url, key, endpoint, last_cached,
+                          cache_timeout)
+    finally:
+      self._FinishBackgroundRefresh(key)
+
+  def _FinishBackgroundRefresh(self, key):
+    self._refreshing_lock.acquire()
+    try:
+      self._refreshing.discard(key)
+    finally:
+      self._refreshing_lock.release()
+
+  def _RefreshSharedCache(self, opener, url, key, endpoint, last_cached,
+                          cache_timeout):
+    '''Refresh a cache entry, holding the cache's lock for it if it has one.
+
+    Other processes sharing the cache wait for the lock and then find the
+    entry already refreshed, rather than each fetching it again.  If the
+    lock is not released in time, the entry is fetched without it.
+    '''
+    lock = None
+    if hasattr(self._cache, 'GetLock'):
+      lock = self._cache.GetLock(key)
+    if lock is None or not lock.Acquire():
+      return self._RefreshCache(opener, url, key, endpoint, last_cached)
+    try:
+      last_cached = self._GetCachedTime(key, endpoint)
+      if last_cached and time.time() < last_cached + cache_timeout:
+        url_data = self._ReadCache(key, endpoint)
+        if url_data is not None:
+          return url_data
+      return self._RefreshCache(opener, url, key, endpoint, last_cached)
+    finally:
+      lock.Release()
+
+  def _ReadCache(self, key, endpoint):
+    '''Return the data of a cache entry, or None if it is missing or corrupt.
+
+    Corrupt entries are removed, along with their validators, so the
+    caller fetches them again.
+    '''
+    url_data = self._GetCache(key, endpoint)
+    if url_data and url_data.startswith(_GZIP_MAGIC):
+      try:
+        url_data = zlib.decompress(url_data, 16 + zlib.MAX_WBITS)
+      except zlib.error:
+        self._RemoveCache(key, endpoint)
+        self._RemoveCache(key + Api._VALIDATORS_SUFFIX, endpoint)
+        return None
+    return url_data
+
+  def _TouchCache(self, key, endpoint):
+    if hasattr(self._cache, 'Touch'):
+      start = time.time()
+      self._cache.Touch(key)
+      self._CountCacheIo(endpoint, start)
+    else:
+      self._WriteCache(key, endpoint, self._GetCache(key, endpoint))
+
+  # The cache is only accessed through the following methods, which keep
+  # the cache statistics
+
+  def _GetCache(self, key, endpoint):
+    start = time.time()
+    data = self._cache.Get(key)
+    self._CountCacheIo(endpoint, start, 'bytes_read', data)
+    return data
+
+  def _WriteCache(self, key, endpoint, data):
+    start = time.time()
+    self._cache.Set(key, data)
+    self._CountCacheIo(endpoint, start, 'bytes_written', data)
+    self._CountCache(endpoint, 'sets')
+
+  def _RemoveCache(self, key, endpoint):
+    start = time.time()
+    self._cache.Remove(key)
+    self._CountCacheIo(endpoint, start)
+
+  def _GetCachedTime(self, key, endpoint):
+    start = time.time()
+    cached_time = self._cache.GetCachedTime(key)
+    self._CountCacheIo(endpoint, start)
+    return cached_time
+
+  def _CountCache(self, endpoint, counter):
+    if self._cache_stats is not None:
+      self._cache_stats.Add(counter, endpoint=endpoint)
+
+  def _CountCacheIo(self, endpoint, start, counter=None, data=None):
+    '''Record the time since start spent on cache I/O, and bytes of data.'''
+    if self._cache_stats is None:
+      return
+    self._cache_stats.AddIoTime(time.time() - start, endpoint=endpoint)
+    if data:
+      self._cache_stats.Add(counter, len(data), endpoint=endpoint)
+
+  def _GetValidators(self, key, endpoint):
+    '''Return the validators stored alongside a cache entry, or None.'''
+    data = self._GetCache(key + Api._VALIDATORS_SUFFIX, endpoint)
+    if not data:
+      return None
+    try:
+      return self._json_codec.Decode(data)
+    except ValueError:
+      return None
+
+  def _SetValidators(self, key, endpoint, response):
+    '''Store the ETag and Last-Modified headers of a response for key.'''
+    validators = {}
+    if hasattr(response, 'info'):
+      headers = response.info()
+      for name in ('ETag', 'Last-Modified'):
+        value = headers.get(name)
+        if value:
+          validators[name] = value
+    if validators:
+      self._WriteCache(key + Api._VALIDATORS_SUFFIX, endpoint,
+                       self._json_codec.Encode(validators))
+    else:
+      self._RemoveCache(key + Api._VALIDATORS_SUFFIX, endpoint)
+
+  def _OpenUrl(self, opener, url, encoded_post_data):
+    '''Open a URL, returning a file-like object over the decoded body.
+
+    Bodies sent with a gzip or deflate Content-Encoding are wrapped in a
+    twitterapi._DecodingReader so they are decompressed incrementally.
+    '''
+    if self._rate_governor:
+      family = self._rate_governor.GetFamily(url, encoded_post_data is not None)
+      reserve = getattr(self._prefetching, 'reserve', None)
+      if reserve is None:
+        self._rate_governor.Acquire(self._username, family)
+      elif not self._rate_governor.TryAcquire(self._username, family, reserve):
+        raise _PrefetchReserveError(
+            'Not prefetching %s, to leave %d %s requests for %s' %
+            (url, reserve, family, self._username))
+    response = opener.open(url, encoded_post_data)
+    if not hasattr(response, 'info'):
+      return response
+    encoding = response.info().get('Content-Encoding', '').strip().lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+      return _DecodingReader(response, encoding,
+                             keep_raw=self._cache_compressed)
+    return response
+
+def _GetEndpoint(url):
+  '''Return the name of the API method a URL calls, without its arguments.
+
+  For example, both http://twitter.com/statuses/user_timeline/kesuke.json
+  and http://twitter.com/statuses/user_timeline.json?count=1 map to
+  'statuses/user_timeline'.
+  '''
+  path = urlparse.urlparse(url)[2]
+  path = os.path.splitext(path)[0]
+  return '/'.join([p for p in path.split('/') if p][:2])
+
+
+def _CanonicalizeUrl(url):
+  '''Return a canonical form of a URL, for use in cache keys.
+
+  The scheme and host are lowercased, the fragment is dropped and the
+  query parameters are sorted and consistently encoded, so URLs that only
+  differ in the order or quoting of their parameters map to the same key.
+  '''
+  (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+  if query:
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(query, True)))
+  return urlparse.urlunparse((scheme.lower(), netloc.lower(), path, params,
+                              query, ''))
+
+
+class CacheStats(object):
+  '''Thread-safe counters of cache use, in total and per endpoint.
+
+  The counters are:
+
+    hits:          lookups answered with a fresh entry
+    misses:        lookups of missing or expired entries
+    stale_hits:    lookups answered with an expired entry
+    sets:          entries written
+    evictions:     entries removed to bound the cache, or as expired
+    bytes_read:    bytes of cached data read
+    bytes_written: bytes of data written to the cache
+    io_time:       seconds spent reading and writing the cache
+
+  The time taken by each cache operation is also counted in a histogram,
+  'io_time_histogram', whose buckets count the operations that took up to
+  each of CacheStats.IO_TIME_BUCKETS seconds, and finally longer ones.
+
+  Counting takes a lock and a few dictionary updates, so the statistics
+  can be left on in production.
+  '''
+
+  COUNTERS = ('hits', 'misses', 'stale_hits', 'sets', 'evictions',
+              'bytes_read', 'bytes_written', 'io_time')
+
+  # Upper bounds, in seconds, of the io_time_histogram buckets
+  IO_TIME_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._total = CacheStats._NewCounters()
+    self._endpoints = {}
+
+  def Add(self, counter, value=1, endpoint=None):
+    '''Add value to a counter.
+
+    Args:
+      counter: The name of the counter, one of CacheStats.COUNTERS
+      value: The amount to add [optional]
+      endpoint: The endpoint to count it against, besides the total [optional]
+    '''
+    self._lock.acquire()
+    try:
+      self._total[counter] += value
+      if endpoint is not None:
+        self._GetEndpointCounters(endpoint)[counter] += value
+    finally:
+      self._lock.release()
+
+  def AddIoTime(self, seconds, endpoint=None):
+    '''Count one cache operation that took the given number of seconds.'''
+    bucket = bisect.bisect_left(CacheStats.IO_TIME_BUCKETS, seconds)
+    self._lock.acquire()
+    try:
+      counters = [self._total]
+      if endpoint is not None:
+        counters.append(self._GetEndpointCounters(endpoint))
+      for counter in counters:
+        counter['io_time'] += seconds
+        counter['io_time_histogram'][bucket] += 1
+    finally:
+      self._lock.release()
+
+  def Get(self, counter, endpoint=None):
+    '''Return the value of a counter, in total or for one endpoint.'''
+    self._lock.acquire()
+    try:
+      if endpoint is None:
+        return self._total[counter]
+      if endpoint not in self._endpoints:
+        return CacheStats._NewCounters()[counter]
+      return self._endpoints[endpoint][counter]
+    finally:
+      self._lock.release()
+
+  def GetSnapshot(self, reset=False):
+    '''Return a copy of every counter.
+
+    Args:
+      reset: If true, also reset the counters, atomically. [optional]
+
+    Returns:
+      A dict with a 'total' dict of counters, and an 'endpoints' dict
+      mapping each endpoint name to a dict of its counters
+    '''
+    self._lock.acquire()
+    try:
+      snapshot = {
+        'total': CacheStats._CopyCounters(self._total),
+        'endpoints': dict([(endpoint, CacheStats._CopyCounters(counters))
+                           for endpoint, counters in self._endpoints.items()])
+      }
+      if reset:
+        self._total = CacheStats._NewCounters()
+        self._endpoints = {}
+      return snapshot
+    finally:
+      self._lock.release()
+
+  def Reset(self):
+    '''Set every counter back to zero.'''
+    self.GetSnapshot(reset=True)
+
+  def _GetEndpointCounters(self, endpoint):
+    counters = self._endpoints.get(endpoint)
+    if counters is None:
+      counters = self._endpoints[endpoint] = CacheStats._NewCounters()
+    return counters
+
+  @staticmethod
+  def _NewCounters():
+    counters = dict([(counter, 0) for counter in CacheStats.COUNTERS])
+    counters['io_time'] = 0.0
+    counters['io_time_histogram'] = [0] * (len(CacheStats.IO_TIME_BUCKETS) + 1)
+    return counters
+
+  @staticmethod
+  def _CopyCounters(counters):
+    counters = dict(counters)
+    counters['io_time_histogram'] = list(counters['io_time_histogram'])
+    return counters
+
+
+class CachePolicy(object):
+  '''How long twitterapi.Api reuses cached responses, per endpoint.
+
+  Endpoints are named as in twitterapi.RateGovernor, by the first two
+  components of the URL path, such as 'users/show' for
+  http://twitter.com/users/show/dewitt.json.  Endpoints without a timeout
+  of their own use the default timeout.  By default user profiles and the
+  featured users list are cached for an hour, and the endpoints that
+  change data are never cached, whatever the default timeout.
+  '''
+
+  NEVER = 0
+
+  # Cache timeouts in seconds for endpoints that differ from the default
+  DEFAULT_TIMEOUTS = {
+    'users/show': 3600,
+    'statuses/featured': 3600,
+    'statuses/update': NEVER,
+    'statuses/destroy': NEVER,
+    'direct_messages/new': NEVER,
+    'direct_messages/destroy': NEVER,
+    'friendships/create': NEVER,
+    'friendships/destroy': NEVER,
+    'favorites/create': NEVER,
+    'favorites/destroy': NEVER,
+  }
+
+  def __init__(self, default_timeout=None, timeouts=None):
+    '''Instantiate a new twitterapi.CachePolicy object.
+
+    Args:
+      default_timeout:
+        The number of seconds responses of endpoints without a timeout of
+        their own are reused.  Defaults to Api.DEFAULT_CACHE_TIMEOUT.
+        [optional]
+      timeouts:
+        A dict mapping endpoint names to timeouts in seconds.  Defaults to
+        CachePolicy.DEFAULT_TIMEOUTS. [optional]
+    '''
+    if default_timeout is None:
+      default_timeout = Api.DEFAULT_CACHE_TIMEOUT
+    if timeouts is None:
+      timeouts = CachePolicy.DEFAULT_TIMEOUTS
+    self._default_timeout = default_timeout
+    self._timeouts = dict(timeouts)
+
+  def SetDefaultTimeout(self, timeout):
+    self._default_timeout = timeout
+
+  def GetDefaultTimeout(self):
+    return self._default_timeout
+
+  def SetAllTimeouts(self, timeout):
+    '''Use one timeout for every endpoint that may be cached.
+
+    The default timeout is set to timeout, and the timeouts of individual
+    endpoints are dropped, except for those that are never cached.
+
+    Args:
+      timeout: The number of seconds responses are reused
+    '''
+    self._default_timeout = timeout
+    self._timeouts = dict([(endpoint, t) for endpoint, t in self._timeouts.items()
+                           if t == CachePolicy.NEVER])
+
+  def SetTimeout(self, endpoint, timeout):
+    '''Set the cache timeout of an endpoint.
+
+    Args:
+      endpoint: The endpoint name, e.g. 'users/show'
+      timeout:
+        The number of seconds its responses are reused, CachePolicy.NEVER
+        to never cache them, or None to use the default timeout.
+    '''
+    if timeout is None:
+      self._timeouts.pop(endpoint, None)
+    else:
+      self._timeouts[endpoint] = timeout
+
+  def GetTimeout(self, url):
+    '''Return the number of seconds the response to a URL may be reused.'''
+    return self.GetEndpointTimeout(_GetEndpoint(url))
+
+  def GetEndpointTimeout(self, endpoint):
+    '''Return the number of seconds responses of an endpoint may be reused.'''
+    return self._timeouts.get(endpoint, self._default_timeout)
+
+
+class RateGovernor(object):
+  '''Client-side request rate limits, per account and endpoint family.
+
+  Each (username, family) pair draws from its own token bucket holding up
+  to `requests` tokens and refilling at `requests` per `period` seconds.
+  The families are:
+
+    timelines:       statuses/*_timeline, statuses/show, statuses/replies
+    users:           users/show, statuses/friends, followers and featured
+    direct_messages: direct_messages
+    writes:          every request that POSTs data
+
+  Requests to other endpoints are not limited unless a limit is set for
+  the 'other' family.
+
+  When a bucket is empty the governor acts according to its mode:
+
+    RateGovernor.BLOCK:    wait for a token, for at most `timeout` seconds
+    RateGovernor.NONBLOCK: never wait; twitterapi.Api serves a stale cached
+                           response if it has one and raises otherwise
+    RateGovernor.RAISE:    raise twitterapi.TwitterRateLimitError at once
+  '''
+
+  BLOCK = 'block'
+  NONBLOCK = 'nonblock'
+  RAISE = 'raise'
+
+  # (requests, period in seconds) for each endpoint family
+  DEFAULT_LIMITS = {
+    'timelines': (150, 3600),
+    'users': (150, 3600),
+    'direct_messages': (150, 3600),
+    'writes': (1000, 86400),
+  }
+
+  _FAMILIES = {
+    'statuses/public_timeline': 'timelines',
+    'statuses/friends_timeline': 'timelines',
+    'statuses/user_timeline': 'timelines',
+    'statuses/show': 'timelines',
+    'statuses/replies': 'timelines',
+    'statuses/friends': 'users',
+    'statuses/followers': 'users',
+    'statuses/featured': 'users',
+    'users/show': 'users',
+    'direct_messages': 'direct_messages',
+  }
+
+  def __init__(self, limits=None, mode=BLOCK, timeout=None):
+    '''Instantiate a new twitterapi.RateGovernor object.
+
+    Args:
+      limits:
+        A dict mapping endpoint families to (requests, period) tuples.
+        Defaults to RateGovernor.DEFAULT_LIMITS. [optional]
+      mode:
+        One of RateGovernor.BLOCK, RateGovernor.NONBLOCK or
+        RateGovernor.RAISE.  Defaults to BLOCK. [optional]
+      timeout:
+        In BLOCK mode, the longest to wait for a token before raising
+        twitterapi.TwitterRateLimitError.  Waits forever if None. [optional]
+    '''
+    if limits is None:
+      limits = RateGovernor.DEFAULT_LIMITS
+    self._limits = dict(limits)
+    self._user_limits = {}
+    self._buckets = {}
+    self._lock = threading.Lock()
+    self.SetMode(mode, timeout)
+
+  def SetMode(self, mode, timeout=None):
+    '''Set what happens when a request is over its limit.
+
+    Args:
+      mode: One of RateGovernor.BLOCK, NONBLOCK or RAISE
+      timeout: The longest to wait for a token in BLOCK mode [optional]
+    '''
+    if mode not in (RateGovernor.BLOCK, RateGovernor.NONBLOCK,
+                    RateGovernor.RAISE):
+      raise TwitterError('Unknown rate governor mode %r' % mode)
+    self._mode = mode
+    self._timeout = timeout
+
+  def GetMode(self):
+    return self._mode
+
+  def SetLimit(self, family, requests, period, username=None):
+    '''Set the limit for an endpoint family.
+
+    Args:
+      family: The endpoint family, e.g. 'timelines'
+      requests: The number of requests allowed per period
+      period: The length of the period, in seconds
+      username:
+        If set, the limit applies only to this account, otherwise it
+        applies to every account without a limit of its own. [optional]
+    '''
+    self._lock.acquire()
+    try:
+      if username is None:
+        self._limits[family] = (requests, period)
+        for (bucket_username, bucket_family) in self._buckets.keys():
+          if bucket_family == family and \
+             (bucket_username, family) not in self._user_limits:
+            del self._buckets[(bucket_username, family)]
+      else:
+        self._user_limits[(username, family)] = (requests, period)
+        self._buckets.pop((username, family), None)
+    finally:
+      self._lock.release()
+
+  def GetFamily(self, url, write=False):
+    '''Return the endpoint family a request belongs to.
+
+    Args:
+      url: The URL being requested
+      write: True if the request POSTs data [optional]
+    '''
+    if write:
+      return 'writes'
+    return RateGovernor._FAMILIES.get(_GetEndpoint(url), 'other')
+
+  def Acquire(self, username, family):
+    '''Take a token for one request, waiting if the mode allows it.
+
+    Raises:
+      twitterapi.TwitterRateLimitError if no token could be taken
+    '''
+    deadline = None
+    if self._timeout is not None:
+      deadline = time.time() + self._timeout
+    while True:
+      self._lock.acquire()
+      try:
+        bucket = self._GetBucket(username, family)
+        if bucket is None:
+          return
+        wait = bucket.Take()
+      finally:
+        self._lock.release()
+      if wait <= 0:
+        return
+      if self._mode != RateGovernor.BLOCK or \
+         (deadline is not None and time.time() + wait > deadline):
+        raise TwitterRateLimitError(
+            'Rate limit for %s requests by %s exceeded; next request '
+            'allowed in %.1f seconds' % (family, username, wait))
+      time.sleep(wait)
+
+  def TryAcquire(self, username, family, reserve=0):
+    '''Take a token for one request if one is available, without waiting.
+
+    Args:
+      username: The account making the request
+      family: The endpoint family of the request
+      reserve:
+        The number of tokens to leave in the bucket for other
+        requests. [optional]
+
+    Returns:
+      True if a token was taken or the family is not limited, else False
+    '''
+    self._lock.acquire()
+    try:
+      bucket = self._GetBucket(username, family)
+      return bucket is None or bucket.Take(reserve) <= 0
+    finally:
+      self._lock.release()
+
+  def GetBudget(self, username, family):
+    '''Return the current budget of an account for an endpoint family.
+
+    Returns:
+      A dict with the 'remaining' number of requests that can be made
+      right away, the 'limit' and 'period' of the bucket and 'next_in',
+      the number of seconds until another request is allowed (0 if one
+      is allowed now); or None if the family is not limited.
+    '''
+    self._lock.acquire()
+    try:
+      bucket = self._GetBucket(username, family)
+      if bucket is None:
+        return None
+      return bucket.GetBudget()
+    finally:
+      self._lock.release()
+
+  def GetBudgets(self, username):
+    '''Return a dict of GetBudget results for every limited family.'''
+    families = set(self._limits.keys())
+    families.update([f for (u, f) in self._user_limits.keys() if u == username])
+    budgets = {}
+    for family in families:
+      budgets[family] = self.GetBudget(username, family)
+    return budgets
+
+  def _GetBucket(self, username, family):
+    key = (username, family)
+    bucket = self._buckets.get(key)
+    if bucket is None:
+      limit = self._user_limits.get(key, self._limits.get(family))
+      if limit is None:
+        return None
+      bucket = self._buckets[key] = _TokenBucket(*limit)
+    return bucket
+
+
+class _TokenBucket(object):
+  '''A bucket of up to `requests` tokens, refilled evenly over `period`.'''
+
+  def __init__(self, requests, period):
+    self._requests = requests
+    self._period = period
+    self._rate = float(requests) / period
+    self._tokens = float(requests)
+    self._updated = time.time()
+
+  def Take(self, reserve=0):
+    '''Take a token if one is available beyond the reserve.
+
+    Args:
+      reserve: The number of tokens that must be left in the bucket [optional]
+
+    Returns:
+      0 if a token was taken, otherwise the seconds until one is available
+    '''
+    self._Refill()
+    if self._tokens >= 1 + reserve:
+      self._tokens -= 1
+      return 0
+    return (1 + reserve - self._tokens) / self._rate
+
+  def GetBudget(self):
+    self._Refill()
+    if self._tokens >= 1:
+      next_in = 0
+    else:
+      next_in = (1 - self._tokens) / self._rate
+    return {'remaining': int(self._tokens),
+            'limit': self._requests,
+            'period': self._period,
+            'next_in': next_in}
+
+  def _Refill(self):
+    now = time.time()
+    self._tokens = min(self._requests,
+                       self._tokens + (now - self._updated) * self._rate)
+    self._updated = now
+
+
+class RetryPolicy(object):
+  '''How often, and how patiently, to retry requests that failed transiently.
+
+  Transient failures are socket and HTTP protocol errors and 5xx responses.
+  The delay before retry n is drawn uniformly between 0 and
+  min(max_delay, base_delay * 2 ** (n - 1)) ("full jitter"), or is exactly
+  that upper bound if jitter is False.  No retry is made once max_attempts
+  requests have been made, or if it would end after max_elapsed seconds.
+  '''
+
+  DEFAULT_MAX_ATTEMPTS = 3
+  DEFAULT_BASE_DELAY = 0.5 # seconds
+  DEFAULT_MAX_DELAY = 10 # seconds
+  DEFAULT_MAX_ELAPSED = 30 # seconds
+
+  def __init__(self,
+               max_attempts=DEFAULT_MAX_ATTEMPTS,
+               base_delay=DEFAULT_BASE_DELAY,
+               max_delay=DEFAULT_MAX_DELAY,
+               max_elapsed=DEFAULT_MAX_ELAPSED,
+               jitter=True,
+               sleep=time.sleep):
+    '''Instantiate a new twitterapi.RetryPolicy object.
+
+    Args:
+      max_attempts: The maximum number of requests to make. [optional]
+      base_delay: The delay bound for the first retry, in seconds. [optional]
+      max_delay: The largest delay bound, in seconds. [optional]
+      max_elapsed:
+        The longest time, in seconds, to keep retrying a request. [optional]
+      jitter: If true, randomize the delays. [optional]
+      sleep: The function used to wait between attempts. [optional]
+    '''
+    self._max_attempts = max_attempts
+    self._base_delay = base_delay
+    self._max_delay = max_delay
+    self._max_elapsed = max_elapsed
+    self._jitter = jitter
+    self._sleep = sleep
+
+  @staticmethod
+  def IsTransient(error):
+    '''Return True if an exception raised by a request is worth retrying.'''
+    if isinstance(error, urllib2.HTTPError):
+      return error.code >= 500
+    return isinstance(error, (urllib2.URLError, socket.error,
+                              httplib.HTTPException))
+
+  def GetDelay(self, attempt, elapsed):
+    '''Return the delay before the next attempt, or None to give up.
+
+    Args:
+      attempt: The number of attempts made so far
+      elapsed: The seconds elapsed since the first attempt
+    '''
+    if attempt >= self._max_attempts:
+      return None
+    delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+    if self._jitter:
+      delay = random.uniform(0, delay)
+    if self._max_elapsed is not None and elapsed + delay > self._max_elapsed:
+      return None
+    return delay
+
+  def Sleep(self, delay):
+    self._sleep(delay)
+
+
+class CircuitBreaker(object):
+  '''Stops requests to an upstream that keeps failing.
+
+  The breaker opens after failure_threshold consecutive transient failures.
+  While open it refuses requests; after reset_timeout seconds it lets a
+  single trial request through, and closes again if that one succeeds.
+  '''
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  DEFAULT_FAILURE_THRESHOLD = 5
+  DEFAULT_RESET_TIMEOUT = 30 # seconds
+
+  def __init__(self,
+               failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+               reset_timeout=DEFAULT_RESET_TIMEOUT):
+    self._failure_threshold = failure_threshold
+    self._reset_timeout = reset_timeout
+    self._lock = threading.Lock()
+    self._state = CircuitBreaker.CLOSED
+    self._failures = 0
+    self._opened_at = None
+    self._trial_started = None
+
+  def GetState(self):
+    '''Return CircuitBreaker.CLOSED, OPEN or HALF_OPEN.'''
+    return self._state
+
+  def Allow(self):
+    '''Return True if a request may be made now.'''
+    self._lock.acquire()
+    try:
+      now = time.time()
+      if self._state == CircuitBreaker.CLOSED:
+        return True
+      if self._state == CircuitBreaker.OPEN:
+        if now < self._opened_at + self._reset_timeout:
+          return False
+        self._state = CircuitBreaker.HALF_OPEN
+        self._trial_started = now
+        return True
+      # Half open: one trial at a time, unless the trial has been lost
+      if now >= self._trial_started + self._reset_timeout:
+        self._trial_started = now
+        return True
+      return False
+    finally:
+      self._lock.release()
+
+  def RecordSuccess(self):
+    self._lock.acquire()
+    try:
+      self._state = CircuitBreaker.CLOSED
+      self._failures = 0
+    finally:
+      self._lock.release()
+
+  def RecordFailure(self):
+    self._lock.acquire()
+    try:
+      self._failures += 1
+      if self._state == CircuitBreaker.HALF_OPEN or \
+         self._failures >= self._failure_threshold:
+        self._state = CircuitBreaker.OPEN
+        self._opened_at = time.time()
+    finally:
+      self._lock.release()
+
+
+class AsyncApi(object):
+  '''A twitterapi.Api whose endpoints run in the background.
+
+  Every endpoint of twitterapi.Api (GetPublicTimeline, GetUser, PostUpdate,
+  and so on) is available with the same arguments, but returns a
+  twitterapi.Future immediately instead of blocking on the network.  The
+  calls themselves are made by a wrapped twitterapi.Api instance, so URL
+  building, parameter encoding, caching and model construction are shared
+  with the synchronous interface.  All other methods, such as
+  SetCredentials or SetCache, are passed straight through.
+
+  Example usage:
+
+    >>> api = twitterapi.AsyncApi()
+    >>> timeline = api.GetUserTimeline('dewitt')
+    >>> user = api.GetUser('kesuke')
+    >>> print [s.text for s in timeline.Result()]
+    >>> print user.Result().name
+
+  The calls run on an executor, by default a twitterapi._WorkerPool of
+  max_workers threads.  Any object with a Submit(callable, *args, **kwargs)
+  method returning a twitterapi.Future can take its place, and the network
+  transport can still be replaced with SetUrllib.
+  '''
+
+  DEFAULT_MAX_WORKERS = 8
+
+  _ENDPOINTS = frozenset([
+    'GetPublicTimeline',
+    'GetFriendsTimeline',
+    'GetUserTimeline',
+    'GetStatus',
+    'GetStatuses',
+    'DestroyStatus',
+    'PostUpdate',
+    'GetReplies',
+    'GetFriends',
+    'GetFollowers',
+    'GetFeatured',
+    'GetUser',
+    'GetUsers',
+    'GetDirectMessages',
+    'PostDirectMessage',
+    'DestroyDirectMessage',
+    'CreateFriendship',
+    'DestroyFriendship',
+    'CreateFavorite',
+    'DestroyFavorite',
+    'GetPublicTimelineFrame',
+    'GetFriendsTimelineFrame',
+    'GetUserTimelineFrame',
+    'GetRepliesFrame',
+  ])
+
+  def __init__(self,
+               username=None,
+               password=None,
+               input_encoding=None,
+               request_headers=None,
+               api=None,
+               executor=None,
+               max_workers=None):
+    '''Instantiate a new twitterapi.AsyncApi object.
+
+    Args:
+      username: The username of the twitter account.  [optional]
+      password: The password for the twitter account. [optional]
+      input_encoding: The encoding used to encode input strings. [optional]
+      request_header: A dictionary of additional HTTP request headers. [optional]
+      api:
+        An existing twitterapi.Api instance to make the calls with.  If set,
+        the other Api arguments are ignored. [optional]
+      executor:
+        An object whose Submit method runs calls in the background.
+        Defaults to a twitterapi._WorkerPool. [optional]
+      max_workers:
+        The number of threads in the default executor. [optional]
+    '''
+    if api is None:
+      api = Api(username=username,
+                password=password,
+                input_encoding=input_encoding,
+                request_headers=request_headers)
+    if executor is None:
+      executor = _WorkerPool(max_workers or AsyncApi.DEFAULT_MAX_WORKERS)
+    self._api = api
+    self._executor = executor
+
+  def __getattr__(self, name):
+    attr = getattr(self._api, name)
+    if name not in AsyncApi._ENDPOINTS:
+      return attr
+    def Submit(*args, **kwargs):
+      return self._executor.Submit(attr, *args, **kwargs)
+    Submit.__name__ = name
+    Submit.__doc__ = attr.__doc__
+    return Submit
+
+  def GetApi(self):
+    '''Return the synchronous twitterapi.Api instance making the calls.'''
+    return self._api
+
+  def Close(self):
+    '''Stop the default executor once the pending calls have finished.'''
+    if hasattr(self._executor, 'Shutdown'):
+      self._executor.Shutdown()
+
+def _IterJsonArray(fp, chunk_size=16 * 1024, codec=None):
+  '''Yield the elements of a JSON array as they are read from fp.
+
+  Only as much of the document as is needed to decode the next element is
+  kept in memory.
+
+  Args:
+    fp: A file-like object positioned at the start of a JSON array
+    chunk_size: The number of bytes to read at a time [optional]
+    codec: The twitterapi.JsonCodec to decode elements with [optional]
+
+  Raises:
+    ValueError if the document is not a JSON array, or is truncated
+  '''
+  if codec is None:
+    codec = _DEFAULT_JSON_CODEC
+  buffer = ''
+  pos = 0
+  eof = False
+  started = False
+  scan = None
+  while True:
+    while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+      pos += 1
+    if pos < len(buffer):
+      c = buffer[pos]
+      if not started:
+        if c != '[':
+          raise ValueError('Expected a JSON array, found %r' % c)
+        started = True
+        pos += 1
+        continue
+      if c == ']':
+        return
+      if c == ',':
+        pos += 1
+        continue
+      if c in '{["':
+        # Only decode objects, arrays and strings once they are complete,
+        # rather than retrying the whole element after every chunk
+        if scan is None:
+          scan, depth, in_string = pos, 0, False
+        end, scan, depth, in_string = _ScanJsonValue(buffer, scan, depth,
+                                                     in_string)
+        if end >= 0:
+          # The element is complete, so the codec's decoder can have it
+          yield codec.Decode(buffer[pos:end])
+          pos = end
+          scan = None
+          continue
+        if eof:
+          raise ValueError('Unexpected end of JSON array')
+      else:
+        try:
+          data, end = codec.RawDecode(buffer, pos)
+        except ValueError:
+          if eof:
+            raise
+        else:
+          # A value running up to the end of the buffer, such as a number,
+          # may continue in the next chunk
+          if end < len(buffer) or eof:
+            yield data
+            pos = end
+            continue
+    elif eof:
+      raise ValueError('Unexpected end of JSON array')
+    # Drop what has been consumed and read some more
+    chunk = fp.read(chunk_size)
+    if not chunk:
+      eof = True
+    buffer = buffer[pos:] + chunk
+    if scan is not None:
+      scan -= pos
+    pos = 0
+
+_JSON_STRING_SPECIAL = re.compile(r'["\\]')
+_JSON_STRUCTURE = re.compile(r'["{}\[\]]')
+
+def _ScanJsonValue(buffer, scan, depth, in_string):
+  '''Scan buffer for the end of a JSON object, array or string.
+
+  The scan resumes from the state returned by the previous call, so a
+  value that spans several chunks is only scanned once.
+
+  Args:
+    buffer: The data read so far
+    scan: The index to resume scanning from
+    depth: The number of objects and arrays open at scan
+    in_string: True if scan is inside a string
+  Returns:
+    An (end, scan, depth, in_string) tuple.  end is the index just past
+    the value, or -1 if it continues beyond the buffer.
+  '''
+  while True:
+    if in_string:
+      match = _JSON_STRING_SPECIAL.search(buffer, scan)
+      if match is None:
+        return -1, len(buffer), depth, True
+      i = match.start()
+      if buffer[i] == '\\':
+        if i + 1 == len(buffer):
+          return -1, i, depth, True
+        scan = i + 2
+        continue
+      in_string = False
+      scan = i + 1
+      if depth == 0:
+        return scan, scan, depth, False
+    else:
+      match = _JSON_STRUCTURE.search(buffer, scan)
+      if match is None:
+        return -1, len(buffer), depth, False
+      c = buffer[match.start()]
+      scan = match.start() + 1
+      if c == '"':
+        in_string = True
+      elif c in '{[':
+        depth += 1
+      else:
+        depth -= 1
+        if depth == 0:
+          return scan, scan, depth, False
+
+_GZIP_MAGIC = '\x1f\x8b'
+
+class _DecodingReader(object):
+  '''A file-like object that decompresses a gzip or deflate body as it is read.
+
+  The underlying response is read in CHUNK_SIZE pieces, so the compressed
+  body is never held in memory all at once unless keep_raw is set.
+  '''
+
+  CHUNK_SIZE = 16 * 1024
+
+  def __init__(self, fp, encoding, keep_raw=False):
+    if encoding == 'x-gzip':
+      encoding = 'gzip'
+    self.encoding = encoding
+    self._fp = fp
+    if encoding == 'gzip':
+      self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      self._decompressor = zlib.decompressobj()
+    self._started = False
+    self._eof = False
+    self._buffer = ''
+    if keep_raw:
+      self._raw = []
+    else:
+      self._raw = None
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      chunks = [self._buffer]
+      while not self._eof:
+        chunks.append(self._ReadChunk())
+      self._buffer = ''
+      return ''.join(chunks)
+    while not self._eof and len(self._buffer) < size:
+      self._buffer += self._ReadChunk()
+    data, self._buffer = self._buffer[:size], self._buffer[size:]
+    return data
+
+  def close(self):
+    self._fp.close()
+
+  def info(self):
+    return self._fp.info()
+
+  def GetRawData(self):
+    '''Return the compressed bytes read so far, if keep_raw was set.'''
+    if self._raw is None:
+      return None
+    return ''.join(self._raw)
+
+  def _ReadChunk(self):
+    chunk = self._fp.read(_DecodingReader.CHUNK_SIZE)
+    if not chunk:
+      self._eof = True
+      return self._decompressor.flush()
+    if self._raw is not None:
+      self._raw.append(chunk)
+    if not self._started:
+      self._started = True
+      if self.encoding == 'deflate':
+        # Some servers send a raw deflate stream without the zlib header
+        try:
+          return self._decompressor.decompress(chunk)
+        except zlib.error:
+          self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self._decompressor.decompress(chunk)
+
+class _FileCacheError(Exception):
   '''Base exception class for FileCache related errors'''
 
+class _CacheCompressor(object):
+  '''Compresses cache entries so that uncompressed entries stay readable.
+
+  Compressed entries start with a NUL byte followed by a byte naming the
+  codec, which cannot be the start of a JSON or gzip encoded response, so
+  entries written without compression are returned unchanged.  Entries
+  that do not shrink are stored uncompressed.  Caches that do not compress
+  still Escape their entries, so an entry that happens to start with a NUL
+  byte is not mistaken for a compressed one.
+
+  The codec defaults to the first of _CacheCompressor.CODECS that can be
+  imported: lz4 if the lz4 package is installed, otherwise zlib.
+  '''
+
+  CODECS = ('lz4', 'zlib')
+
+  _MARKER = '\x00'
+  _TAGS = {'lz4': 'l', 'zlib': 'z', None: 'r'}
+
+  def __init__(self, codec=None):
+    '''Instantiate a new twitterapi._CacheCompressor object.
+
+    Args:
+      codec: The name of the codec to compress with, 'lz4' or 'zlib' [optional]
+    '''
+    if codec is None:
+      for name in _CacheCompressor.CODECS:
+        if _CacheCompressor._GetCodec(name) is not None:
+          codec = name
+          break
+    elif _CacheCompressor._GetCodec(codec) is None:
+      raise _FileCacheError('The %s codec is not available' % codec)
+    self.codec = codec
+    self._compress = _CacheCompressor._GetCodec(codec)[0]
+    self._tag = _CacheCompressor._MARKER + _CacheCompressor._TAGS[codec]
+    self._lock = threading.Lock()
+    self._bytes_saved = 0
+
+  def Compress(self, data):
+    '''Return the form of data to store in a cache.'''
+    compressed = self._compress(data)
+    if len(compressed) + len(self._tag) < len(data):
+      self._lock.acquire()
+      try:
+        self._bytes_saved += len(data) - len(compressed) - len(self._tag)
+      finally:
+        self._lock.release()
+      return self._tag + compressed
+    return _CacheCompressor.Escape(data)
+
+  @staticmethod
+  def Escape(data):
+    '''Return the form of data to store in a cache without compressing it.'''
+    if data.startswith(_CacheCompressor._MARKER):
+      return _CacheCompressor._MARKER + _CacheCompressor._TAGS[None] + data
+    return data
+
+  @staticmethod
+  def Decompress(data):
+    '''Return the data stored in a cache entry, or None if unreadable.
+
+    An entry is unreadable if it is corrupt, or was compressed with a
+    codec that is not installed.
+    '''
+    if not data or not data.startswith(_CacheCompressor._MARKER):
+      return data
+    tag = data[1:2]
+    if tag == _CacheCompressor._TAGS[None]:
+      return data[2:]
+    for codec in _CacheCompressor.CODECS:
+      if tag == _CacheCompressor._TAGS[codec]:
+        functions = _CacheCompressor._GetCodec(codec)
+        if functions is not None:
+          try:
+            return functions[1](data[2:])
+          except Exception:
+            # zlib.error, or whichever error the lz4 version raises
+            return None
+    return None
+
+  def GetBytesSaved(self):
+    '''Return the number of bytes compression has saved so far.'''
+    return self._bytes_saved
+
+  @staticmethod
+  def _GetCodec(codec):
+    '''Return the (compress, decompress) functions for a codec, or None.'''
+    if codec == 'zlib':
+      return zlib.compress, zlib.decompress
+    if codec == 'lz4':
+      try:
+        import lz4.block
+      except ImportError:
+        return None
+      return lz4.block.compress, lz4.block.decompress
+    return None
+
+
+# The in-process locks of _FileLocks, keyed by lock file path and offset.
+# fcntl locks are held by a process, so these keep the threads of one
+# process, and _FileCaches sharing a directory, from holding one together.
+_FILE_THREAD_LOCKS = {}
+_FILE_THREAD_LOCKS_LOCK = threading.Lock()
+
+
+class _FileLock(object):
+  '''An exclusive lock on one byte of a shared lock file.
+
+  The lock is polled rather than waited on, so that a process that hangs
+  while holding it cannot block the others for longer than their timeout.
+  '''
+
+  DEFAULT_TIMEOUT = 10
+  POLL_INTERVAL = 0.01
+
+  def __init__(self, fd, path, offset):
+    self._fd = fd
+    self._offset = offset
+    self._thread_key = (path, offset)
+    self._thread_lock = None
+
+  def Acquire(self, timeout=None):
+    '''Take the lock, waiting at most timeout seconds.
+
+    Args:
+      timeout:
+        The number of seconds to wait.  Defaults to DEFAULT_TIMEOUT.
+        [optional]
+
+    Returns:
+      True if the lock was taken, or False if the timeout expired first.
+    '''
+    if timeout is None:
+      timeout = _FileLock.DEFAULT_TIMEOUT
+    deadline = time.time() + timeout
+    thread_lock = self._RetainThreadLock()
+    acquired = False
+    try:
+      if self._Poll(lambda: thread_lock.acquire(False), deadline):
+        try:
+          acquired = self._Poll(self._TryLockFile, deadline)
+        finally:
+          if not acquired:
+            thread_lock.release()
+    finally:
+      if not acquired:
+        self._ReleaseThreadLock()
+    if acquired:
+      self._thread_lock = thread_lock
+    return acquired
+
+  def Release(self):
+    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+    thread_lock, self._thread_lock = self._thread_lock, None
+    thread_lock.release()
+    self._ReleaseThreadLock()
+
+  def _Poll(self, try_acquire, deadline):
+    '''Call try_acquire until it returns True or the deadline passes.'''
+    while not try_acquire():
+      if time.time() >= deadline:
+        return False
+      time.sleep(_FileLock.POLL_INTERVAL)
+    return True
+
+  def _TryLockFile(self):
+    try:
+      fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._offset)
+    except IOError, e:
+      if e.errno not in (errno.EACCES, errno.EAGAIN):
+        raise
+      return False
+    return True
+
+  def _RetainThreadLock(self):
+    '''Return the in-process lock for this lock's byte, counting a user.'''
+    _FILE_THREAD_LOCKS_LOCK.acquire()
+    try:
+      entry = _FILE_THREAD_LOCKS.get(self._thread_key)
+      if entry is None:
+        entry = _FILE_THREAD_LOCKS[self._thread_key] = [threading.Lock(), 0]
+      entry[1] += 1
+      return entry[0]
+    finally:
+      _FILE_THREAD_LOCKS_LOCK.release()
+
+  def _ReleaseThreadLock(self):
+    '''Drop a user of the in-process lock, forgetting it once unused.'''
+    _FILE_THREAD_LOCKS_LOCK.acquire()
+    try:
+      entry = _FILE_THREAD_LOCKS[self._thread_key]
+      entry[1] -= 1
+      if not entry[1]:
+        del _FILE_THREAD_LOCKS[self._thread_key]
+    finally:
+      _FILE_THREAD_LOCKS_LOCK.release()
+
+
+def _NewCacheCompressor(compress):
+  '''Return a _CacheCompressor for a cache's compress argument, or None.'''
+  if not compress:
+    return None
+  if compress is True:
+    return _CacheCompressor()
+  return _CacheCompressor(compress)
+
+
 class _FileCache(object):
+  '''A cache that stores each entry as a file under a root directory.
+
+  By default the cache grows without bound.  If max_bytes is set, the
+  least recently read entries are evicted once the files add up to more
+  than max_bytes, down to LOW_WATER_MARK of max_bytes, and if max_age is
+  set, entries written more than max_age seconds ago are removed whenever
+  the cache is swept.  Sweeps run on a background thread when a Set pushes
+  the cache over max_bytes, when Sweep is called, or periodically on a
+  background thread started with StartSweeper.
+
+  If compress is true, entries are compressed on disk; see
+  twitterapi._CacheCompressor.
+
+  Several processes may share a root directory.  Entries are written to a
+  temporary file in their own directory and renamed into place, so readers
+  never see a partly written entry and need no locks.  GetLock returns a
+  lock for refreshing a key that excludes other processes.
+  '''
 
   DEPTH = 3
+  DEFAULT_SWEEP_INTERVAL = 300
+  # The fraction of max_bytes that sweeps evict down to, so that a full
+  # cache is not swept again by the next Set
+  LOW_WATER_MARK = 0.9
 
-  def __init__(self,root_directory=None):
+  # Temporary files older than this are left over from a crashed writer
+  _TEMP_PREFIX = '.tmp'
+  _TEMP_MAX_AGE = 3600
+  _LOCK_FILENAME = '.lock'
+
+  def __init__(self,root_directory=None,max_bytes=None,max_age=None,
+               compress=False):
+    '''Instantiate a new twitterapi._FileCache object.
+
+    Args:
+      root_directory:
+        The directory to store entries in.  Defaults to
+        python.cache_<username> in the temp directory. [optional]
+      max_bytes: The maximum total size of the cached files [optional]
+      max_age: The number of seconds after which entries are swept [optional]
+      compress:
+        True to compress entries with the fastest codec available, or the
+        name of a twitterapi._CacheCompressor codec. [optional]
+    '''
     self._InitializeRootDirectory(root_directory)
+    self._compressor = _NewCacheCompressor(compress)
+    self._max_bytes = max_bytes
+    self._max_age = max_age
+    self._lock = threading.Lock()
+    self._sweep_lock = threading.Lock()
+    # The estimated size of the cache, unknown until the first sweep
+    self._size = None
+    self._sweep_requested = False
+    self._bytes_reclaimed = 0
+    self._sweeper = None
+    self._sweeper_stopped = None
+    self._lock_fd = None
+    self._lock_path = None
+    self._stats = CacheStats()
 
   def Get(self,key):
     path = self._GetPath(key)
-    if os.path.exists(path):
-      return open(path).read()
-    else:
+    try:
+      fp = open(path, 'rb')
+    except IOError:
+      self._stats.Add('misses')
+      return None
+    try:
+      data = fp.read()
+    finally:
+      fp.close()
+    value = _CacheCompressor.Decompress(data)
+    if value is None:
+      # Treat an unreadable entry as a miss, and drop it so that it is not
+      # reported as cached either
+      self._stats.Add('misses')
+      self.Remove(key)
       return None
+    self._stats.Add('hits')
+    self._stats.Add('bytes_read', len(data))
+    if self._max_bytes is not None:
+      # Record the access time explicitly, as many filesystems don't
+      try:
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+      except OSError:
+        pass
+    return value
 
   def Set(self,key,data):
     path = self._GetPath(key)
+    if not path.startswith(self._root_directory):
+      raise _FileCacheError('%s does not appear to live under %s' %
+                            (path, self._root_directory))
     directory = os.path.dirname(path)
     if not os.path.exists(directory):
-      os.makedirs(directory)
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Another process may have created it in the meantime
+        pass
     if not os.path.isdir(directory):
       raise _FileCacheError('%s exists but is not a directory' % directory)
-    temp_fd, temp_path = tempfile.mkstemp()
-    temp_fp = os.fdopen(temp_fd, 'w')
-    temp_fp.write(data)
-    temp_fp.close()
-    if not path.startswith(self._root_directory):
-      raise _FileCacheError('%s does not appear to live under %s' %
-                            (path, self._root_directory))
-    if os.path.exists(path):
-      os.remove(path)
-    os.rename(temp_path, path)
+    if self._compressor is not None:
+      data = self._compressor.Compress(data)
+    else:
+      data = _CacheCompressor.Escape(data)
+    # Write to the same directory, so the rename is atomic
+    temp_fd, temp_path = tempfile.mkstemp(prefix=_FileCache._TEMP_PREFIX,
+                                          dir=directory)
+    try:
+      temp_fp = os.fdopen(temp_fd, 'wb')
+      try:
+        temp_fp.write(data)
+      finally:
+        temp_fp.close()
+      try:
+        replaced_size = os.path.getsize(path)
+      except OSError:
+        replaced_size = 0
+      self._Replace(temp_path, path)
+    except:
+      exc_info = sys.exc_info()
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+      raise exc_info[0], exc_info[1], exc_info[2]
+    self._stats.Add('sets')
+    self._stats.Add('bytes_written', len(data))
+    if self._max_bytes is not None:
+      self._Resize(len(data) - replaced_size)
 
   def Remove(self,key):
     path = self._GetPath(key)
     if not path.startswith(self._root_directory):
       raise _FileCacheError('%s does not appear to live under %s' %
                             (path, self._root_directory ))
-    if os.path.exists(path):
+    try:
+      size = os.path.getsize(path)
       os.remove(path)
+    except OSError:
+      return
+    if self._max_bytes is not None:
+      self._Resize(-size)
+
+  def Touch(self,key):
+    '''Mark an entry as freshly cached without rewriting its data.'''
+    try:
+      os.utime(self._GetPath(key), None)
+    except OSError:
+      pass
 
   def GetCachedTime(self,key):
-    path = self._GetPath(key)
-    if os.path.exists(path):
-      return os.path.getmtime(path)
-    else:
+    try:
+      return os.path.getmtime(self._GetPath(key))
+    except OSError:
+      return None
+
+  def GetLock(self,key):
+    '''Return a lock that other processes and threads must hold to refresh key.
+
+    The locks are byte-range locks on a single lock file in the root
+    directory, so taking one is a single system call, together with an
+    in-process lock for the same byte of the same file.  Acquire gives up
+    after a timeout and returns False, in which case the caller may
+    refresh the key without the lock.
+
+    Returns:
+      A lock with Acquire and Release methods, or None if the platform
+      has no fcntl module.
+    '''
+    if fcntl is None:
       return None
+    self._lock.acquire()
+    try:
+      if self._lock_fd is None:
+        # Closing any descriptor of the file would drop all of this
+        # process's locks on it, so one descriptor is kept open
+        self._lock_path = os.path.realpath(os.path.join(
+            self._root_directory, _FileCache._LOCK_FILENAME))
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT,
+                                0666)
+    finally:
+      self._lock.release()
+    offset = int(md5(key).hexdigest()[:8], 16)
+    return _FileLock(self._lock_fd, self._lock_path, offset)
+
+  def Sweep(self):
+    '''Remove expired entries, then evict entries if over max_bytes.
+
+    Entries are expired if they were written more than max_age seconds
+    ago.  If the rest add up to more than max_bytes, they are evicted in
+    order of the time they were last read until they fit in LOW_WATER_MARK
+    of max_bytes.
+
+    Returns:
+      The number of bytes reclaimed
+    '''
+    self._sweep_lock.acquire()
+    try:
+      now = time.time()
+      entries = []
+      size = 0
+      reclaimed = 0
+      for directory, directories, filenames in os.walk(self._root_directory):
+        for filename in filenames:
+          path = os.path.join(directory, filename)
+          try:
+            stat = os.stat(path)
+          except OSError:
+            # Removed by another thread or process since the listing
+            continue
+          if filename == _FileCache._LOCK_FILENAME:
+            continue
+          if filename.startswith(_FileCache._TEMP_PREFIX):
+            if stat.st_mtime + _FileCache._TEMP_MAX_AGE <= now:
+              reclaimed += self._RemovePath(path, stat.st_size)
+            continue
+          if self._max_age is not None and \
+             stat.st_mtime + self._max_age <= now:
+            reclaimed += self._EvictPath(path, stat.st_size)
+          else:
+            entries.append((stat.st_atime, stat.st_size, path))
+            size += stat.st_size
+      if self._max_bytes is not None and size > self._max_bytes:
+        target = self._max_bytes * _FileCache.LOW_WATER_MARK
+        entries.sort()
+        for access_time, file_size, path in entries:
+          if size <= target:
+            break
+          size -= file_size
+          reclaimed += self._EvictPath(path, file_size)
+      self._lock.acquire()
+      try:
+        self._size = size
+        self._sweep_requested = False
+        self._bytes_reclaimed += reclaimed
+      finally:
+        self._lock.release()
+      return reclaimed
+    finally:
+      self._sweep_lock.release()
+
+  def GetBytesReclaimed(self):
+    '''Return the number of bytes reclaimed by all sweeps so far.'''
+    return self._bytes_reclaimed
+
+  def GetBytesSaved(self):
+    '''Return the number of bytes compression has saved so far.'''
+    if self._compressor is None:
+      return 0
+    return self._compressor.GetBytesSaved()
+
+  def GetStats(self):
+    '''Return the twitterapi.CacheStats counting the use of this cache.'''
+    return self._stats
+
+  def StartSweeper(self, interval=DEFAULT_SWEEP_INTERVAL):
+    '''Sweep the cache every interval seconds on a daemon thread.
+
+    Args:
+      interval: The number of seconds between sweeps [optional]
+    '''
+    self.StopSweeper()
+    self._sweeper_stopped = threading.Event()
+    self._sweeper = threading.Thread(target=self._RunSweeper,
+                                     args=(interval, self._sweeper_stopped))
+    self._sweeper.setDaemon(True)
+    self._sweeper.start()
+
+  def StopSweeper(self):
+    '''Stop the background sweeper, if one is running.'''
+    if self._sweeper is not None:
+      self._sweeper_stopped.set()
+      self._sweeper.join()
+      self._sweeper = None
+
+  def _RunSweeper(self, interval, stopped):
+    while True:
+      stopped.wait(interval)
+      if stopped.isSet():
+        return
+      try:
+        self.Sweep()
+      except (IOError, OSError):
+        pass
+
+  def _Resize(self, delta):
+    '''Update the estimated size of the cache, sweeping if it is too big.
+
+    The sweep runs on a thread of its own, so a Set never waits for the
+    cache directory to be walked, and only one is requested at a time.
+    '''
+    self._lock.acquire()
+    try:
+      if self._size is not None:
+        self._size += delta
+      needs_sweep = not self._sweep_requested and \
+                    (self._size is None or self._size > self._max_bytes)
+      if needs_sweep:
+        self._sweep_requested = True
+    finally:
+      self._lock.release()
+    if needs_sweep:
+      thread = threading.Thread(target=self._SweepInBackground)
+      thread.setDaemon(True)
+      thread.start()
+
+  def _SweepInBackground(self):
+    try:
+      self.Sweep()
+    except (IOError, OSError):
+      self._lock.acquire()
+      try:
+        self._sweep_requested = False
+      finally:
+        self._lock.release()
+
+  def _Replace(self, temp_path, path):
+    '''Atomically replace path with temp_path.'''
+    try:
+      os.rename(temp_path, path)
+    except OSError:
+      # Windows can't rename over an existing file
+      if os.name != 'nt' or not os.path.exists(path):
+        raise
+      os.remove(path)
+      os.rename(temp_path, path)
+
+  def _RemovePath(self, path, size):
+    '''Remove a cache file, returning the number of bytes reclaimed.'''
+    try:
+      os.remove(path)
+    except OSError:
+      return 0
+    return size
 
-  def _GetUsername(self):
+  def _EvictPath(self, path, size):
+    reclaimed = self._RemovePath(path, size)
+    if reclaimed:
+      self._stats.Add('evictions')
+    return reclaimed
+
+  @staticmethod
+  def _GetUsername():
     '''Attempt to find the username in a cross-platform fashion.'''
     try:
       return os.getenv('USER') or \
@@ -1622,3 +5107,928 @@ class _FileCache(object):
 
   def _GetPrefix(self,hashed_key):
     return os.path.sep.join(hashed_key[0:_FileCache.DEPTH])
+
+
+class _SqliteCache(object):
+  '''A cache that keeps every entry in a single SQLite database file.
+
+  Supports the same API as twitterapi._FileCache, but stores entries as
+  rows of one indexed table instead of one file per key, so it scales to
+  millions of keys without exhausting inodes, and a Set is a single
+  statement rather than a makedirs, mkstemp and rename.  The database may
+  be shared by several threads and processes.
+
+  If compress is true, entries are compressed in the database; see
+  twitterapi._CacheCompressor.
+  '''
+
+  TIMEOUT = 30
+
+  def __init__(self,path=None,compress=False):
+    '''Instantiate a new twitterapi._SqliteCache object.
+
+    Args:
+      path:
+        The database file to use, created if it does not exist.  Defaults
+        to python.cache_<username>.sqlite in the temp directory. [optional]
+      compress:
+        True to compress entries with the fastest codec available, or the
+        name of a twitterapi._CacheCompressor codec. [optional]
+    '''
+    if sqlite3 is None:
+      raise _FileCacheError('The sqlite3 module is not available')
+    if not path:
+      path = os.path.join(tempfile.gettempdir(),
+                          'python.cache_%s.sqlite' % _FileCache._GetUsername())
+    self._path = os.path.abspath(path)
+    self._compressor = _NewCacheCompressor(compress)
+    self._stats = CacheStats()
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(self._path,
+                                       timeout=_SqliteCache.TIMEOUT,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+    self._connection.text_factory = str
+    try:
+      # Let readers proceed while another process is writing
+      self._connection.execute('PRAGMA journal_mode=WAL')
+      self._connection.execute('PRAGMA synchronous=NORMAL')
+    except sqlite3.DatabaseError:
+      pass
+    self._Execute('CREATE TABLE IF NOT EXISTS cache ('
+                  'key TEXT PRIMARY KEY, data BLOB, cached_time REAL)')
+
+  def Get(self,key):
+    row = self._FetchOne('SELECT data FROM cache WHERE key = ?', key)
+    if row is None:
+      self._stats.Add('misses')
+      return None
+    data = str(row[0])
+    value = _CacheCompressor.Decompress(data)
+    if value is None:
+      # Treat an unreadable entry as a miss; see _FileCache.Get
+      self._stats.Add('misses')
+      self.Remove(key)
+      return None
+    self._stats.Add('hits')
+    self._stats.Add('bytes_read', len(data))
+    return value
+
+  def Set(self,key,data):
+    if self._compressor is not None:
+      data = self._compressor.Compress(data)
+    else:
+      data = _CacheCompressor.Escape(data)
+    self._Execute('INSERT OR REPLACE INTO cache (key, data, cached_time) '
+                  'VALUES (?, ?, ?)', key, sqlite3.Binary(data), time.time())
+    self._stats.Add('sets')
+    self._stats.Add('bytes_written', len(data))
+
+  def Remove(self,key):
+    self._Execute('DELETE FROM cache WHERE key = ?', key)
+
+  def Touch(self,key):
+    '''Mark an entry as freshly cached without rewriting its data.'''
+    self._Execute('UPDATE cache SET cached_time = ? WHERE key = ?',
+                  time.time(), key)
+
+  def GetCachedTime(self,key):
+    row = self._FetchOne('SELECT cached_time FROM cache WHERE key = ?', key)
+    if row is None:
+      return None
+    return row[0]
+
+  def GetBytesSaved(self):
+    '''Return the number of bytes compression has saved so far.'''
+    if self._compressor is None:
+      return 0
+    return self._compressor.GetBytesSaved()
+
+  def GetStats(self):
+    '''Return the twitterapi.CacheStats counting the use of this cache.'''
+    return self._stats
+
+  def Close(self):
+    '''Close the database connection.'''
+    self._lock.acquire()
+    try:
+      self._connection.close()
+    finally:
+      self._lock.release()
+
+  def _Execute(self, statement, *parameters):
+    self._lock.acquire()
+    try:
+      self._connection.execute(statement, parameters)
+    finally:
+      self._lock.release()
+
+  def _FetchOne(self, statement, *parameters):
+    self._lock.acquire()
+    try:
+      return self._connection.execute(statement, parameters).fetchone()
+    finally:
+      self._lock.release()
+
+
+class _MemoryCache(object):
+  '''A process-local LRU cache, optionally in front of a slower cache.
+
+  Supports the same API as twitterapi._FileCache.  Writes go through to
+  the backing cache, and entries found only in the backing cache are
+  copied into memory the first time they are looked up, so hot keys are
+  served without touching the backing cache at all.
+
+  The cache holds at most max_entries entries and max_bytes bytes of data,
+  evicting the least recently used entries first.  If ttl is set, entries
+  cached more than ttl seconds ago are dropped from memory instead of
+  being served, and are not copied in from the backing cache.
+  '''
+
+  DEFAULT_MAX_ENTRIES = 1000
+  DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+  # Indexes into the [prev, next, key, data, cached_time] list nodes
+  _PREV, _NEXT, _KEY, _DATA, _CACHED_TIME = range(5)
+
+  def __init__(self,
+               backing_cache=None,
+               max_entries=DEFAULT_MAX_ENTRIES,
+               max_bytes=DEFAULT_MAX_BYTES,
+               ttl=None):
+    '''Instantiate a new twitterapi._MemoryCache object.
+
+    Args:
+      backing_cache:
+        A cache supporting the twitterapi._FileCache API to read from and
+        write through to. [optional]
+      max_entries: The maximum number of entries held in memory [optional]
+      max_bytes: The maximum total size of the data held in memory [optional]
+      ttl: The number of seconds entries may be served from memory [optional]
+    '''
+    self._backing_cache = backing_cache
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+    self._lock = threading.Lock()
+    self._entries = {}
+    self._bytes = 0
+    self._stats = CacheStats()
+    # A circular doubly linked list of nodes, most recently used first
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, None]
+
+  def Get(self,key):
+    self._lock.acquire()
+    try:
+      node = self._Lookup(key)
+      if node is not None:
+        data = node[_MemoryCache._DATA]
+        self._stats.Add('hits')
+        self._stats.Add('bytes_read', len(data))
+        return data
+    finally:
+      self._lock.release()
+    self._stats.Add('misses')
+    if self._backing_cache is None:
+      return None
+    data = self._backing_cache.Get(key)
+    if data is not None:
+      self._Promote(key, data, self._backing_cache.GetCachedTime(key))
+    return data
+
+  def Set(self,key,data):
+    if self._backing_cache is not None:
+      self._backing_cache.Set(key, data)
+    self._stats.Add('sets')
+    self._stats.Add('bytes_written', len(data))
+    self._Store(key, data, time.time())
+
+  def Remove(self,key):
+    self._lock.acquire()
+    try:
+      self._Discard(key)
+    finally:
+      self._lock.release()
+    if self._backing_cache is not None:
+      self._backing_cache.Remove(key)
+
+  def Touch(self,key):
+    '''Mark an entry as freshly cached without rewriting its data.'''
+    if self._backing_cache is not None:
+      if hasattr(self._backing_cache, 'Touch'):
+        self._backing_cache.Touch(key)
+      else:
+        self._backing_cache.Set(key, self._backing_cache.Get(key))
+    self._lock.acquire()
+    try:
+      node = self._Lookup(key)
+      if node is not None:
+        node[_MemoryCache._CACHED_TIME] = time.time()
+    finally:
+      self._lock.release()
+
+  def GetCachedTime(self,key):
+    self._lock.acquire()
+    try:
+      node = self._Lookup(key)
+      if node is not None:
+        return node[_MemoryCache._CACHED_TIME]
+    finally:
+      self._lock.release()
+    if self._backing_cache is None:
+      return None
+    cached_time = self._backing_cache.GetCachedTime(key)
+    if cached_time is not None and not self._IsExpired(cached_time):
+      self._Promote(key, self._backing_cache.Get(key), cached_time)
+    return cached_time
+
+  def GetLock(self,key):
+    '''Return the backing cache's lock for refreshing key, or None.
+
+    Acquiring the lock drops the in-memory copy of the entry, as another
+    process may have replaced it in the backing cache.
+    '''
+    if self._backing_cache is None or \
+       not hasattr(self._backing_cache, 'GetLock'):
+      return None
+    lock = self._backing_cache.GetLock(key)
+    if lock is None:
+      return None
+    return _MemoryCacheLock(self, key, lock)
+
+  def GetStats(self):
+    '''Return the twitterapi.CacheStats counting the use of memory.
+
+    Only lookups answered from memory count as hits; the backing cache
+    keeps statistics of its own.
+    '''
+    return self._stats
+
+  def GetSize(self):
+    '''Return the number of entries and bytes held in memory.'''
+    self._lock.acquire()
+    try:
+      return len(self._entries), self._bytes
+    finally:
+      self._lock.release()
+
+  def _Forget(self, key):
+    '''Drop the in-memory copy of an entry, leaving the backing cache alone.'''
+    self._lock.acquire()
+    try:
+      self._Discard(key)
+    finally:
+      self._lock.release()
+
+  def _Promote(self, key, data, cached_time):
+    '''Copy an entry of the backing cache into memory, unless it is too old.'''
+    if cached_time is not None and not self._IsExpired(cached_time):
+      self._Store(key, data, cached_time)
+
+  def _IsExpired(self, cached_time):
+    return self._ttl is not None and time.time() >= cached_time + self._ttl
+
+  def _Lookup(self, key):
+    '''Return the node for key, moved to the front, or None.'''
+    node = self._entries.get(key)
+    if node is None:
+      return None
+    if self._IsExpired(node[_MemoryCache._CACHED_TIME]):
+      self._Discard(key)
+      self._stats.Add('evictions')
+      return None
+    self._Unlink(node)
+    self._LinkFront(node)
+    return node
+
+  def _Store(self, key, data, cached_time):
+    self._lock.acquire()
+    try:
+      self._Discard(key)
+      if data is None or len(data) > self._max_bytes:
+        return
+      node = [None, None, key, data, cached_time]
+      self._LinkFront(node)
+      self._entries[key] = node
+      self._bytes += len(data)
+      while len(self._entries) > self._max_entries or \
+            self._bytes > self._max_bytes:
+        self._Discard(self._root[_MemoryCache._PREV][_MemoryCache._KEY])
+        self._stats.Add('evictions')
+    finally:
+      self._lock.release()
+
+  def _Discard(self, key):
+    node = self._entries.pop(key, None)
+    if node is not None:
+      self._Unlink(node)
+      self._bytes -= len(node[_MemoryCache._DATA])
+
+  def _LinkFront(self, node):
+    first = self._root[_MemoryCache._NEXT]
+    node[_MemoryCache._PREV] = self._root
+    node[_MemoryCache._NEXT] = first
+    first[_MemoryCache._PREV] = node
+    self._root[_MemoryCache._NEXT] = node
+
+  def _Unlink(self, node):
+    node[_MemoryCache._PREV][_MemoryCache._NEXT] = node[_MemoryCache._NEXT]
+    node[_MemoryCache._NEXT][_MemoryCache._PREV] = node[_MemoryCache._PREV]
+
+
+class _MemoryCacheLock(object):
+  '''A backing cache lock that drops a _MemoryCache's copy of its key.'''
+
+  def __init__(self, memory_cache, key, lock):
+    self._memory_cache = memory_cache
+    self._key = key
+    self._lock = lock
+
+  def Acquire(self, timeout=None):
+    if not self._lock.Acquire(timeout):
+      return False
+    self._memory_cache._Forget(self._key)
+    return True
+
+  def Release(self):
+    self._lock.Release()
+
+
+class _ObjectCache(object):
+  '''A thread-safe LRU cache of arbitrary Python objects.
+
+  Holds at most max_entries entries, evicting the least recently used
+  entries first.
+  '''
+
+  DEFAULT_MAX_ENTRIES = 1000
+
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+    '''Instantiate a new twitterapi._ObjectCache object.
+
+    Args:
+      max_entries: The maximum number of entries held [optional]
+    '''
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def Get(self, key):
+    self._lock.acquire()
+    try:
+      value = self._entries.pop(key, None)
+      if value is not None:
+        self._entries[key] = value
+      return value
+    finally:
+      self._lock.release()
+
+  def Set(self, key, value):
+    self._lock.acquire()
+    try:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    finally:
+      self._lock.release()
+
+  def Remove(self, key):
+    self._lock.acquire()
+    try:
+      self._entries.pop(key, None)
+    finally:
+      self._lock.release()
+
+  def GetSize(self):
+    '''Return the number of entries held.'''
+    return len(self._entries)
+
+
+class _ConnectionPool(object):
+  '''A thread-safe pool of persistent HTTP/1.1 connections.
+
+  Connections are keyed by (scheme, host).  At most max_per_host connections
+  are open to a host at any one time; further callers wait for one to be
+  released.  A caller that has waited wait_timeout seconds gets a new
+  connection outside the pool instead, so responses that are never closed
+  cannot hang every later request.  Connections that sit idle for longer
+  than idle_timeout seconds are closed rather than reused.
+  '''
+
+  DEFAULT_MAX_PER_HOST = 4
+  DEFAULT_IDLE_TIMEOUT = 30 # seconds
+  DEFAULT_WAIT_TIMEOUT = 30 # seconds
+
+  def __init__(self, max_per_host=None, idle_timeout=None, wait_timeout=None):
+    if max_per_host is None:
+      max_per_host = _ConnectionPool.DEFAULT_MAX_PER_HOST
+    if idle_timeout is None:
+      idle_timeout = _ConnectionPool.DEFAULT_IDLE_TIMEOUT
+    if wait_timeout is None:
+      wait_timeout = _ConnectionPool.DEFAULT_WAIT_TIMEOUT
+    self._max_per_host = max_per_host
+    self._idle_timeout = idle_timeout
+    self._wait_timeout = wait_timeout
+    self._condition = threading.Condition()
+    self._idle = {}
+    self._active = {}
+    self._unpooled = set()
+    self._stats = {'created': 0, 'reused': 0, 'expired': 0, 'discarded': 0,
+                   'unpooled': 0}
+
+  def Acquire(self, scheme, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+              fresh=False):
+    '''Check a connection to host out of the pool.
+
+    Args:
+      scheme: Either 'http' or 'https'
+      host: The host[:port] to connect to
+      timeout: The socket timeout for newly created connections [optional]
+      fresh: If true, never hand out an idle connection [optional]
+
+    Returns:
+      A (connection, reused) tuple.  The connection must be handed back
+      with Release when the caller is done with it.
+    '''
+    key = (scheme, host)
+    deadline = time.time() + self._wait_timeout
+    pooled = True
+    self._condition.acquire()
+    try:
+      while True:
+        self._ExpireIdle(key)
+        idle = self._idle.get(key)
+        if idle and not fresh:
+          connection, last_used = idle.pop()
+          self._active[key] = self._active.get(key, 0) + 1
+          self._stats['reused'] += 1
+          return connection, True
+        if self._active.get(key, 0) + len(idle or []) < self._max_per_host:
+          break
+        if idle:
+          # Make room for a fresh connection by dropping an idle one
+          self._Close(idle.pop(0)[0])
+          self._stats['discarded'] += 1
+          continue
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          pooled = False
+          self._stats['unpooled'] += 1
+          break
+        self._condition.wait(remaining)
+      if pooled:
+        self._active[key] = self._active.get(key, 0) + 1
+    finally:
+      self._condition.release()
+    try:
+      connection = self._NewConnection(scheme, host, timeout)
+    except:
+      if pooled:
+        self.Release(scheme, host, None, False)
+      raise
+    self._condition.acquire()
+    try:
+      self._stats['created'] += 1
+      if not pooled:
+        self._unpooled.add(connection)
+    finally:
+      self._condition.release()
+    return connection, False
+
+  def Release(self, scheme, host, connection, reusable):
+    '''Hand a connection obtained from Acquire back to the pool.
+
+    Args:
+      scheme: The scheme the connection was acquired for
+      host: The host the connection was acquired for
+      connection: The connection, or None if it could not be created
+      reusable: True if the connection may carry another request
+    '''
+    key = (scheme, host)
+    self._condition.acquire()
+    try:
+      if connection in self._unpooled:
+        self._unpooled.remove(connection)
+        self._Close(connection)
+        return
+      self._active[key] -= 1
+      if connection is not None:
+        if reusable:
+          self._idle.setdefault(key, []).append((connection, time.time()))
+        else:
+          self._Close(connection)
+          self._stats['discarded'] += 1
+      self._condition.notify()
+    finally:
+      self._condition.release()
+
+  def Close(self):
+    '''Close every idle connection held by the pool.'''
+    self._condition.acquire()
+    try:
+      for idle in self._idle.values():
+        for connection, last_used in idle:
+          self._Close(connection)
+      self._idle = {}
+    finally:
+      self._condition.release()
+
+  def GetStats(self):
+    '''Return a snapshot of the pool's counters.
+
+    Returns:
+      A dict with the number of connections 'created', 'reused',
+      'expired' (closed after idle_timeout), 'discarded' (closed because
+      they could not be reused) and 'unpooled' (created outside the pool
+      after waiting wait_timeout), plus the current number of 'active' and
+      'idle' connections.
+    '''
+    self._condition.acquire()
+    try:
+      stats = dict(self._stats)
+      stats['active'] = sum(self._active.values())
+      stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+      return stats
+    finally:
+      self._condition.release()
+
+  def _ExpireIdle(self, key):
+    idle = self._idle.get(key)
+    if not idle:
+      return
+    cutoff = time.time() - self._idle_timeout
+    while idle and idle[0][1] < cutoff:
+      self._Close(idle.pop(0)[0])
+      self._stats['expired'] += 1
+
+  def _NewConnection(self, scheme, host, timeout):
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host, timeout=timeout)
+    return httplib.HTTPConnection(host, timeout=timeout)
+
+  def _Close(self, connection):
+    try:
+      connection.close()
+    except (socket.error, httplib.HTTPException):
+      pass
+
+
+class _PooledResponse(object):
+  '''Wraps an httplib response so its connection returns to the pool.
+
+  The connection is handed back as soon as the body has been read to the
+  end, or discarded if the response is closed before that.
+  '''
+
+  def __init__(self, pool, scheme, host, connection, response):
+    self._pool = pool
+    self._scheme = scheme
+    self._host = host
+    self._connection = connection
+    self._response = response
+    if response.length == 0:
+      # Drain empty bodies (e.g. 304 Not Modified) so the connection is idle
+      response.read()
+    if response.isclosed():
+      self._Release()
+
+  def recv(self, amt=None):
+    data = self._response.read(amt)
+    if self._response.isclosed():
+      self._Release()
+    return data
+
+  read = recv
+
+  def close(self):
+    self._Release()
+    self._response.close()
+
+  def _Release(self):
+    if self._connection is None:
+      return
+    reusable = self._response.isclosed() and not self._response.will_close
+    connection, self._connection = self._connection, None
+    self._pool.Release(self._scheme, self._host, connection, reusable)
+
+
+class _KeepAliveHandler(urllib2.HTTPHandler):
+  '''A urllib2 handler that sends requests over pooled connections.'''
+
+  # Run ahead of the stock HTTPSHandler that build_opener always installs
+  handler_order = urllib2.HTTPHandler.handler_order - 1
+
+  https_request = urllib2.AbstractHTTPHandler.do_request_
+
+  def __init__(self, pool):
+    urllib2.HTTPHandler.__init__(self)
+    self._pool = pool
+
+  def http_open(self, req):
+    return self._Open('http', req)
+
+  def https_open(self, req):
+    return self._Open('https', req)
+
+  def _Open(self, scheme, req, fresh=False):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError('no host given')
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict([(k, v) for k, v in req.headers.items()
+                         if k not in headers]))
+    headers = dict([(name.title(), value) for name, value in headers.items()])
+    connection, reused = self._pool.Acquire(scheme, host, req.timeout, fresh)
+    sent = False
+    try:
+      connection.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+      sent = True
+      response = connection.getresponse()
+    except (socket.error, httplib.HTTPException), e:
+      self._pool.Release(scheme, host, connection, False)
+      # The server may have dropped the idle connection; try a new one.  A
+      # request with a body that was sent in full may have been acted on,
+      # so it is not sent twice.
+      if reused and (not sent or req.data is None):
+        return self._Open(scheme, req, fresh=True)
+      raise urllib2.URLError(e)
+    pooled = _PooledResponse(self._pool, scheme, host, connection, response)
+    if 200 <= response.status < 300:
+      fp = socket._fileobject(pooled, close=True)
+    else:
+      # urllib2 keeps the response of an error on the HTTPError it raises,
+      # which may live long after the request.  Read the body now so the
+      # connection goes back to the pool instead of staying with it.
+      try:
+        fp = StringIO.StringIO(pooled.read())
+      except (socket.error, httplib.HTTPException), e:
+        pooled.close()
+        raise urllib2.URLError(e)
+    resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+    resp.code = response.status
+    resp.msg = response.reason
+    return resp
+
+
+def _DetachHttpError(error):
+  '''Read the body of an urllib2.HTTPError into memory and close its response.
+
+  The error can then be kept without holding on to a connection, and its
+  body can still be read.
+  '''
+  if error.fp is None or isinstance(error.fp, StringIO.StringIO):
+    return
+  try:
+    try:
+      body = error.read()
+    except (socket.error, httplib.HTTPException):
+      body = ''
+  finally:
+    error.close()
+  urllib2.HTTPError.__init__(error, error.filename, error.code, error.msg,
+                             error.hdrs, StringIO.StringIO(body))
+
+
+class _KeepAliveUrllib(object):
+  '''A stand-in for the urllib2 module whose openers reuse connections.
+
+  Anything other than build_opener is delegated to the wrapped urllib2
+  module, so an instance can be passed to twitterapi.Api.SetUrllib.
+  '''
+
+  def __init__(self, pool=None, urllib=urllib2):
+    if pool is None:
+      pool = _ConnectionPool()
+    self._pool = pool
+    self._urllib = urllib
+
+  def __getattr__(self, name):
+    return getattr(self._urllib, name)
+
+  def build_opener(self, *handlers):
+    # Each opener gets its own handler (handlers keep a reference to their
+    # opener) but all of them share one pool.
+    return self._urllib.build_opener(_KeepAliveHandler(self._pool), *handlers)
+
+  def GetStats(self):
+    '''Return the counters of the underlying twitterapi._ConnectionPool.'''
+    return self._pool.GetStats()
+
+  def Close(self):
+    '''Close all idle pooled connections.'''
+    self._pool.Close()
+
+
+class Future(object):
+  '''The pending result of a call made in the background.
+
+  Returned by the endpoints of twitterapi.AsyncApi.
+  '''
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def Done(self):
+    '''Return True if the call has finished, successfully or not.'''
+    return self._done
+
+  def Result(self, timeout=None):
+    '''Wait for the call to finish and return its result.
+
+    If the call raised an exception, the same exception is raised here.
+
+    Args:
+      timeout:
+        The maximum number of seconds to wait.  Waits forever if None.
+        [optional]
+    '''
+    self._Wait(timeout)
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def Exception(self, timeout=None):
+    '''Wait for the call to finish and return the exception it raised.
+
+    Returns:
+      The exception raised by the call, or None if it succeeded.
+    '''
+    self._Wait(timeout)
+    if self._exc_info:
+      return self._exc_info[1]
+    return None
+
+  def AddCallback(self, callback):
+    '''Call callback(future) when the call finishes.
+
+    If the call has already finished, callback is called immediately.
+    Otherwise it is called on the thread that finishes the call, and any
+    exception it raises is printed to stderr and otherwise ignored.
+    '''
+    self._condition.acquire()
+    try:
+      if not self._done:
+        self._callbacks.append(callback)
+        return
+    finally:
+      self._condition.release()
+    callback(self)
+
+  def SetResult(self, result):
+    self._Finish(result, None)
+
+  def SetException(self, exc_info):
+    '''Finish the call with the exception in exc_info (see sys.exc_info).'''
+    self._Finish(None, exc_info)
+
+  def _Wait(self, timeout):
+    self._condition.acquire()
+    try:
+      if not self._done:
+        self._condition.wait(timeout)
+      if not self._done:
+        raise TwitterError('Timed out waiting for the result')
+    finally:
+      self._condition.release()
+
+  def _Finish(self, result, exc_info):
+    self._condition.acquire()
+    try:
+      self._result = result
+      self._exc_info = exc_info
+      self._done = True
+      callbacks, self._callbacks = self._callbacks, []
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+    for callback in callbacks:
+      # A failing callback must not take the worker thread down with it
+      try:
+        callback(self)
+      except Exception:
+        traceback.print_exc()
+
+
+class _WorkerPool(object):
+  '''A bounded pool of daemon threads that run calls in the background.
+
+  Threads are started on demand, up to max_workers.
+  '''
+
+  def __init__(self, max_workers):
+    self._max_workers = max_workers
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._threads = []
+    self._idle = 0
+    self._shutdown = False
+
+  def Submit(self, function, *args, **kwargs):
+    '''Schedule function(*args, **kwargs) to run on a worker thread.
+
+    Returns:
+      A twitterapi.Future for the result of the call
+    '''
+    future = Future()
+    self._lock.acquire()
+    try:
+      if self._shutdown:
+        raise TwitterError('Cannot submit calls after Shutdown')
+      self._queue.put((future, function, args, kwargs))
+      if self._idle:
+        self._idle -= 1
+      elif len(self._threads) < self._max_workers:
+        thread = threading.Thread(target=self._Work)
+        thread.setDaemon(True)
+        self._threads.append(thread)
+        thread.start()
+    finally:
+      self._lock.release()
+    return future
+
+  def Shutdown(self, wait=True):
+    '''Stop the worker threads once the queued calls have run.
+
+    Args:
+      wait: If true, block until the worker threads have exited. [optional]
+    '''
+    self._lock.acquire()
+    try:
+      self._shutdown = True
+      threads = list(self._threads)
+    finally:
+      self._lock.release()
+    for thread in threads:
+      self._queue.put(None)
+    if wait:
+      for thread in threads:
+        thread.join()
+
+  def _Work(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      future, function, args, kwargs = item
+      try:
+        try:
+          result = function(*args, **kwargs)
+        except:
+          future.SetException(sys.exc_info())
+        else:
+          future.SetResult(result)
+      finally:
+        self._lock.acquire()
+        try:
+          self._idle += 1
+        finally:
+          self._lock.release()
+
+
+class _SingleFlight(object):
+  '''Collapses concurrent calls made with the same key into a single call.
+
+  The first caller for a key runs the call; callers that arrive while it is
+  still running wait for it and receive the same result, or exception.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def Do(self, key, function, *args):
+    '''Return function(*args), sharing the call with concurrent callers.'''
+    self._lock.acquire()
+    try:
+      future = self._calls.get(key)
+      leader = future is None
+      if leader:
+        future = self._calls[key] = Future()
+    finally:
+      self._lock.release()
+    if not leader:
+      return future.Result()
+    try:
+      result = function(*args)
+    except:
+      exc_info = sys.exc_info()
+      self._Forget(key)
+      future.SetException(exc_info)
+      raise exc_info[0], exc_info[1], exc_info[2]
+    self._Forget(key)
+    future.SetResult(result)
+    return result
+
+  def _Forget(self, key):
+    self._lock.acquire()
+    try:
+      del self._calls[key]
+    finally:
+      self._lock.release()